@@ -0,0 +1,478 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script evaluates the expressions of `patients.satisfying` and
+# `patients.categorised_as` variables (eg "dmres_date < diab_date",
+# "ckd OR (ckd15_date AND ckd35_date >= ckd15_date)") over whole columns
+#
+# each expression is parsed once, with cohortextractor's own token rules, into a
+# syntax tree which is compiled to numpy operations. Results follow the SQL the
+# TPP backend runs:
+#   - a column on its own is true where it isn't empty (0, or '' for strings and dates)
+#   - a missing date compares as '', so before every date and equal to another missing date
+#   - integer division truncates, and dividing by zero gives NULL
+#   - comparisons with NULL are NULL, and AND / OR / NOT use three-valued logic
+#   - a patient gets the first category whose expression is true (not NULL), or the DEFAULT
+#
+# usage: python analysis/category_expressions.py <cohort file> "<expression>"
+# prints how many patients in the cohort the expression is true, false and NULL for
+# # # # # # # # # # # # # # # # # # # # #
+
+import sys
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import sqlparse
+from cohortextractor.expressions import InvalidExpressionError, UnknownColumnError, filter_and_validate_tokens
+from sqlparse import tokens as ttypes
+
+
+COMPARISONS = {
+  ">": np.greater, "<": np.less, ">=": np.greater_equal, "<=": np.less_equal, "=": np.equal, "!=": np.not_equal,
+}
+ARITHMETIC = {"+": np.add, "-": np.subtract, "*": np.multiply}
+
+# value of a missing date, as a number of days: below every date, as '' is in SQL
+MISSING_DAY = np.iinfo("int64").min
+
+
+def tokenize(expression):
+  """
+  the tokens of an expression as (kind, text) pairs, checked against the tokens cohortextractor allows
+  """
+  tokens = []
+  for token in filter_and_validate_tokens(sqlparse.parse(expression)[0].flatten()):
+    if token.ttype is ttypes.Name:
+      kind = "name"
+    elif token.ttype in ttypes.Literal.String:
+      kind = "string"
+    elif token.ttype in ttypes.Number:
+      kind = "number"
+    elif token.ttype in ttypes.Keyword:
+      kind = "keyword"
+    elif token.ttype in ttypes.Comparison:
+      kind = "comparison"
+    elif token.ttype in ttypes.Operator:
+      kind = "operator"
+    else:
+      kind = "punctuation"
+    tokens.append((kind, token.value))
+  return tokens
+
+
+class Parser:
+  """
+  recursive descent parser for the expression dialect, from loosest to tightest binding:
+  OR, AND, NOT, comparisons, + and -, * and /, unary minus, then names, literals and brackets
+
+  nodes are tuples: ("or" | "and", left, right), ("not", operand), ("compare", op, left, right),
+  ("arithmetic", op, left, right), ("negate", operand), ("column", name) and ("literal", kind, text)
+  """
+
+  def __init__(self, tokens):
+    self.tokens = tokens
+    self.position = 0
+
+  def peek(self):
+    return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+  def take(self, kind=None, values=None):
+    token = self.peek()
+    if token[0] is None or (kind and token[0] != kind) or (values and token[1] not in values):
+      return None
+    self.position += 1
+    return token
+
+  def parse(self):
+    if not self.tokens:
+      raise InvalidExpressionError("empty expression")
+    node = self.disjunction()
+    if self.position != len(self.tokens):
+      raise InvalidExpressionError(f"unexpected {self.peek()[1]!r}")
+    return node
+
+  def disjunction(self):
+    node = self.conjunction()
+    while self.take("keyword", ["OR"]):
+      node = ("or", node, self.conjunction())
+    return node
+
+  def conjunction(self):
+    node = self.negation()
+    while self.take("keyword", ["AND"]):
+      node = ("and", node, self.negation())
+    return node
+
+  def negation(self):
+    if self.take("keyword", ["NOT"]):
+      return ("not", self.negation())
+    return self.comparison()
+
+  def comparison(self):
+    node = self.sum()
+    token = self.take("comparison")
+    if token:
+      node = ("compare", token[1], node, self.sum())
+    return node
+
+  def sum(self):
+    node = self.product()
+    while True:
+      token = self.take("operator", ["+", "-"])
+      if not token:
+        return node
+      node = ("arithmetic", token[1], node, self.product())
+
+  def product(self):
+    node = self.unary()
+    while True:
+      token = self.take("operator", ["*", "/"])
+      if not token:
+        return node
+      node = ("arithmetic", token[1], node, self.unary())
+
+  def unary(self):
+    if self.take("operator", ["-"]):
+      return ("negate", self.unary())
+    return self.primary()
+
+  def primary(self):
+    kind, text = self.peek()
+    if self.take("punctuation", ["("]):
+      node = self.disjunction()
+      if not self.take("punctuation", [")"]):
+        raise InvalidExpressionError("missing ')'")
+      return node
+    if self.take("name"):
+      return ("column", text)
+    if self.take("number") or self.take("string"):
+      return ("literal", kind, text)
+    raise InvalidExpressionError(f"unexpected {text!r}" if text else "unexpected end of expression")
+
+
+@lru_cache(maxsize=None)
+def parse(expression):
+  """
+  the syntax tree of an expression, parsed once however many times it's evaluated
+  """
+  try:
+    return Parser(tokenize(expression)).parse()
+  except InvalidExpressionError as e:
+    raise InvalidExpressionError(f"Invalid SQL expression: {expression}\nError: {e}")
+
+
+def expression_columns(node):
+  """
+  the names of the columns an expression (or syntax tree) uses
+  """
+  if isinstance(node, str):
+    node = parse(node)
+  if node[0] == "column":
+    return {node[1]}
+  if node[0] == "literal":
+    return set()
+  return set().union(*(expression_columns(child) for child in node[1:] if isinstance(child, tuple)))
+
+
+class Columns:
+  """
+  the columns of a frame as (values, nulls) arrays, converted once on first use:
+  dates as whole days (MISSING_DAY where missing), strings with '' for missing,
+  and numbers with a mask of missing values (or None if there aren't any)
+  """
+
+  def __init__(self, frame, column_types):
+    self.frame = frame
+    self.column_types = column_types
+    self.arrays = {}
+
+  def __getitem__(self, name):
+    if name not in self.arrays:
+      values = self.frame[name]
+      column_type = self.column_types[name]
+      nulls = None
+      if column_type == "date":
+        values = pd.to_datetime(values).to_numpy().astype("datetime64[D]").view("int64")
+      elif column_type == "str":
+        values = values.astype(object).fillna("").to_numpy(dtype=str)
+      else:
+        values = pd.to_numeric(values).to_numpy()
+        if values.dtype.kind == "f":
+          nulls = np.isnan(values)
+          if not nulls.any():
+            nulls = None
+            if column_type in ("bool", "int"):
+              values = values.astype("int64")
+        elif values.dtype.kind == "b":
+          values = values.astype("int64")
+      self.arrays[name] = (values, nulls)
+    return self.arrays[name]
+
+
+def infer_column_types(frame):
+  """
+  column types for a frame read back from an output file, where dates may be datetimes or strings
+  """
+  column_types = {}
+  for name, values in frame.items():
+    if pd.api.types.is_datetime64_any_dtype(values):
+      column_types[name] = "date"
+    elif pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+      column_types[name] = "int"
+    elif pd.api.types.is_float_dtype(values):
+      column_types[name] = "float"
+    else:
+      column_types[name] = "str"
+  return column_types
+
+
+def either_null(*nulls):
+  nulls = [mask for mask in nulls if mask is not None]
+  if not nulls:
+    return None
+  return np.logical_or.reduce(np.broadcast_arrays(*nulls)) if len(nulls) > 1 else nulls[0]
+
+
+def empty_value(kind):
+  return {"num": 0, "str": "", "date": MISSING_DAY}[kind]
+
+
+def literal_value(text, kind, as_kind):
+  """
+  a literal converted for comparison with a value of `as_kind`, as SQL converts it
+  """
+  if kind == "string":
+    text = text[1:-1]
+    if as_kind == "str":
+      return text
+    if as_kind == "date":
+      if text == "":
+        return MISSING_DAY
+      try:
+        return np.datetime64(text, "D").astype("int64")
+      except ValueError:
+        raise InvalidExpressionError(f"{text!r} is not a date")
+    try:
+      return float(text) if "." in text else int(text)
+    except ValueError:
+      raise InvalidExpressionError(f"{text!r} is not a number")
+  if as_kind == "str":
+    return text
+  if as_kind == "date":
+    raise InvalidExpressionError(f"can't compare a date with the number {text}")
+  return float(text) if "." in text or "e" in text.lower() else int(text)
+
+
+def compile_node(node, column_types):
+  """
+  compiles a syntax tree to a function of a Columns object, returning (kind, function)
+
+  the function returns (values, nulls), where nulls is a boolean mask of NULL
+  results or None if there can't be any; kind is "bool", "num", "str" or "date"
+  (a literal's kind is only settled by what it's compared with, so it's "literal")
+  """
+  operation = node[0]
+
+  if operation == "column":
+    name = node[1]
+    if name not in column_types:
+      raise UnknownColumnError(f"Unknown column: {name}")
+    kind = {"date": "date", "str": "str"}.get(column_types[name], "num")
+    return kind, lambda columns: columns[name]
+
+  if operation == "literal":
+    return "literal", node
+
+  if operation in ("and", "or"):
+    left, right = (condition(child, column_types) for child in node[1:])
+
+    def combine(columns):
+      (left_values, left_nulls), (right_values, right_nulls) = left(columns), right(columns)
+      left_true, left_false = known(left_values, left_nulls)
+      right_true, right_false = known(right_values, right_nulls)
+      if operation == "and":
+        true, false = left_true & right_true, left_false | right_false
+      else:
+        true, false = left_true | right_true, left_false & right_false
+      nulls = None if left_nulls is None and right_nulls is None else ~(true | false)
+      return true, nulls
+    return "bool", combine
+
+  if operation == "not":
+    operand = condition(node[1], column_types)
+
+    def negate(columns):
+      values, nulls = operand(columns)
+      return ~values, nulls
+    return "bool", negate
+
+  if operation == "compare":
+    compare = COMPARISONS[node[1]]
+    left, right = comparable(node[2], node[3], column_types)
+
+    def comparison(columns):
+      (left_values, left_nulls), (right_values, right_nulls) = left(columns), right(columns)
+      return compare(left_values, right_values), either_null(left_nulls, right_nulls)
+    return "bool", comparison
+
+  if operation == "negate":
+    operand = number(node[1], column_types)
+
+    def minus(columns):
+      values, nulls = operand(columns)
+      return -values, nulls
+    return "num", minus
+
+  if operation == "arithmetic":
+    left, right = (number(child, column_types) for child in node[2:])
+    if node[1] == "/":
+      return "num", lambda columns: divide(*left(columns), *right(columns))
+    apply = ARITHMETIC[node[1]]
+
+    def arithmetic(columns):
+      (left_values, left_nulls), (right_values, right_nulls) = left(columns), right(columns)
+      return apply(left_values, right_values), either_null(left_nulls, right_nulls)
+    return "num", arithmetic
+
+  raise InvalidExpressionError(f"unknown operation {operation}")
+
+
+def known(values, nulls):
+  """
+  masks of where a boolean is known to be true and known to be false
+  """
+  if nulls is None:
+    return values, ~values
+  return values & ~nulls, ~values & ~nulls
+
+
+def constant(value):
+  return lambda columns: (value, None)
+
+
+def condition(node, column_types):
+  """
+  compiles a node used as a condition: anything that isn't already a boolean
+  is true where it isn't empty (eg `registered`, `ckd15_date`)
+  """
+  kind, function = compile_node(node, column_types)
+  if kind == "bool":
+    return function
+  if kind == "literal":
+    kind = "str" if node[1] == "string" else "num"
+    function = constant(literal_value(node[2], node[1], kind))
+  empty = empty_value(kind)
+
+  def not_empty(columns):
+    values, nulls = function(columns)
+    return np.not_equal(values, empty), nulls
+  return not_empty
+
+
+def number(node, column_types):
+  """
+  compiles a node used in arithmetic, which only numbers (and conditions, as 0 or 1) support
+  """
+  kind, function = compile_node(node, column_types)
+  if kind == "literal":
+    return constant(literal_value(node[2], node[1], "num"))
+  if kind == "bool":
+    def as_number(columns):
+      values, nulls = function(columns)
+      return values.astype("int64"), nulls
+    return as_number
+  if kind != "num":
+    raise InvalidExpressionError(f"can't do arithmetic with {kind} values")
+  return function
+
+
+def comparable(left_node, right_node, column_types):
+  """
+  compiles both sides of a comparison, converting literals to the type of the other side
+  (and conditions to 0 or 1)
+  """
+  sides = []
+  for node in (left_node, right_node):
+    kind, function = compile_node(node, column_types)
+    if kind == "bool":
+      kind, function = "num", number(node, column_types)
+    sides.append((kind, function))
+  (left_kind, left), (right_kind, right) = sides
+  if left_kind == right_kind == "literal":
+    kind = "str" if "string" in (left_node[1], right_node[1]) else "num"
+    left = constant(literal_value(left_node[2], left_node[1], kind))
+    right = constant(literal_value(right_node[2], right_node[1], kind))
+  elif left_kind == "literal":
+    left = constant(literal_value(left_node[2], left_node[1], right_kind))
+  elif right_kind == "literal":
+    right = constant(literal_value(right_node[2], right_node[1], left_kind))
+  elif left_kind != right_kind:
+    raise InvalidExpressionError(f"can't compare {left_kind} values with {right_kind} values")
+  return left, right
+
+
+def divide(left, left_nulls, right, right_nulls):
+  """
+  SQL division: truncating when both sides are integers, and NULL when dividing by zero
+  """
+  left, right = np.broadcast_arrays(left, right)
+  by_zero = right == 0
+  divisor = np.where(by_zero, 1, right)
+  if left.dtype.kind in "iu" and right.dtype.kind in "iu":
+    quotient = left // divisor
+    quotient = quotient + ((quotient < 0) & (quotient * divisor != left))
+  else:
+    quotient = left / divisor
+  return quotient, either_null(left_nulls, right_nulls, by_zero if by_zero.any() else None)
+
+
+def evaluate(expression, frame, column_types=None):
+  """
+  evaluates a `satisfying` expression over the columns of `frame`, returning a nullable boolean Series
+  without `column_types`, they're inferred from the frame (eg a cohort read back from an output file)
+  """
+  column_types = column_types or infer_column_types(frame)
+  values, nulls = condition(parse(expression), column_types)(Columns(frame, column_types))
+  values = np.broadcast_to(values, len(frame))
+  nulls = np.zeros(len(frame), dtype=bool) if nulls is None else np.broadcast_to(nulls, len(frame))
+  return pd.Series(pd.arrays.BooleanArray(values.copy(), nulls.copy()), index=frame.index)
+
+
+def evaluate_categories(category_definitions, frame, column_types):
+  """
+  evaluates a `categorised_as` (or `satisfying`) definition over the extracted columns,
+  returning the first category whose expression is true for each patient
+  """
+  columns = Columns(frame, column_types)
+  default = None
+  categories = []
+  conditions = []
+  for category, expression in category_definitions.items():
+    if expression == "DEFAULT":
+      default = category
+      continue
+    values, nulls = condition(parse(expression), column_types)(columns)
+    true, _ = known(values, nulls)
+    categories.append(category)
+    conditions.append(np.broadcast_to(true, len(frame)))
+
+  values = [category for category in categories + [default] if category is not None]
+  dtype = np.result_type(*(np.asarray(category).dtype for category in values)) if values else np.dtype(object)
+  if dtype.kind in "biuf":
+    # patients in no category are NULL, which comes back as NaN alongside numbers
+    dtype = np.result_type(dtype, "int64") if default is not None else np.dtype("float64")
+    fallback = default if default is not None else np.nan
+  else:
+    dtype, fallback = np.dtype(object), default
+  values = np.full(len(frame), fallback, dtype=dtype)
+  for category, true in zip(reversed(categories), reversed(conditions)):
+    values[true] = category
+  return pd.Series(values, index=frame.index)
+
+
+if __name__ == "__main__":
+  from cohort_store import read_frame
+
+  source, expression = sys.argv[1:3]
+  cohort = read_frame(source, sorted(expression_columns(expression)))
+  result = evaluate(expression, cohort)
+  print(f"true: {result.sum()}, false: {(~result).sum()}, NULL: {result.isna().sum()}")
@@ -0,0 +1,133 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script compiles the codelist CSVs used by codelists.py into a single
+# binary store, so that importing codelists.py doesn't re-parse every CSV
+#
+# each entry records the modification time and hash of the CSV it came from;
+# an entry is only re-parsed when its CSV has changed (a changed mtime with an
+# unchanged hash just refreshes the mtime)
+#
+# usage: python analysis/codelist_store.py   (compiles every codelist up front)
+# # # # # # # # # # # # # # # # # # # # #
+
+import atexit
+import csv
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+from cohortextractor import codelist, combine_codelists
+from cohortextractor.codelistlib import check_categories_consistent
+
+
+STORE_PATH = Path("codelists/.codelists.pickle")
+
+
+def file_hash(path):
+  return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def read_codelist_csv(path, column, category_column=None):
+  """
+  reads codes (and categories) from a CSV exactly as cohortextractor's codelist_from_csv does
+  """
+  codes = []
+  with open(path, "r") as f:
+    for row in csv.DictReader(f):
+      code = row[column].strip()
+      if not code:
+        continue
+      if category_column:
+        codes.append((code, row[category_column].strip()))
+      else:
+        codes.append(code)
+  return tuple(codes)
+
+
+class CodelistStore:
+  """
+  codelists compiled from CSV, loaded from and saved to a single pickle file
+
+  `specs` maps each codelist name to the arguments of codelist_from_csv
+  (path, system, column and optionally category_column)
+  """
+
+  def __init__(self, specs, store_path=STORE_PATH):
+    self.specs = specs
+    self.store_path = Path(store_path)
+    self.entries = {}
+    self.codelists = {}
+    self.changed = False
+    try:
+      with open(self.store_path, "rb") as f:
+        self.entries = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+      self.entries = {}
+    # write back anything recompiled during this run once, on exit
+    atexit.register(self.save)
+
+  def entry(self, name):
+    """
+    the compiled entry for a codelist, recompiling it if its CSV or spec has changed
+    """
+    spec = self.specs[name]
+    path = spec["path"]
+    mtime = os.stat(path).st_mtime_ns
+    entry = self.entries.get(name)
+    if entry is not None and entry["spec"] == spec:
+      if entry["mtime"] == mtime:
+        return entry
+      if entry["hash"] == file_hash(path):
+        entry["mtime"] = mtime
+        self.changed = True
+        return entry
+
+    codes = read_codelist_csv(path, spec["column"], spec.get("category_column"))
+    entry = {
+      "spec": dict(spec),
+      "mtime": mtime,
+      "hash": file_hash(path),
+      "codes": codes,
+    }
+    if spec.get("category_column"):
+      check_categories_consistent(codes)
+    self.entries[name] = entry
+    self.changed = True
+    return entry
+
+  def get(self, name):
+    """
+    the codelist as a cohortextractor Codelist object, as returned by codelist_from_csv
+    """
+    if name not in self.codelists:
+      entry = self.entry(name)
+      self.codelists[name] = codelist(list(entry["codes"]), entry["spec"]["system"], check_categories=False)
+    return self.codelists[name]
+
+  def save(self):
+    """
+    writes the store if anything was recompiled; a read-only checkout just means no caching
+    """
+    if not self.changed:
+      return
+    partial = self.store_path.with_suffix(".partial")
+    try:
+      with open(partial, "wb") as f:
+        pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+      partial.replace(self.store_path)
+      self.changed = False
+    except OSError:
+      pass
+
+
+def combined(store, names):
+  return combine_codelists(*(store.get(name) for name in names))
+
+
+if __name__ == "__main__":
+  import sys
+  sys.path.insert(0, "analysis")
+  import codelists
+  for name in codelists.CODELIST_CSVS:
+    codelists.store.get(name)
+  print(f"compiled {len(codelists.CODELIST_CSVS)} codelists into {STORE_PATH}")
@@ -1,81 +1,321 @@
-from cohortextractor import (codelist, codelist_from_csv, combine_codelists)
+# codelists are compiled once into codelists/.codelists.pickle (see codelist_store.py)
+# and loaded lazily: `codelists.ast` only reads the asthma codelist, and only
+# re-parses its CSV if the file has changed since it was last compiled
+from codelist_store import CodelistStore, combined
 
 
-covid_icd10 = codelist_from_csv(
-    "codelists/opensafely-covid-identification.csv",
+CODELIST_CSVS = {
+  "covid_icd10": dict(
+    path="codelists/opensafely-covid-identification.csv",
     system="icd10",
     column="icd10_code",
-)
+  ),
 
-covid_primary_care_positive_test = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
+  "covid_primary_care_positive_test": dict(
+    path="codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
     system="ctv3",
     column="CTV3ID",
-)
+  ),
 
-covid_primary_care_code = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
+  "covid_primary_care_code": dict(
+    path="codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
     system="ctv3",
     column="CTV3ID",
-)
+  ),
 
-covid_primary_care_sequalae = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
+  "covid_primary_care_sequalae": dict(
+    path="codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
     system="ctv3",
     column="CTV3ID",
-)
-
-covid_primary_care_probable_combined = combine_codelists(
-    covid_primary_care_positive_test,
-    covid_primary_care_code,
-    covid_primary_care_sequalae,
-)
-covid_primary_care_suspected_covid_advice = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-suspected-covid-advice.csv",
+  ),
+
+  "covid_primary_care_suspected_covid_advice": dict(
+    path="codelists/opensafely-covid-identification-in-primary-care-suspected-covid-advice.csv",
     system="ctv3",
     column="CTV3ID",
-)
-covid_primary_care_suspected_covid_had_test = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-suspected-covid-had-test.csv",
+  ),
+
+  "covid_primary_care_suspected_covid_had_test": dict(
+    path="codelists/opensafely-covid-identification-in-primary-care-suspected-covid-had-test.csv",
     system="ctv3",
     column="CTV3ID",
-)
-covid_primary_care_suspected_covid_isolation = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-suspected-covid-isolation-code.csv",
+  ),
+
+  "covid_primary_care_suspected_covid_isolation": dict(
+    path="codelists/opensafely-covid-identification-in-primary-care-suspected-covid-isolation-code.csv",
     system="ctv3",
     column="CTV3ID",
-)
-covid_primary_care_suspected_covid_nonspecific_clinical_assessment = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-suspected-covid-nonspecific-clinical-assessment.csv",
+  ),
+
+  "covid_primary_care_suspected_covid_nonspecific_clinical_assessment": dict(
+    path="codelists/opensafely-covid-identification-in-primary-care-suspected-covid-nonspecific-clinical-assessment.csv",
     system="ctv3",
     column="CTV3ID",
-)
-covid_primary_care_suspected_covid_exposure = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-exposure-to-disease.csv",
+  ),
+
+  "covid_primary_care_suspected_covid_exposure": dict(
+    path="codelists/opensafely-covid-identification-in-primary-care-exposure-to-disease.csv",
     system="ctv3",
     column="CTV3ID",
-)
-primary_care_suspected_covid_combined = combine_codelists(
-    covid_primary_care_suspected_covid_advice,
-    covid_primary_care_suspected_covid_had_test,
-    covid_primary_care_suspected_covid_isolation,
-    covid_primary_care_suspected_covid_exposure,
-)
-
+  ),
 
-
-ethnicity = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
+  "ethnicity": dict(
+    path="codelists/opensafely-ethnicity.csv",
     system="ctv3",
     column="Code",
     category_column="Grouping_6",
-)
-ethnicity_16 = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
+  ),
+
+  "ethnicity_16": dict(
+    path="codelists/opensafely-ethnicity.csv",
     system="ctv3",
     column="Code",
     category_column="Grouping_16",
-)
+  ),
+
+
+  ## PRIMIS
+
+  # Patients in long-stay nursing and residential care
+  "carehome": dict(
+    path="codelists/primis-covid19-vacc-uptake-longres.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # High Risk from COVID-19 code
+  "shield": dict(
+    path="codelists/primis-covid19-vacc-uptake-shield.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Lower Risk from COVID-19 codes
+  "nonshield": dict(
+    path="codelists/primis-covid19-vacc-uptake-nonshield.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Asthma Diagnosis code
+  "ast": dict(
+    path="codelists/primis-covid19-vacc-uptake-ast.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Asthma Admission codes
+  "astadm": dict(
+    path="codelists/primis-covid19-vacc-uptake-astadm.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Asthma systemic steroid prescription codes
+  "astrx": dict(
+    path="codelists/primis-covid19-vacc-uptake-astrx.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Chronic Respiratory Disease
+  "resp_cov": dict(
+    path="codelists/primis-covid19-vacc-uptake-resp_cov.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Chronic heart disease codes
+  "chd_cov": dict(
+    path="codelists/primis-covid19-vacc-uptake-chd_cov.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Chronic kidney disease diagnostic codes
+  "ckd_cov": dict(
+    path="codelists/primis-covid19-vacc-uptake-ckd_cov.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Chronic kidney disease codes - all stages
+  "ckd15": dict(
+    path="codelists/primis-covid19-vacc-uptake-ckd15.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Chronic kidney disease codes-stages 3 - 5
+  "ckd35": dict(
+    path="codelists/primis-covid19-vacc-uptake-ckd35.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Chronic Liver disease codes
+  "cld": dict(
+    path="codelists/primis-covid19-vacc-uptake-cld.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Diabetes diagnosis codes
+  "diab": dict(
+    path="codelists/primis-covid19-vacc-uptake-diab.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Immunosuppression diagnosis codes
+  "immdx_cov": dict(
+    path="codelists/primis-covid19-vacc-uptake-immdx_cov.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Immunosuppression medication codes
+  "immrx": dict(
+    path="codelists/primis-covid19-vacc-uptake-immrx.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Chronic Neurological Disease including Significant Learning Disorder
+  "cns_cov": dict(
+    path="codelists/primis-covid19-vacc-uptake-cns_cov.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Asplenia or Dysfunction of the Spleen codes
+  "spln_cov": dict(
+    path="codelists/primis-covid19-vacc-uptake-spln_cov.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # BMI
+  "bmi": dict(
+    path="codelists/primis-covid19-vacc-uptake-bmi.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # All BMI coded terms
+  "bmi_stage": dict(
+    path="codelists/primis-covid19-vacc-uptake-bmi_stage.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Severe Obesity code recorded
+  "sev_obesity": dict(
+    path="codelists/primis-covid19-vacc-uptake-sev_obesity.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Diabetes resolved codes
+  "dmres": dict(
+    path="codelists/primis-covid19-vacc-uptake-dmres.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Severe Mental Illness codes
+  "sev_mental": dict(
+    path="codelists/primis-covid19-vacc-uptake-sev_mental.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Remission codes relating to Severe Mental Illness
+  "smhres": dict(
+    path="codelists/primis-covid19-vacc-uptake-smhres.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # to represent household contact of shielding individual
+  "hhld_imdef": dict(
+    path="codelists/primis-covid19-vacc-uptake-hhld_imdef.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Wider Learning Disability
+  "learndis": dict(
+    path="codelists/primis-covid19-vacc-uptake-learndis.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Carer codes
+  "carer": dict(
+    path="codelists/primis-covid19-vacc-uptake-carer.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # No longer a carer codes
+  "notcarer": dict(
+    path="codelists/primis-covid19-vacc-uptake-notcarer.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Employed by Care Home codes
+  "carehomeemployee": dict(
+    path="codelists/primis-covid19-vacc-uptake-carehome.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Employed by nursing home codes
+  "nursehomeemployee": dict(
+    path="codelists/primis-covid19-vacc-uptake-nursehome.csv",
+    system="snomed",
+    column="code",
+  ),
+
+  # Employed by domiciliary care provider codes
+  "domcareemployee": dict(
+    path="codelists/primis-covid19-vacc-uptake-domcare.csv",
+    system="snomed",
+    column="code",
+  ),
+}
+
+# codelists made by combining the ones above
+COMBINED_CODELISTS = {
+  "covid_primary_care_probable_combined": [
+    "covid_primary_care_positive_test",
+    "covid_primary_care_code",
+    "covid_primary_care_sequalae",
+  ],
+  "primary_care_suspected_covid_combined": [
+    "covid_primary_care_suspected_covid_advice",
+    "covid_primary_care_suspected_covid_had_test",
+    "covid_primary_care_suspected_covid_isolation",
+    "covid_primary_care_suspected_covid_exposure",
+  ],
+}
+
+store = CodelistStore(CODELIST_CSVS)
+
+
+def __getattr__(name):
+  if name in CODELIST_CSVS:
+    value = store.get(name)
+  elif name in COMBINED_CODELISTS:
+    value = combined(store, COMBINED_CODELISTS[name])
+  else:
+    raise AttributeError(f"module 'codelists' has no attribute '{name}'")
+  # cache on the module so later lookups don't come back through __getattr__
+  globals()[name] = value
+  return value
+
 
 # 
 # solid_organ_transplantation = codelist_from_csv(
@@ -199,225 +439,3 @@ ethnicity_16 = codelist_from_csv(
 # asplenia = codelist_from_csv(
 #     "codelists/opensafely-asplenia.csv", system="ctv3", column="CTV3ID"
 # )
-
-
-## PRIMIS
-
-
-# Patients in long-stay nursing and residential care
-carehome = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-longres.csv", 
-    system="snomed", 
-    column="code",
-)
-
-
-# High Risk from COVID-19 code
-shield = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-shield.csv",
-    system="snomed",
-    column="code",
-)
-
-# Lower Risk from COVID-19 codes
-nonshield = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-nonshield.csv",
-    system="snomed",
-    column="code",
-)
-
-
-
-# Asthma Diagnosis code
-ast = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-ast.csv",
-  system="snomed",
-  column="code",
-)
-
-# Asthma Admission codes
-astadm = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-astadm.csv",
-  system="snomed",
-  column="code",
-)
-
-# Asthma systemic steroid prescription codes
-astrx = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-astrx.csv",
-  system="snomed",
-  column="code",
-)
-
-# Chronic Respiratory Disease
-resp_cov = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-resp_cov.csv",
-  system="snomed",
-  column="code",
-)
-
-# Chronic heart disease codes
-chd_cov = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-chd_cov.csv",
-  system="snomed",
-  column="code",
-)
-
-# Chronic kidney disease diagnostic codes
-ckd_cov = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-ckd_cov.csv",
-  system="snomed",
-  column="code",
-)
-
-# Chronic kidney disease codes - all stages
-ckd15 = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-ckd15.csv",
-  system="snomed",
-  column="code",
-)
-
-# Chronic kidney disease codes-stages 3 - 5
-ckd35 = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-ckd35.csv",
-  system="snomed",
-  column="code",
-)
-
-# Chronic Liver disease codes
-cld = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-cld.csv",
-  system="snomed",
-  column="code",
-)
-
-# Diabetes diagnosis codes
-diab = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-diab.csv",
-  system="snomed",
-  column="code",
-)
-
-# Immunosuppression diagnosis codes
-immdx_cov = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-immdx_cov.csv",
-  system="snomed",
-  column="code",
-)
-
-# Immunosuppression medication codes
-immrx = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-immrx.csv",
-  system="snomed",
-  column="code",
-)
-
-# Chronic Neurological Disease including Significant Learning Disorder
-cns_cov = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-cns_cov.csv",
-  system="snomed",
-  column="code",
-)
-
-# Asplenia or Dysfunction of the Spleen codes
-spln_cov = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-spln_cov.csv",
-  system="snomed",
-  column="code",
-)
-
-# BMI
-bmi = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-bmi.csv",
-  system="snomed",
-  column="code",
-)
-
-# All BMI coded terms
-bmi_stage = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-bmi_stage.csv",
-  system="snomed",
-  column="code",
-)
-
-# Severe Obesity code recorded
-sev_obesity = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-sev_obesity.csv",
-  system="snomed",
-  column="code",
-)
-
-# Diabetes resolved codes
-dmres = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-dmres.csv",
-  system="snomed",
-  column="code",
-)
-
-# Severe Mental Illness codes
-sev_mental = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-sev_mental.csv",
-  system="snomed",
-  column="code",
-)
-
-# Remission codes relating to Severe Mental Illness
-smhres = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-smhres.csv",
-  system="snomed",
-  column="code",
-)
-
-
-# to represent household contact of shielding individual
-hhld_imdef = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-hhld_imdef.csv",
-  system="snomed",
-  column="code",
-)
-
-# Wider Learning Disability
-learndis = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-learndis.csv",
-  system="snomed",
-  column="code",
-)
-
-
-
-# Carer codes
-carer = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-carer.csv",
-  system="snomed",
-  column="code",
-)
-
-# No longer a carer codes
-notcarer = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-notcarer.csv",
-  system="snomed",
-  column="code",
-)
-
-# Employed by Care Home codes
-carehomeemployee = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-carehome.csv",
-  system="snomed",
-  column="code",
-)
-
-# Employed by nursing home codes
-nursehomeemployee = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-nursehome.csv",
-  system="snomed",
-  column="code",
-)
-
-# Employed by domiciliary care provider codes
-domcareemployee = codelist_from_csv(
-  "codelists/primis-covid19-vacc-uptake-domcare.csv",
-  system="snomed",
-  column="code",
-)
-
-
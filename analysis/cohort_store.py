@@ -0,0 +1,165 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script keeps an uncompressed Arrow IPC copy of a cohort extract (or of
+# any feather, parquet or CSV file) next to it, eg output/input.feather.arrow for
+# output/input.feather, which downstream scripts memory-map rather than read
+#
+# columns are then views onto the mapped file: nothing is decompressed or
+# parsed, and every process reading the store shares the same pages of the
+# operating system's file cache instead of holding its own copy of the cohort
+# (R can map the same file with arrow::read_feather(..., as_data_frame = FALSE))
+#
+# the store is only rebuilt when its source is newer than it
+#
+# CSVs are read as pandas.read_csv reads them, so NA (as R's write_csv writes a
+# missing value) is missing in text columns too, not the string "NA"
+#
+# a cohort written by local_extract.py --compact keeps its compact types in the
+# store (dates as dates, flags as int8, text dictionary-encoded); extracted_types
+# converts it back to cohortextractor's, using the column types in its metadata
+#
+# usage: python analysis/cohort_store.py <file> [<file> ...]   (builds each <file>.arrow up front)
+# # # # # # # # # # # # # # # # # # # # #
+
+import json
+import os
+import sys
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+
+STORE_SUFFIX = ".arrow"
+
+# schema metadata of a compact cohort: JSON of each column's column_type and date_format
+COMPACT_METADATA = "cohort_columns"
+
+# strftime format of each date_format, as cohortextractor writes dates
+DATE_FORMATS = {"YYYY": "%Y", "YYYY-MM": "%Y-%m", "YYYY-MM-DD": "%Y-%m-%d"}
+
+# tables already mapped by this process, keyed by store path and modification time
+_mapped = {}
+
+
+def store_path(source):
+  """
+  the store for `source`, named after its whole file name, so input.csv and input.feather have stores of their own
+  """
+  source = Path(source)
+  if source.suffix == STORE_SUFFIX:
+    return source
+  return source.with_name(source.name + STORE_SUFFIX)
+
+
+def read_source(source):
+  """
+  reads a feather, parquet or CSV file into an arrow table
+  """
+  source = Path(source)
+  if source.suffix in (".feather", STORE_SUFFIX):
+    return feather.read_table(source)
+  if source.suffix == ".parquet":
+    return pq.read_table(source)
+  if source.suffix == ".csv":
+    return pv.read_csv(source, convert_options=pv.ConvertOptions(strings_can_be_null=True))
+  raise ValueError(f"can't read a cohort from {source}: expected a .feather, .parquet or .csv file")
+
+
+def build_store(source):
+  """
+  writes the uncompressed store for `source`, unless it's already up to date, and returns its path
+  """
+  source = Path(source)
+  path = store_path(source)
+  if source == path:
+    return path
+  if path.exists() and path.stat().st_mtime_ns >= source.stat().st_mtime_ns:
+    return path
+  # one record batch, so each column maps as a single contiguous array
+  table = read_source(source).combine_chunks()
+  partial = path.with_name(f"{path.name}.{os.getpid()}.partial")
+  with pa.OSFile(str(partial), "wb") as sink:
+    with pa.ipc.new_file(sink, table.schema) as writer:
+      writer.write_table(table)
+  partial.replace(path)
+  return path
+
+
+def open_cohort(source):
+  """
+  the cohort in `source` as an arrow table backed by its memory-mapped store
+  """
+  path = build_store(source)
+  key = (path.resolve(), path.stat().st_mtime_ns)
+  if key not in _mapped:
+    # the table's buffers point into the map, which stays open for as long as they're used
+    _mapped[key] = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+  return _mapped[key]
+
+
+def column_view(table, name):
+  """
+  a column as a numpy array, without copying where arrow allows it
+  (numbers and dates with no missing values); other columns are converted
+  """
+  column = table.column(name)
+  if column.num_chunks == 1 and column.null_count == 0:
+    try:
+      return column.chunk(0).to_numpy(zero_copy_only=True)
+    except pa.ArrowInvalid:
+      pass
+  return column.to_numpy()
+
+
+def columns(source, names=None):
+  """
+  the named columns (or every column) of a cohort as numpy arrays, keyed by name
+  """
+  table = open_cohort(source)
+  return {name: column_view(table, name) for name in (names or table.column_names)}
+
+
+def read_frame(source, names=None):
+  """
+  the named columns (or every column) of a cohort as a pandas data frame
+  only the requested columns are touched, so the rest of the store is never paged in
+  """
+  table = open_cohort(source)
+  if names is not None:
+    table = table.select(list(names))
+  return table.to_pandas(date_as_object=False)
+
+
+def extracted_types(table):
+  """
+  a compact cohort (see local_extract.py --compact) with cohortextractor's column types:
+  dates as strings in their date_format, flags as int64 and text as plain strings
+  tables without compact metadata are returned as they are
+  """
+  metadata = (table.schema.metadata or {}).get(COMPACT_METADATA.encode())
+  if metadata is None:
+    return table
+  for name, column in json.loads(metadata).items():
+    if name not in table.column_names:
+      continue
+    values = table.column(name)
+    if column["column_type"] == "date":
+      # as cohortextractor, dates without a date_format are written as just the year
+      date_format = DATE_FORMATS[column.get("date_format") or "YYYY"]
+      values = pc.strftime(values.cast(pa.timestamp("s")), format=date_format)
+    elif column["column_type"] == "bool":
+      values = values.cast(pa.int64())
+    elif column["column_type"] == "str":
+      values = values.cast(pa.string())
+    else:
+      continue
+    table = table.set_column(table.column_names.index(name), name, values)
+  return table.replace_schema_metadata(None)
+
+
+if __name__ == "__main__":
+  for source in sys.argv[1:]:
+    print(f"{source} -> {build_store(source)}")
@@ -0,0 +1,252 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script extracts the variable types that read the patients, registrations,
+# addresses and ons_deaths tables, for local_extract.py
+#
+# each variable is one DuckDB query, run directly over the (pandas) table and
+# following the SQL that cohortextractor's TPP backend generates for it: the same
+# treatment of current registrations, the same grouping of duplicate deaths,
+# and so on. The patients being extracted and their date limits (resolved by
+# AnchorTable, so a missing anchor date is 1900-01-01 as in the TPP backend)
+# are joined in as a `limits` table, so only their rows are read
+#
+# differences from the TPP backend:
+#   - registrations and addresses with no end date are current, as 9999-12-31 is in TPP
+# # # # # # # # # # # # # # # # # # # # #
+
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import duckdb
+import pandas as pd
+
+
+# end date of current registrations and addresses, as recorded in TPP
+OPEN_END = "COALESCE(CAST(t.end_date AS TIMESTAMP), TIMESTAMP '9999-12-31')"
+
+
+@dataclass
+class Query:
+  """
+  the SQL for one variable, returning patient_id, value and date (of the match) columns
+
+  `limits` are the date references joined in as columns of `l` (eg l.lower),
+  `codes` is joined in as a `codes` table, and `finish` post-processes the result
+  """
+  sql: str
+  limits: dict = field(default_factory=dict)
+  codes: list = None
+  finish: object = None
+
+
+def codelist_codes(codelist):
+  return [code[0] if isinstance(code, tuple) else code for code in codelist]
+
+
+def period_condition(column, between):
+  """
+  SQL for `column` falling within `between`, with the date limits it refers to
+  """
+  lower, upper = between or (None, None)
+  conditions, limits = [], {}
+  if lower is not None:
+    conditions.append(f"{column} >= l.lower")
+    limits["lower"] = lower
+  if upper is not None:
+    conditions.append(f"{column} <= l.upper")
+    limits["upper"] = upper
+  return " AND ".join(conditions) or "TRUE", limits
+
+
+def age_as_of(reference_date, **_):
+  # whole years, as SQL Server's datediff counts year boundaries
+  years = "date_diff('year', CAST(t.date_of_birth AS DATE), CAST(l.reference AS DATE))"
+  return Query(
+    f"""
+    SELECT t.patient_id,
+      {years} - CASE WHEN date_add(CAST(t.date_of_birth AS DATE), to_years(CAST({years} AS INTEGER))) > l.reference THEN 1 ELSE 0 END AS value,
+      NULL::TIMESTAMP AS date
+    FROM limits l JOIN patients t USING (patient_id)
+    WHERE t.date_of_birth IS NOT NULL
+    """,
+    {"reference": reference_date},
+  )
+
+
+def all_patients(**_):
+  return Query("SELECT t.patient_id, 1 AS value, NULL::TIMESTAMP AS date FROM limits l JOIN patients t USING (patient_id)")
+
+
+def sex(**_):
+  return Query("SELECT t.patient_id, t.sex AS value, NULL::TIMESTAMP AS date FROM limits l JOIN patients t USING (patient_id)")
+
+
+def registered_with_one_practice_between(start_date, end_date, **_):
+  return Query(
+    f"""
+    SELECT DISTINCT t.patient_id, 1 AS value, NULL::TIMESTAMP AS date
+    FROM limits l JOIN registrations t USING (patient_id)
+    WHERE t.start_date <= l.start_date AND {OPEN_END} > l.end_date
+    """,
+    {"start_date": start_date, "end_date": end_date},
+  )
+
+
+def registered_as_of(reference_date, **_):
+  return registered_with_one_practice_between(reference_date, reference_date)
+
+
+def date_deregistered_from_all_supported_practices(between=None, **_):
+  # current registrations end in 9999, so they're never within the default limits
+  lower, upper = between or (None, None)
+  return Query(
+    f"""
+    SELECT patient_id, end_date AS value, end_date AS date FROM (
+      SELECT t.patient_id, MAX({OPEN_END}) AS end_date
+      FROM limits l JOIN registrations t USING (patient_id)
+      GROUP BY t.patient_id
+    ) d JOIN limits l USING (patient_id)
+    WHERE end_date >= COALESCE(l.lower, TIMESTAMP '1900-01-01') AND end_date <= COALESCE(l.upper, TIMESTAMP '3000-01-01')
+    """,
+    {"lower": lower, "upper": upper},
+  )
+
+
+def with_these_codes_on_death_certificate(
+  codelist=None, between=None, match_only_underlying_cause=False, returning="binary_flag", **_
+):
+  period, limits = period_condition("t.date", between)
+  conditions = [period]
+  if codelist is not None:
+    columns = ["icd10u"] if match_only_underlying_cause else ["icd10u"] + [f"icd10{number:03d}" for number in range(1, 16)]
+    conditions.append("(" + " OR ".join(f"t.{column} IN (SELECT code FROM codes)" for column in columns) + ")")
+  # some patients have more than one death record: take the earliest date, or the smallest code
+  values = {"binary_flag": "1", "date_of_death": "MIN(t.date)", "underlying_cause_of_death": "MIN(t.icd10u)"}
+  if returning not in values:
+    raise ValueError(f"Unsupported `returning` value: {returning}")
+  return Query(
+    f"""
+    SELECT t.patient_id, {values[returning]} AS value, MIN(t.date) AS date
+    FROM limits l JOIN ons_deaths t USING (patient_id)
+    WHERE {" AND ".join(conditions)}
+    GROUP BY t.patient_id
+    """,
+    limits,
+    codes=None if codelist is None else codelist_codes(codelist),
+  )
+
+
+def died_from_any_cause(between=None, returning="binary_flag", **_):
+  return with_these_codes_on_death_certificate(between=between, returning=returning)
+
+
+# query for each variable type
+QUERIES = {
+  "all": all_patients,
+  **{query.__name__: query for query in [
+    age_as_of, sex, registered_as_of, registered_with_one_practice_between,
+    date_deregistered_from_all_supported_practices, with_these_codes_on_death_certificate, died_from_any_cause,
+  ]},
+}
+
+
+def limits_table(anchors, limits):
+  """
+  the patients being extracted, with a column for each date limit
+  (at microsecond precision, like DuckDB's own timestamps, so they compare with 9999-12-31)
+  """
+  table = pd.DataFrame({"patient_id": anchors.frame.index.to_numpy()})
+  for column, date_ref in limits.items():
+    limit = anchors.limit(date_ref)
+    table[column] = pd.Series(pd.NaT, index=table.index, dtype="datetime64[ns]") if limit is None else limit
+    table[column] = table[column].astype("datetime64[us]")
+  return table
+
+
+def run_query(connection, query, anchors):
+  """
+  runs a variable's query, returning its values and match dates indexed by patient_id
+  """
+  connection.register("limits", limits_table(anchors, query.limits))
+  if query.codes is not None:
+    connection.register("codes", pd.DataFrame({"code": pd.Series(query.codes, dtype=object)}))
+  try:
+    rows = connection.execute(query.sql).df()
+  finally:
+    connection.unregister("limits")
+    if query.codes is not None:
+      connection.unregister("codes")
+  if query.finish is not None:
+    rows = query.finish(rows)
+  rows = rows.set_index("patient_id")
+  values = rows["value"]
+  if values.dtype == "Int64":
+    values = values.astype("int64")
+  elif values.dtype.kind == "M":
+    values = values.astype("datetime64[ns]")
+  return values, pd.to_datetime(rows["date"]).astype("datetime64[ns]")
+
+
+class ConnectionPool:
+  """
+  DuckDB connections shared by scan groups: a scan takes an idle connection, or
+  opens a new one if fewer than `size` are open, and hands it back when it's done,
+  so scans on different threads never share a connection and at most `size` run at once
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.idle = queue.LifoQueue()
+    self.opened = 0
+    self.lock = threading.Lock()
+
+  @contextmanager
+  def connection(self):
+    with self.lock:
+      if self.idle.empty() and self.opened < self.size:
+        self.idle.put(duckdb.connect())
+        self.opened += 1
+    connection = self.idle.get()
+    try:
+      yield connection
+    finally:
+      self.idle.put(connection)
+
+
+def query_for(query_type, query_args):
+  """
+  the query extracting a variable, from its (processed) study definition arguments
+  """
+  arguments = {key: value for key, value in query_args.items() if key not in ("column_type", "hidden", "return_expectations", "date_format")}
+  return QUERIES[query_type](**arguments)
+
+
+# each query already runs on every core, so more connections than cores wouldn't go any faster
+CONNECTIONS = ConnectionPool(os.cpu_count() or 1)
+
+
+def scan_with_duckdb(group, tables, anchors, profile=None):
+  """
+  extracts each variable in a scan group with its own DuckDB query over the group's table
+
+  returns a dict of values and a dict of match dates, keyed by variable name
+  """
+  columns, dates = {}, {}
+  with CONNECTIONS.connection() as connection:
+    connection.register(group.table, tables[group.table])
+    try:
+      for name, (query_type, query_args) in group.variables.items():
+        started = time.perf_counter()
+        columns[name], dates[name] = run_query(connection, query_for(query_type, query_args), anchors)
+        if profile is not None:
+          profile.record(name, group.label, time.perf_counter() - started, len(tables[group.table]), None, len(columns[name]))
+    finally:
+      connection.unregister(group.table)
+  return columns, dates
+
+
+# tables whose variables are extracted with DuckDB
+DUCKDB_TABLES = ("patients", "registrations", "addresses", "ons_deaths")
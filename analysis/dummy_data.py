@@ -0,0 +1,305 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script generates dummy data for a study definition from the
+# `return_expectations` of its variables, in the same format as
+# `cohortextractor generate_cohort --expectations-population ... --output-format feather`
+#
+# unlike cohortextractor's generator, every column is drawn in a single
+# vectorised pass, and dates defined relative to other variables respect those
+# dependencies: eg covid_vax_pfizer_2_date is only ever drawn on or after
+# covid_vax_pfizer_1_date + 1 day, and emergency_*_date only on emergency_date
+#
+# usage: python analysis/dummy_data.py <study_definition> <output_file> [--population N] [--seed S]
+# # # # # # # # # # # # # # # # # # # # #
+
+import argparse
+from pathlib import Path
+
+import cohortextractor
+import numpy as np
+import pandas as pd
+from cohortextractor.study_definition import merge
+
+from category_expressions import evaluate_categories
+from local_extract import DEFAULT_VALUES, MISSING_DATE_LIMIT, date_format, shift_dates
+from study_plan import dependency_levels, load_study, parse_date_ref
+
+
+# population_size in project.yaml
+DEFAULT_POPULATION = 100000
+
+# cohortextractor treats these ints as categories for the purposes of dummy data
+CATEGORICAL_RETURNS = ("index_of_multiple_deprivation", "rural_urban_classification")
+
+
+def uk_age_probabilities(max_age=110):
+  """
+  probability of each age from 0 to max_age - 1, following the same UK
+  population bands (and the same adjustment) as cohortextractor's `population_ages`
+  """
+  bands = pd.read_csv(Path(cohortextractor.__file__).parent / "uk_population_bands_2018.csv")
+  band_ends = bands["band"].str.split("-").str[1].astype(int).to_numpy()
+  counts = bands["range"].astype(str).str.replace(",", "").astype(int).to_numpy()
+  ages = np.arange(max_age)
+  p = counts[np.searchsorted(band_ends, ages)] / counts.sum() / 5
+  # make sure p adds up to 1 by trimming the largest value
+  p[np.argmax(p)] -= p.sum() - 1
+  return p
+
+
+def expectations_for(name, query_args, default_expectations):
+  """
+  a variable's return_expectations merged over the study's default_expectations
+  """
+  expectations = merge(default_expectations or {}, query_args.get("return_expectations") or {})
+  if not expectations:
+    raise ValueError(
+      f"No `return_expectations` defined for {name} and no `default_expectations` defined for the study"
+    )
+  return expectations
+
+
+def resolve_limit(date_ref, columns, population):
+  """
+  evaluates one end of a `between` period as an array of dates, one per patient
+  returns None for an open limit; a missing anchor date is treated as 1900-01-01, as in the TPP backend
+  """
+  if date_ref is None:
+    return None
+  column, offset = parse_date_ref(date_ref, columns.keys())
+  if column is None:
+    return np.full(population, np.datetime64(date_ref, "D"))
+  dates = columns[column]
+  dates = np.where(np.isnat(dates), np.datetime64(MISSING_DATE_LIMIT.date(), "D"), dates)
+  if offset is not None and offset[1] == "day":
+    dates = dates + np.timedelta64(offset[0], "D")
+  elif offset is not None:
+    dates = shift_dates(pd.Series(dates), *offset).to_numpy().astype("datetime64[D]")
+  return dates
+
+
+def period_limits(query_args, columns, population):
+  """
+  the earliest and latest date (or None) allowed for each patient by a variable's `between` period
+  """
+  lower, upper = query_args.get("between") or (None, None)
+  return resolve_limit(lower, columns, population), resolve_limit(upper, columns, population)
+
+
+def day_fractions(rng, population, rate):
+  """
+  how far back from the latest possible date each event falls, as a fraction of the period
+  """
+  if rate == "exponential_increase":
+    # same shape as cohortextractor (exponential with scale 0.1, truncated at
+    # the earliest date), drawn directly by inverting the truncated CDF
+    return -0.1 * np.log1p(-rng.random(population) * (1 - np.exp(-10)))
+  if rate in ("uniform", "universal"):
+    return rng.random(population)
+  raise ValueError("Only exponential_increase and uniform distributions currently supported")
+
+
+def generate_dates(rng, name, query_args, expectations, columns, population):
+  """
+  draws a date column between the expected earliest and latest dates, narrowed
+  to each patient's own period where it depends on other variables
+  """
+  date = expectations.get("date") or {}
+  for key in ("earliest", "latest"):
+    if key not in date:
+      raise ValueError(f"{name} must define a date[{key}] expectation")
+  earliest = np.full(population, np.datetime64(date["earliest"], "D"))
+  latest = np.full(population, np.datetime64(date["latest"], "D"))
+  lower, upper = period_limits(query_args, columns, population)
+  if lower is not None:
+    earliest = np.maximum(earliest, lower)
+  if upper is not None:
+    latest = np.minimum(latest, upper)
+
+  # eg a period ending the day before a missing date (1900-01-01) is empty
+  present = earliest <= latest
+  rate = expectations.get("rate", "exponential_increase")
+  if rate != "universal":
+    present &= rng.random(population) < expectations["incidence"]
+
+  elapsed = (latest - earliest).astype("int64")
+  days_back = np.minimum((day_fractions(rng, population, rate) * (elapsed + 1)).astype("int64"), elapsed)
+  dates = np.full(population, np.datetime64("NaT", "D"))
+  dates[present] = latest[present] - days_back[present].astype("timedelta64[D]")
+  return dates
+
+
+def generate_values(rng, name, column_type, expectations, present, population):
+  """
+  draws a bool, int, float or category column; patients not in `present` get the empty value
+  """
+  if "category" in expectations:
+    ratios = expectations["category"]["ratios"]
+    labels = np.array(list(ratios.keys()), dtype=object)
+    p = np.array(list(ratios.values()), dtype=float)
+    values = labels[rng.choice(len(labels), size=population, p=p / p.sum())]
+    empty = None
+  elif column_type == "bool":
+    values = np.ones(population, dtype="int64")
+    empty = 0
+  elif "int" in expectations:
+    distribution = expectations["int"]
+    if distribution["distribution"] == "normal":
+      values = rng.normal(distribution["mean"], distribution["stddev"], population).astype("int64")
+    elif distribution["distribution"] == "poisson":
+      values = rng.poisson(distribution["mean"], population)
+    elif distribution["distribution"] == "population_ages":
+      p = uk_age_probabilities()
+      values = rng.choice(len(p), size=population, p=p)
+    else:
+      raise ValueError(
+        "Only `normal`, `poisson`, and `population_ages` distributions currently supported for ints"
+      )
+    empty = 0
+  elif "float" in expectations:
+    distribution = expectations["float"]
+    if distribution["distribution"] != "normal":
+      raise ValueError("Only `normal` distributions currently supported for floats")
+    values = rng.normal(distribution["mean"], distribution["stddev"], population)
+    empty = 0.0
+  else:
+    raise ValueError(f"Column definition {name} does not return expected type {column_type}")
+
+  values = np.where(present, values, empty)
+  if column_type == "bool" and "category" in expectations:
+    values = np.where(present, values, 0).astype("int64")
+  return values
+
+
+def value_present(rng, name, expectations, match_dates, population):
+  """
+  which patients have a value for a non-date variable
+  """
+  if name in match_dates:
+    return ~np.isnat(match_dates[name])
+  if expectations.get("rate") == "universal":
+    return np.ones(population, dtype=bool)
+  return rng.random(population) < expectations["incidence"]
+
+
+def aggregate(columns, column_names, aggregate_function):
+  """
+  row-wise MIN or MAX of several columns, ignoring missing values as SQL does
+  """
+  stacked = pd.DataFrame({column: columns[column] for column in column_names})
+  if aggregate_function == "MIN":
+    aggregated = stacked.min(axis=1)
+  elif aggregate_function == "MAX":
+    aggregated = stacked.max(axis=1)
+  else:
+    raise ValueError(f"Unsupported aggregate function '{aggregate_function}'")
+  if pd.api.types.is_datetime64_any_dtype(aggregated):
+    return aggregated.to_numpy().astype("datetime64[D]")
+  return aggregated.fillna(0).to_numpy()
+
+
+def categorise(query_args, columns, column_types):
+  """
+  evaluates a `categorised_as` definition over the columns generated so far
+  used when the variable has no category expectations of its own
+  """
+  frame = pd.DataFrame({
+    column: pd.Series(values).astype("datetime64[ns]") if column_types[column] == "date" else values
+    for column, values in columns.items()
+  })
+  return evaluate_categories(query_args["category_definitions"], frame, column_types).to_numpy()
+
+
+def generate(study, population, seed=None):
+  """
+  generates `population` rows of dummy data for a study definition, returning a data frame
+  with a patient_id column followed by every output (non-hidden) variable
+  """
+  rng = np.random.default_rng(seed)
+  definitions = study.covariate_definitions
+  levels = dependency_levels(definitions)
+  column_types = {name: query_args["column_type"] for name, (_, query_args) in definitions.items()}
+  # variables whose match date is picked up elsewhere with `date_of`
+  match_date_sources = {
+    query_args["source"] for query_type, query_args in definitions.values()
+    if query_type == "value_from" and query_args.get("returning") == "date"
+  }
+  columns = {}
+  match_dates = {}
+
+  for name in sorted(definitions, key=lambda name: levels[name]):
+    query_type, query_args = definitions[name]
+    column_type = column_types[name]
+
+    if query_type == "fixed_value":
+      value = query_args["value"]
+      if column_type == "date":
+        value = np.datetime64(value, "D")
+      columns[name] = np.full(population, value)
+      continue
+    if query_type == "aggregate_of":
+      columns[name] = aggregate(columns, query_args["column_names"], query_args["aggregate_function"])
+      continue
+    if query_type == "value_from":
+      if query_args.get("returning") == "date":
+        columns[name] = match_dates[query_args["source"]]
+      else:
+        columns[name] = columns[query_args["source"]]
+      continue
+
+    expectations = expectations_for(name, query_args, study.default_expectations)
+    if query_type == "categorised_as" and "category" not in expectations:
+      columns[name] = categorise(query_args, columns, column_types)
+    elif column_type == "date" and query_type != "categorised_as":
+      columns[name] = generate_dates(rng, name, query_args, expectations, columns, population)
+    elif query_args.get("hidden") and column_type in ("int", "float", "str") and not (
+      {"category", "int", "float"} & set(expectations)
+    ):
+      # hidden values with no expectations (eg bmi_value) aren't generated by cohortextractor either
+      columns[name] = np.full(population, DEFAULT_VALUES[column_type], dtype=object if column_type == "str" else None)
+    else:
+      if name in match_date_sources:
+        match_dates[name] = generate_dates(rng, name, query_args, expectations, columns, population)
+      present = value_present(rng, name, expectations, match_dates, population)
+      columns[name] = generate_values(rng, name, column_type, expectations, present, population)
+
+  output = {"patient_id": rng.choice(population * 10, size=population, replace=False)}
+  for name, (query_type, query_args) in definitions.items():
+    if name == "population" or query_args.get("hidden"):
+      continue
+    output[name] = output_column(columns[name], query_args, date_format(definitions, name))
+  return pd.DataFrame(output)
+
+
+def output_column(values, query_args, date_format=None):
+  """
+  converts a generated column to the type cohortextractor writes to feather files,
+  with dates truncated to `date_format`
+  """
+  column_type = query_args["column_type"]
+  if query_args.get("returning") in CATEGORICAL_RETURNS:
+    column_type = "str"
+  if column_type == "date" and values.dtype.kind == "M":
+    precision = {"YYYY": "Y", "YYYY-MM": "M"}.get(date_format or "YYYY", "D")
+    return values.astype(f"datetime64[{precision}]").astype("datetime64[ns]")
+  if column_type == "bool":
+    return values.astype(bool)
+  if column_type == "str" or column_type == "date":
+    missing = pd.isna(values) | (values == DEFAULT_VALUES["str"])
+    return pd.Categorical(np.where(missing, None, values))
+  if column_type == "int":
+    return values.astype("int64")
+  return values.astype("float64")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="generate dummy data for a study definition from its return_expectations")
+  parser.add_argument("study_definition")
+  parser.add_argument("output_file")
+  parser.add_argument("--population", type=int, default=DEFAULT_POPULATION, help="number of rows to generate")
+  parser.add_argument("--seed", type=int, help="random seed, for reproducible dummy data")
+  args = parser.parse_args()
+
+  study = load_study(args.study_definition)
+  dummy = generate(study, args.population, args.seed)
+  dummy.to_feather(args.output_file, compression="zstd")
+  print(f"wrote {len(dummy)} rows of dummy data to {args.output_file}")
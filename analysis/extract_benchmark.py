@@ -0,0 +1,143 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script benchmarks the extraction of each study definition against
+# synthetic tables (see synthetic_tables.py) at fixed population sizes, well
+# beyond the population_size of 100000 in project.yaml
+#
+# for each population and study definition it records, in one JSON file:
+#   the time taken to extract the whole cohort, end to end (reading the tables included)
+#   the time and rows scanned and returned for each variable (see extract_profile.py)
+#   the peak memory of the extraction
+# each extraction runs in a fresh process, so the peak memory is that run's alone
+#
+# tables for each population are generated once, under <tables_root>/<population>,
+# and reused while the population and seed are unchanged
+#
+# usage: python analysis/extract_benchmark.py [--populations N ...] [--study-definitions NAME ...]
+#                                             [--seed S] [--batch-size N] [--workers N] [--tables-root DIR] [--output FILE]
+# # # # # # # # # # # # # # # # # # # # #
+
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+
+from extract_profile import ExtractionProfile
+from local_extract import extract, extract_in_batches, load_tables
+from study_plan import load_study, source_tables
+from synthetic_tables import STUDY_DEFINITIONS, generate_tables, read_study_dates
+
+
+POPULATIONS = (100000, 1000000, 10000000)
+
+
+def tables_for(tables_root, population, seed):
+  """
+  the directory of synthetic tables for `population`, generating them first
+  unless they were already generated with the same seed
+  """
+  tables_dir = Path(tables_root) / str(population)
+  settings = {"population": population, "seed": seed}
+  settings_file = tables_dir / "settings.json"
+  if not settings_file.exists() or json.loads(settings_file.read_text()) != settings:
+    started = time.perf_counter()
+    generate_tables(tables_dir, population, seed)
+    print(f"generated tables for {population} patients in {time.perf_counter() - started:.1f}s")
+    settings_file.write_text(json.dumps(settings))
+  return tables_dir
+
+
+def peak_memory_mb():
+  # ru_maxrss is in kilobytes on linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_extraction(study_definition, tables_dir, output_file, batch_size=None, workers=1):
+  """
+  extracts one study definition, returning its timings and peak memory
+
+  runs in its own process (see benchmark)
+  """
+  started = time.perf_counter()
+  study = load_study(study_definition)
+  profile = ExtractionProfile()
+  if batch_size:
+    patients, _ = extract_in_batches(study, tables_dir, output_file, batch_size, profile=profile, workers=workers)
+  else:
+    tables = load_tables(tables_dir, names=source_tables(study.covariate_definitions))
+    cohort = extract(study, tables, profile=profile, workers=workers)
+    cohort.to_feather(output_file)
+    patients = len(cohort)
+  seconds = time.perf_counter() - started
+
+  variables = profile.report()
+  variables = variables.astype(object).where(variables.notna(), None)
+  return {
+    "seconds": round(seconds, 3),
+    "peak_memory_mb": round(peak_memory_mb(), 1),
+    "patients_extracted": patients,
+    "variables": variables.to_dict("records"),
+  }
+
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def benchmark(populations, study_definitions, seed=0, batch_size=None, tables_root="output/benchmark/tables", workers=1):
+  """
+  one run per population and study definition; a study definition that fails
+  is recorded with its error rather than stopping the benchmark
+  """
+  runs = []
+  for population in populations:
+    tables_dir = tables_for(tables_root, population, seed)
+    for study_definition in study_definitions:
+      run = {"study_definition": study_definition, "population": population, "batch_size": batch_size, "workers": workers}
+      output_file = tables_dir / f"input_{study_definition}.feather"
+      # a new process for each run, so memory from earlier runs doesn't count towards its peak
+      with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        try:
+          run |= pool.submit(run_extraction, study_definition, tables_dir, output_file, batch_size, workers).result()
+        except Exception as error:
+          run["error"] = repr(error)
+      output_file.unlink(missing_ok=True)
+      print(
+        f"{study_definition} at {population} patients: "
+        + (run["error"] if "error" in run else f"{run['seconds']}s, {run['peak_memory_mb']}MB")
+      )
+      runs.append(run)
+
+  return {
+    "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    "commit": git_commit(),
+    "machine": {"platform": platform.platform(), "processor": platform.processor(), "python": platform.python_version()},
+    "seed": seed,
+    "study_dates": {name: date.strftime("%Y-%m-%d") for name, date in read_study_dates().items()},
+    "runs": runs,
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="benchmark the extraction of each study definition against synthetic tables")
+  parser.add_argument("--populations", type=int, nargs="+", default=POPULATIONS)
+  parser.add_argument("--study-definitions", nargs="+", default=STUDY_DEFINITIONS)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--batch-size", type=int, help="number of patients to extract at a time")
+  parser.add_argument("--workers", type=int, default=1, help="number of independent scans to run at once")
+  parser.add_argument("--tables-root", default="output/benchmark/tables")
+  parser.add_argument("--output", default="output/benchmark/extract_benchmark.json")
+  args = parser.parse_args()
+
+  results = benchmark(args.populations, args.study_definitions, args.seed, args.batch_size, args.tables_root, args.workers)
+  Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2)
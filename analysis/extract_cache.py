@@ -0,0 +1,218 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script caches extracted columns on disk, keyed by a fingerprint of each
+# variable's definition, so that re-running an extraction after editing a
+# study definition only re-queries the variables that changed
+#
+# a variable's fingerprint covers its arguments, the full contents of any
+# codelists it uses, the fingerprints of the variables its dates or expressions
+# depend on, and the source data it was extracted from. Variables outside the
+# population's own dependencies are only extracted for the population, so their
+# fingerprints also cover the population definition. Dates from
+# metadata_study-dates.json are already substituted into the arguments by the
+# time the study definition is loaded, so changing them changes the fingerprint.
+# For variables extracted with DuckDB the fingerprint also covers the SQL of the
+# query, so columns aren't reused once the query that extracted them changes
+#
+# the cache is content-addressed, so a variable defined the same way in two
+# study definitions (eg the covariates shared by study_definition_hcw and
+# study_definition_2dose) is only extracted once. With a size limit, the least
+# recently used columns are removed once the cache grows beyond it
+#
+# SharedColumns is the in-memory counterpart, for study definitions extracted
+# together by extract_cohorts.py
+# # # # # # # # # # # # # # # # # # # # #
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from duckdb_scans import QUERIES, query_for
+from study_plan import population_variables, variable_dependencies
+
+
+# arguments that don't change the extracted values
+IGNORED_ARGS = ("return_expectations", "hidden", "date_format")
+
+
+def canonical(value):
+  """
+  converts argument values (including codelists) to something json can serialise consistently
+  """
+  if hasattr(value, "system"):
+    return {"system": value.system, "codes": sorted(canonical(code) for code in value)}
+  if isinstance(value, dict):
+    return {str(key): canonical(item) for key, item in sorted(value.items(), key=lambda item: str(item[0]))}
+  if isinstance(value, (list, tuple)):
+    return [canonical(item) for item in value]
+  return value
+
+
+def compiled_query(query_type, query_args):
+  """
+  the SQL a variable is extracted with, or None if it isn't extracted with DuckDB
+  (or its arguments aren't supported, which extracting it reports)
+  """
+  if query_type not in QUERIES:
+    return None
+  try:
+    return query_for(query_type, query_args).sql
+  except ValueError:
+    return None
+
+
+def fingerprint_definitions(covariate_definitions, snapshot="", by_population=True):
+  """
+  returns a fingerprint (hex digest) for every variable in the study definition
+  `snapshot` identifies the source data, so columns are never reused across databases
+  with `by_population` False, fingerprints don't cover the population definition,
+  for variables extracted for several populations at once (see extract_cohorts.py)
+  """
+  column_names = set(covariate_definitions)
+  for_everyone = set(population_variables(covariate_definitions)) or column_names
+  fingerprints = {}
+
+  def fingerprint(name):
+    if name not in fingerprints:
+      query_type, query_args = covariate_definitions[name]
+      dependencies = sorted(variable_dependencies(query_type, query_args, column_names))
+      content = {
+        "query_type": query_type,
+        "query_args": canonical({key: value for key, value in query_args.items() if key not in IGNORED_ARGS}),
+        "dependencies": {dependency: fingerprint(dependency) for dependency in dependencies},
+        "snapshot": snapshot,
+        "query": compiled_query(query_type, query_args),
+      }
+      if by_population and name not in for_everyone:
+        content["population"] = fingerprint("population")
+      digest = hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode())
+      fingerprints[name] = digest.hexdigest()
+    return fingerprints[name]
+
+  for name in covariate_definitions:
+    fingerprint(name)
+  return fingerprints
+
+
+def tables_snapshot(tables_dir):
+  """
+  identifies a directory of local tables by the names, sizes and modification times of its files
+  """
+  stamps = [
+    (path.name, path.stat().st_size, path.stat().st_mtime_ns)
+    for path in sorted(Path(tables_dir).iterdir()) if path.is_file()
+  ]
+  return hashlib.sha256(json.dumps(stamps).encode()).hexdigest()
+
+
+class ColumnCache:
+  """
+  per-variable columns stored as <cache_dir>/<fingerprint>.feather, with columns
+  patient_id, value and date (the date of the record the value came from)
+
+  with `max_bytes`, the least recently used columns (by modification time, which
+  is updated whenever a column is reused) are removed when the cache is opened and
+  after each new column is stored, until the cache fits
+  """
+
+  def __init__(self, cache_dir, covariate_definitions, snapshot="", max_bytes=None):
+    self.cache_dir = Path(cache_dir)
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    self.fingerprints = fingerprint_definitions(covariate_definitions, snapshot)
+    self.max_bytes = max_bytes
+    self.reused = []
+    self.extracted = []
+    self.evicted = []
+    self.lock = threading.Lock()
+    if max_bytes is not None:
+      self.evict()
+
+  def path(self, name):
+    return self.cache_dir / f"{self.fingerprints[name]}.feather"
+
+  def get(self, name):
+    """
+    the cached (values, dates) for a variable, or None if it needs to be extracted
+    """
+    path = self.path(name)
+    try:
+      cached = pd.read_feather(path).set_index("patient_id")
+      os.utime(path)
+    except FileNotFoundError:
+      # never cached, or evicted by another scan
+      return None
+    self.reused.append(name)
+    return cached["value"], cached["date"]
+
+  def put(self, name, values, dates):
+    cached = pd.DataFrame({"value": values, "date": pd.to_datetime(dates.reindex(values.index))})
+    cached.index.name = "patient_id"
+    # write to a temporary file first so an interrupted run never leaves a partial column behind
+    # (one per thread, as variables with the same definition share a file)
+    path = self.path(name)
+    partial = path.with_suffix(f".{threading.get_ident()}.partial")
+    cached.reset_index().to_feather(partial)
+    partial.replace(path)
+    self.extracted.append(name)
+    if self.max_bytes is not None:
+      self.evict()
+
+  def evict(self):
+    """
+    removes the least recently used columns until the cache is no bigger than `max_bytes`
+    """
+    with self.lock:
+      columns = []
+      for path in self.cache_dir.glob("*.feather"):
+        try:
+          columns.append((path.stat().st_mtime_ns, path.stat().st_size, path))
+        except FileNotFoundError:
+          continue
+      size = sum(column_size for _, column_size, _ in columns)
+      for _, column_size, path in sorted(columns):
+        if size <= self.max_bytes:
+          break
+        path.unlink(missing_ok=True)
+        size -= column_size
+        self.evicted.append(path.stem)
+
+  def size(self):
+    return sum(path.stat().st_size for path in self.cache_dir.glob("*.feather"))
+
+  def summary(self):
+    hits, misses = len(self.reused), len(self.extracted)
+    rate = f" ({hits / (hits + misses):.0%} hit rate)" if hits + misses else ""
+    summary = f"{hits} variable(s) reused from cache, {misses} extracted{rate}"
+    if self.evicted:
+      summary += f", {len(self.evicted)} least recently used column(s) evicted"
+    return summary + f"; cache holds {self.size() / 1e6:.1f}MB"
+
+
+class SharedColumns:
+  """
+  columns kept in memory under their fingerprints while several study definitions
+  are extracted together (see extract_cohorts.py): a variable defined the same way
+  in more than one of them is extracted for the first and reused by the others
+
+  `columns` is the dict shared by every study definition, and `fingerprints` are
+  this study definition's (from fingerprint_definitions, with by_population False)
+  """
+
+  def __init__(self, columns, fingerprints):
+    self.columns = columns
+    self.fingerprints = fingerprints
+    self.reused = []
+    self.extracted = []
+
+  def get(self, name):
+    cached = self.columns.get(self.fingerprints[name])
+    if cached is not None:
+      self.reused.append(name)
+    return cached
+
+  def put(self, name, values, dates):
+    self.columns[self.fingerprints[name]] = (values, dates)
+    self.extracted.append(name)
@@ -0,0 +1,163 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script runs several study definitions against the same local tables in
+# one extraction (see local_extract.py), writing each one's cohort to its own file
+#
+# study_definition, study_definition_2dose and study_definition_hcw define many
+# of the same variables (vaccination dates, age, sex, ethnicity, practice and
+# address, comorbidities) over overlapping populations. Here every definition's
+# population is extracted first; a variable defined the same way in more than
+# one definition (by its fingerprint, see extract_cache.py) is then extracted
+# once, for the union of their populations, and reused by each of them, while
+# the rest are extracted for their own definition's population. Each cohort
+# keeps its own patients and columns, so each file is the same as a separate
+# local_extract.py run would write
+#
+# usage: python analysis/extract_cohorts.py <tables_dir> <study_definition> <output_file> [<study_definition> <output_file> ...]
+#                                           [--batch-size N] [--profile] [--workers N] [--compact]
+# with --batch-size, patients are extracted N at a time and each batch of every
+# cohort is appended to its output as it's done
+# with --profile, each cohort's profile is written next to its output (see extract_profile.py)
+# with --compact, each cohort is written in compact types (see local_extract.py)
+# # # # # # # # # # # # # # # # # # # # #
+
+import argparse
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+from extract_cache import SharedColumns, fingerprint_definitions
+from extract_profile import ExtractionProfile, report_path
+from local_extract import (
+  compact_table, extract_population, extract_remaining, format_output, load_tables, open_writer, output_columns,
+  output_schema, patient_batches, write_cohort,
+)
+from study_plan import load_study, population_variables, source_tables
+
+
+def extract_cohorts(studies, tables, profiles=None, workers=1, compact=False):
+  """
+  runs several study definitions (a dict of study objects) against local tables,
+  returning each one's cohort, keyed as `studies` are, as extract would
+
+  the populations, and the variables they depend on, are extracted for every
+  patient, one definition after another. The other variables which more than one
+  definition defines the same way are then extracted for the patients in any of
+  the populations, once for all those definitions, and each definition's own
+  variables only for its own population
+
+  `profiles` optionally maps a study's key to its ExtractionProfile
+  with `compact`, dates are left as datetimes, for compact_table
+  returns the cohorts and, for each definition, the variables it shares with the others
+  """
+  profiles = profiles or {}
+  columns = {}
+  definitions, column_types, fingerprints, caches, frames, match_dates = {}, {}, {}, {}, {}, {}
+  for key, study in studies.items():
+    definitions[key] = study.covariate_definitions
+    column_types[key] = {name: query_args["column_type"] for name, (_, query_args) in definitions[key].items()}
+    fingerprints[key] = fingerprint_definitions(definitions[key], by_population=False)
+    caches[key] = SharedColumns(columns, fingerprints[key])
+    frames[key], match_dates[key] = extract_population(
+      definitions[key], tables, column_types[key], caches[key], profiles.get(key), workers
+    )
+
+  definers = Counter(fingerprint for key in studies for fingerprint in set(fingerprints[key].values()))
+  shared = {key: [name for name, fingerprint in fingerprints[key].items() if definers[fingerprint] > 1] for key in studies}
+  # every frame has a row for every patient, in the same order
+  in_any = np.logical_or.reduce([frame["population"].astype(bool).to_numpy() for frame in frames.values()])
+  for key in studies:
+    # a shared variable's dependencies are shared too, as they're part of its fingerprint
+    population = population_variables(definitions[key])
+    common = {name: query for name, query in definitions[key].items() if name in shared[key] or name in population}
+    frame = frames[key][in_any].copy()
+    dates = {name: column[in_any] for name, column in match_dates[key].items()}
+    extract_remaining(common, frame, dates, tables, column_types[key], caches[key], profiles.get(key), workers)
+
+  cohorts = {}
+  for key in studies:
+    in_population = frames[key]["population"].astype(bool)
+    frame = frames[key][in_population].copy()
+    dates = {name: column[in_population] for name, column in match_dates[key].items()}
+    extract_remaining(definitions[key], frame, dates, tables, column_types[key], caches[key], profiles.get(key), workers)
+    cohort = frame[output_columns(definitions[key])]
+    cohorts[key] = cohort.reset_index() if compact else format_output(cohort, definitions[key])
+  return cohorts, shared
+
+
+def extract_cohorts_in_batches(studies, tables_dir, output_files, batch_size, profiles=None, workers=1, compact=False):
+  """
+  extracts `batch_size` patients at a time, reading only their rows from each table
+  and appending each batch of every cohort to its file in `output_files` (keyed as `studies` are)
+
+  returns the number of patients written to each file and the variables each definition shares with the others
+  """
+  names = set().union(*(source_tables(study.covariate_definitions) for study in studies.values()))
+  schemas = {key: output_schema(study.covariate_definitions, compact=compact) for key, study in studies.items()}
+  dictionaries = {key: {} for key in studies}
+  partials = {key: Path(path).with_name(Path(path).name + ".partial") for key, path in output_files.items()}
+  rows = dict.fromkeys(studies, 0)
+  shared = {key: [] for key in studies}
+  try:
+    with ExitStack() as stack:
+      writers = {
+        key: stack.enter_context(open_writer(partials[key], schemas[key], Path(output_files[key]).suffix))
+        for key in studies
+      }
+      for patient_ids in patient_batches(tables_dir, batch_size):
+        cohorts, shared = extract_cohorts(studies, load_tables(tables_dir, patient_ids, names), profiles, workers, compact)
+        for key, cohort in cohorts.items():
+          if compact:
+            writers[key].write_table(compact_table(cohort, studies[key].covariate_definitions, schemas[key], dictionaries[key]))
+          else:
+            writers[key].write_table(pa.Table.from_pandas(cohort, schema=schemas[key], preserve_index=False))
+          rows[key] += len(cohort)
+  except BaseException:
+    for partial in partials.values():
+      partial.unlink(missing_ok=True)
+    raise
+  for key, partial in partials.items():
+    partial.replace(output_files[key])
+  return rows, shared
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="run several study definitions against the same local tables in one extraction")
+  parser.add_argument("tables_dir")
+  parser.add_argument("cohorts", nargs="+", metavar="study_definition output_file")
+  parser.add_argument("--batch-size", type=int, help="number of patients to extract at a time")
+  parser.add_argument("--profile", action="store_true", help="write the time and rows for each variable next to each output")
+  parser.add_argument("--workers", type=int, default=1, help="number of independent scans to run at once")
+  parser.add_argument("--compact", action="store_true", help="write dates, flags and text in compact types")
+  args = parser.parse_args()
+  if len(args.cohorts) % 2:
+    parser.error("each study definition needs an output file")
+
+  output_files = dict(zip(args.cohorts[::2], args.cohorts[1::2]))
+  studies = {name: load_study(name) for name in output_files}
+  profiles = {name: ExtractionProfile() for name in studies} if args.profile else None
+  if args.batch_size:
+    rows, shared = extract_cohorts_in_batches(
+      studies, args.tables_dir, output_files, args.batch_size, profiles, args.workers, args.compact,
+    )
+  else:
+    names = set().union(*(source_tables(study.covariate_definitions) for study in studies.values()))
+    cohorts, shared = extract_cohorts(studies, load_tables(args.tables_dir, names=names), profiles, args.workers, args.compact)
+    rows = {}
+    for name, cohort in cohorts.items():
+      if args.compact:
+        definitions = studies[name].covariate_definitions
+        write_cohort(compact_table(cohort, definitions, output_schema(definitions, compact=True), {}), output_files[name])
+      else:
+        write_cohort(pa.Table.from_pandas(cohort, preserve_index=False), output_files[name])
+      rows[name] = len(cohort)
+
+  for name, path in output_files.items():
+    print(
+      f"{name}: wrote {rows[name]} patients to {path};"
+      f" {len(shared[name])} of {len(studies[name].covariate_definitions)} variables shared with the other definitions"
+    )
+    if profiles is not None:
+      profiles[name].write(report_path(path))
@@ -0,0 +1,102 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script reports where extraction time goes, variable by variable:
+# seconds spent, rows scanned, rows matched and rows returned, slowest first
+#
+# local_extract.py --profile records these as it runs and writes the report
+# next to its output (eg output/input.feather.profile.csv for output/input.feather)
+#
+# for a `generate_cohort` run against the TPP backend, the same report (with
+# time only) can be built from the query timings cohortextractor writes to its log
+#
+# usage: python analysis/extract_profile.py <cohortextractor log> <report.csv>
+# # # # # # # # # # # # # # # # # # # # #
+
+import re
+import sys
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+
+COLUMNS = ["variable", "step", "seconds", "rows_scanned", "rows_matched", "rows_returned"]
+
+# a finished query in cohortextractor's console log, eg
+# ... description='Query for covid_vax_pfizer_1_date' execution_time=... execution_time_secs=1.52 ... timing=stop ...
+LOGGED_QUERY = re.compile(r"description='?Query for (?P<variable>[^'\s]+).*execution_time_secs=(?P<seconds>[0-9.e+-]+)")
+ANSI_CODES = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def report_path(output_file):
+  """
+  where the profile of an extraction to `output_file` is written: <output_file>.profile.csv
+  """
+  output_file = Path(output_file)
+  return output_file.with_name(output_file.name + ".profile.csv")
+
+
+class ExtractionProfile:
+  """
+  time and row counts per variable, summed over every scan (and batch) that extracted it
+  scans running on several threads can record into the same profile
+  """
+
+  def __init__(self):
+    self.records = {}
+    self.lock = threading.Lock()
+
+  def record(self, name, step, seconds, rows_scanned=None, rows_matched=None, rows_returned=None):
+    with self.lock:
+      record = self.records.setdefault(name, dict.fromkeys(COLUMNS[2:], 0) | {"variable": name, "step": step})
+      record["seconds"] += seconds
+      for key, rows in [("rows_scanned", rows_scanned), ("rows_matched", rows_matched), ("rows_returned", rows_returned)]:
+        if rows is None:
+          record[key] = None
+        elif record[key] is not None:
+          record[key] += rows
+
+  def share(self, seconds, weights):
+    """
+    spreads the time of a scan shared by several variables across them, in proportion to `weights`
+    (eg the rows each one matched), or evenly if they're all zero
+    """
+    total = sum(weights.values())
+    with self.lock:
+      for name, weight in weights.items():
+        self.records[name]["seconds"] += seconds * (weight / total if total else 1 / len(weights))
+
+  def report(self):
+    """
+    the profile as a data frame, slowest variable first
+    """
+    report = pd.DataFrame(list(self.records.values()), columns=COLUMNS)
+    for column in COLUMNS[3:]:
+      report[column] = report[column].astype("Int64")
+    return report.sort_values("seconds", ascending=False, kind="stable").reset_index(drop=True)
+
+  def write(self, path):
+    report = self.report()
+    report.to_csv(path, index=False, float_format="%.4f")
+    return report
+
+
+def profile_from_log(lines):
+  """
+  the time taken by each variable's query, from cohortextractor's log of a `generate_cohort` run
+  """
+  profile = ExtractionProfile()
+  for line in lines:
+    line = ANSI_CODES.sub("", line)
+    if "timing=stop" not in line:
+      continue
+    query = LOGGED_QUERY.search(line)
+    if query:
+      profile.record(query["variable"], "query", float(query["seconds"]))
+  return profile
+
+
+if __name__ == "__main__":
+  log_file, output_file = sys.argv[1:3]
+  with open(log_file) as lines:
+    report = profile_from_log(lines).write(output_file)
+  print(report.head(20).to_string(index=False))
@@ -0,0 +1,1322 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script runs a study definition against local, TPP-shaped tables
+# using the plan from study_plan.py, so that each scan group reads its
+# source table once for all of its variables
+#
+# tables are read from a directory of <table>.feather or <table>.parquet files:
+#   patients:        patient_id, date_of_birth, sex
+#   clinical_events: patient_id, date, code, numeric_value
+#   medications:     patient_id, date, code
+#   ecds:            patient_id, attendance_id, date (of arrival), discharge_destination
+#   ecds_diagnoses:  attendance_id, code (one row per diagnosis on the attendance)
+#   vaccinations:    patient_id, date, product_name, target_disease (one row per disease the vaccine targets)
+#   healthcare_workers: patient_id, healthcare_worker ("Y" for patients flagged on their covid vaccine record)
+#   registrations:   patient_id, registration_id, start_date, end_date (missing while current),
+#                    practice_id, stp_code, region, msoa (of the practice)
+#   addresses:       patient_id, address_id, start_date, end_date (missing while current), msoa,
+#                    imd_rounded, rural_urban, care_home (1 for a potential care home),
+#                    requires_nursing, does_not_require_nursing ("Y" or "N")
+#   ons_deaths:      patient_id, date (of death), icd10u (underlying cause), icd10001 to icd10015
+#   sgss_tests:      patient_id, date (of specimen), result ("positive" or "negative"),
+#                    earliest (1 for the earliest specimen of an episode)
+#   apcs:            patient_id, apcs_ident, admission_date, discharge_date, admission_method,
+#                    primary_diagnosis, diagnoses and procedures (all codes on the spell, eg "||U071 ,J189"),
+#                    days_in_critical_care, ethnicity
+# variables from the patients, registrations, addresses and ons_deaths tables
+# are extracted with DuckDB (see duckdb_scans.py)
+# ethnicity from SUS is the most frequent code on APCS spells alone
+# (TPP also counts A&E and outpatient records)
+#
+# usage: python analysis/local_extract.py <study_definition> <tables_dir> <output_file> [--cache-dir DIR [--cache-size-mb MB]] [--batch-size N] [--columns MANIFEST] [--workers N] [--compact]
+# the output is written as parquet if <output_file> ends in .parquet, and as feather otherwise
+# with --cache-dir, columns whose definitions are unchanged since the last run are reused
+# (and with --cache-size-mb, the least recently used columns are evicted to keep the cache within that size)
+# with --batch-size, patients are extracted N at a time and each batch is appended to
+# the output as it's done, so memory use is bounded by the batch size
+# with --profile, the time and rows scanned and returned for each variable are
+# written next to the output, slowest first (see extract_profile.py)
+# with --columns, only the columns listed in the manifest (see study_plan.py) are
+# written, and only they, the population and what they depend on are extracted
+# with --workers, up to N scans that don't depend on each other run at once
+# with --compact, columns are written in compact types rather than cohortextractor's
+# (see COMPACT_TYPES): dates as arrow dates (days since 1970-01-01, truncated to the
+# variable's date_format), flags as int8 and text dictionary-encoded, with each
+# column's type and date_format in the file's metadata (see cohort_store.py)
+# # # # # # # # # # # # # # # # # # # # #
+
+import argparse
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from category_expressions import evaluate_categories
+from cohort_store import COMPACT_METADATA
+from duckdb_scans import DUCKDB_TABLES, codelist_codes, scan_with_duckdb
+from extract_cache import ColumnCache, tables_snapshot
+from extract_profile import ExtractionProfile, report_path
+from study_plan import (
+  ScanGroup, anchor_columns, load_study, parse_date_ref, plan_levels, plan_remaining, population_variables,
+  project_definitions, read_manifest, select_columns, source_tables,
+)
+
+
+# value used for patients with no matching record, as in the TPP backend
+DEFAULT_VALUES = {"date": pd.NaT, "str": "", "bool": 0, "int": 0, "float": 0.0}
+
+# missing dates are stored as '' in the TPP backend, which SQL Server reads as
+# 1900-01-01 when they're used as the limit of a period
+MISSING_DATE_LIMIT = pd.Timestamp("1900-01-01")
+
+# tables with no patient_id, which are read for the rows of the table they belong to
+# (the parent table and the column joining them)
+LINKED_KEYS = {"ecds_diagnoses": ("ecds", "attendance_id")}
+
+# apcs columns which admitted_to_hospital can filter on (with_<column>) or return
+APCS_COLUMNS = (
+  "admission_method", "source_of_admission", "discharge_destination", "patient_classification",
+  "primary_diagnosis", "days_in_critical_care",
+)
+
+# codelist arguments of admitted_to_hospital -> the apcs column they match and what comes before a code:
+# primary diagnoses start with one of the codes; the other lists match a code anywhere after a separator
+APCS_CODE_COLUMNS = {
+  "with_these_primary_diagnoses": ("primary_diagnosis", "^"),
+  "with_these_diagnoses": ("diagnoses", "[^A-Za-z0-9]"),
+  "with_these_procedures": ("procedures", "[^A-Za-z0-9]"),
+}
+
+# column read for each `returning` of registered_practice_as_of and address_as_of
+PRACTICE_COLUMNS = {"stp_code": "stp_code", "msoa": "msoa", "msoa_code": "msoa", "nuts1_region_name": "region", "pseudo_id": "practice_id"}
+ADDRESS_COLUMNS = {"index_of_multiple_deprivation": "imd_rounded", "rural_urban_classification": "rural_urban", "msoa": "msoa"}
+
+# variable types which read the registration or address each patient has on a date
+SNAPSHOT_TYPES = ("registered_practice_as_of", "address_as_of", "care_home_status_as_of")
+
+# first character of an ethnicity code on SUS records -> 6 and 16 category groups
+ETHNICITY_GROUPS = {
+  "group_6": dict(zip("ABCDEFGHJKLMNPRS", "1112222333344455")),
+  "group_16": {letter: str(number) for number, letter in enumerate("ABCDEFGHJKLMNPRS", start=1)},
+}
+
+# arrow type of each output column type, so that every batch is written with the same schema
+# (dates are written as strings, as formatted by format_output)
+ARROW_TYPES = {"date": pa.string(), "str": pa.string(), "bool": pa.int64(), "int": pa.int64(), "float": pa.float64()}
+
+# arrow type of each output column type with --compact: text is mostly a few distinct
+# values (regions, stps, msoas, categories), so each is stored once in the column's dictionary
+COMPACT_TYPES = {
+  "date": pa.date32(), "str": pa.dictionary(pa.int32(), pa.string()), "bool": pa.int8(), "int": pa.int64(),
+  "float": pa.float64(),
+}
+
+# numpy unit each date_format truncates dates to in compact output
+DATE_UNITS = {"YYYY": "Y", "YYYY-MM": "M", "YYYY-MM-DD": "D"}
+
+
+def table_datasets(tables_dir):
+  """
+  the feather or parquet file for each table in `tables_dir`, as arrow datasets keyed by table name
+  """
+  datasets = {}
+  for path in sorted(Path(tables_dir).iterdir()):
+    if path.suffix == ".feather":
+      datasets[path.stem] = ds.dataset(path, format="feather")
+    elif path.suffix == ".parquet":
+      datasets[path.stem] = ds.dataset(path, format="parquet")
+  return datasets
+
+
+def load_tables(tables_dir, patient_ids=None, names=None):
+  """
+  reads every feather or parquet file in `tables_dir` into a dict of data frames, keyed by table name
+  with `patient_ids`, only the rows for those patients are read (and the rows
+  of linked tables, eg ecds_diagnoses, that belong to them)
+  with `names`, only those tables are read
+  """
+  datasets = {name: dataset for name, dataset in table_datasets(tables_dir).items() if names is None or name in names}
+  row_filter = None if patient_ids is None else ds.field("patient_id").isin(patient_ids)
+  tables = {
+    name: dataset.to_table(filter=row_filter).to_pandas()
+    for name, dataset in datasets.items()
+    if patient_ids is None or name not in LINKED_KEYS
+  }
+  for name, (parent, key) in LINKED_KEYS.items():
+    if name not in tables and name in datasets:
+      tables[name] = datasets[name].to_table(filter=ds.field(key).isin(tables[parent][key].to_numpy())).to_pandas()
+  for table in tables.values():
+    for column in table.columns:
+      if column == "date" or column.endswith("_date"):
+        table[column] = pd.to_datetime(table[column])
+  return tables
+
+
+def shift_dates(dates, quantity, units):
+  """
+  adds `quantity` days, months or years to a series of dates
+  """
+  if units == "day":
+    return dates + pd.Timedelta(days=quantity)
+  if units == "month":
+    return dates + pd.DateOffset(months=quantity)
+  if units == "year":
+    return dates + pd.DateOffset(years=quantity)
+  raise ValueError(f"unknown date units: {units}")
+
+
+def resolve_date(date_ref, frame):
+  """
+  evaluates a date reference against the columns extracted so far
+  returns None for an open limit, a Timestamp for a fixed date, or a series indexed by patient_id
+  """
+  if date_ref is None:
+    return None
+  column, offset = parse_date_ref(date_ref, frame.columns)
+  if column is None:
+    return pd.Timestamp(date_ref)
+  dates = frame[column].fillna(MISSING_DATE_LIMIT)
+  if offset is not None:
+    dates = shift_dates(dates, *offset)
+  return dates
+
+
+class AnchorTable:
+  """
+  the patients being extracted and the date limits relative to their anchor
+  dates (eg "covid_vax_any_1_date - 1 day"), each evaluated once per extraction
+  and kept as an array in patient order
+
+  scanned rows carry the `position` of their patient, so every variable that
+  uses a limit joins to it by position instead of re-evaluating it
+
+  scan groups running at the same time share one table, so adding an anchor
+  and evaluating a limit are done one thread at a time
+  """
+
+  def __init__(self, frame):
+    self.frame = frame
+    self.limits = {}
+    self.lock = threading.Lock()
+
+  def positions(self, patient_ids):
+    """
+    the position of each patient id among the patients being extracted, or -1 if it isn't one
+    """
+    return self.frame.index.get_indexer(patient_ids)
+
+  def rows_for_patients(self, rows):
+    """
+    the rows belonging to the patients being extracted, with their `position`
+    """
+    positions = self.positions(rows["patient_id"])
+    keep = positions >= 0
+    return rows[keep].assign(position=positions[keep])
+
+  def add(self, name, dates):
+    """
+    makes a date column available as an anchor before it's added to the cohort,
+    for variables dated relative to another variable in the same scan
+    """
+    with self.lock:
+      self.frame[name] = pd.to_datetime(dates.reindex(self.frame.index))
+
+  def limit(self, date_ref):
+    """
+    a date limit as None (open), a Timestamp (fixed date), or an array with one date per patient
+    """
+    if date_ref is None:
+      return None
+    key = date_ref.replace(" ", "")
+    with self.lock:
+      if key not in self.limits:
+        limit = resolve_date(date_ref, self.frame)
+        self.limits[key] = limit.to_numpy() if isinstance(limit, pd.Series) else limit
+      return self.limits[key]
+
+
+def in_period(rows, between, anchors, date_column="date"):
+  """
+  boolean mask of `rows` whose date falls within the (possibly patient-specific) period
+  a missing anchor date is treated as 1900-01-01, as in the TPP backend
+  """
+  lower, upper = between or (None, None)
+  mask = np.ones(len(rows), dtype=bool)
+  dates = rows[date_column].to_numpy()
+  for limit, compare in ((lower, np.greater_equal), (upper, np.less_equal)):
+    limit = anchors.limit(limit)
+    if limit is None:
+      continue
+    if isinstance(limit, np.ndarray):
+      limit = limit[rows["position"].to_numpy()]
+    else:
+      # a Timestamp would be compared with each date in python, rather than by numpy
+      limit = limit.to_datetime64()
+    mask &= compare(dates, limit)
+  return mask
+
+
+def codes_and_categories(codelist):
+  """
+  splits a codelist into a list of codes and a matching list of categories (or None)
+  """
+  if codelist.has_categories:
+    return [code for code, category in codelist], [category for code, category in codelist]
+  return list(codelist), [None] * len(codelist)
+
+
+def pick_row(rows, query_args):
+  """
+  the first or last row per patient, for returning a value rather than a flag
+  """
+  first = query_args.get("find_first_match_in_period")
+  rows = rows.sort_values(["patient_id", "date"], kind="stable")
+  return rows.drop_duplicates("patient_id", keep="first" if first else "last").set_index("patient_id")
+
+
+def summarise_events(rows, query_args):
+  """
+  reduces the matching rows for one variable to one value per patient
+  returns the values and the date of the match they were taken from
+  """
+  returning = query_args["returning"]
+  if returning in ("numeric_value", "category", "code", "discharge_destination"):
+    picked = pick_row(rows, query_args)
+    return picked[returning], picked["date"]
+  dates = rows.groupby("patient_id")["date"]
+  dates = dates.min() if query_args.get("find_first_match_in_period") else dates.max()
+  if returning == "binary_flag":
+    return pd.Series(1, index=dates.index), dates
+  if returning == "date":
+    return dates, dates
+  if returning == "number_of_matches_in_period":
+    return rows.groupby("patient_id").size(), dates
+  raise ValueError(f"unsupported `returning` value for local extraction: {returning}")
+
+
+def day_window(between, column_names):
+  """
+  a period as (anchor column, first day, last day) relative to a single column,
+  with None for an open end, or None if it isn't a whole number of days from one column
+  """
+  window = []
+  anchors = set()
+  for date_ref in between or (None, None):
+    column, offset = parse_date_ref(date_ref, column_names)
+    if date_ref is None:
+      window.append(None)
+    elif column is not None and (offset is None or offset[1] == "day"):
+      anchors.add(column)
+      window.append(offset[0] if offset else 0)
+    else:
+      return None
+  if len(anchors) != 1:
+    return None
+  return (anchors.pop(), *window)
+
+
+def window_families(variables, column_names):
+  """
+  groups flags and counts over the same codes in different day windows relative
+  to the same anchor (eg astrxm1, astrxm2 and astrxm3), which can all be counted
+  from one sort of their matching rows
+
+  returns {first variable of each family: (anchor column, {variable: (first day, last day)})}
+  """
+  families = OrderedDict()
+  for name, (query_type, query_args) in variables.items():
+    if query_type not in ("with_these_clinical_events", "with_these_medications"):
+      continue
+    if query_args["returning"] not in ("binary_flag", "number_of_matches_in_period"):
+      continue
+    if query_args.get("ignore_days_where_these_codes_occur") or query_args.get("ignore_missing_values"):
+      continue
+    window = day_window(query_args.get("between"), column_names)
+    if window is None:
+      continue
+    codes = tuple(codes_and_categories(query_args["codelist"])[0])
+    key = (window[0], codes, bool(query_args.get("find_first_match_in_period")))
+    families.setdefault(key, OrderedDict())[name] = window[1:]
+  return {
+    next(iter(windows)): (anchor, windows)
+    for (anchor, _, _), windows in families.items() if len(windows) > 1
+  }
+
+
+def count_in_windows(rows, anchor, windows, anchors, find_first):
+  """
+  counts the rows in several day windows relative to the same anchor date from one sort
+
+  the rows are sorted by patient and then by day relative to the patient's
+  anchor, so each patient's rows in a window are a contiguous run; the ends of
+  the run are found by binary search, and the count is the difference between
+  them (ie between the prefix sums at the two ends of the window)
+
+  returns {variable: (number of rows, first or last date)} for patients with any rows in each window
+  """
+  # as in the TPP backend, a missing anchor is read as 1900-01-01
+  anchor_dates = anchors.limit(anchor)[rows["position"].to_numpy()]
+  days = (rows["date"].to_numpy() - anchor_dates) // np.timedelta64(1, "D")
+  positions = rows["position"].to_numpy()
+  order = np.lexsort((days, positions))
+  # patient and day packed into one sortable key; days are well within +/- 2**30 of any anchor
+  keys = positions[order].astype("int64") * 2**32 + days[order]
+  dates = rows["date"].to_numpy()[order]
+  patients = np.unique(positions)
+  patient_ids = anchors.frame.index[patients]
+  base = patients.astype("int64") * 2**32
+
+  counted = {}
+  for name, (first, last) in windows.items():
+    start = np.searchsorted(keys, base + (-2**31 if first is None else first), side="left")
+    stop = np.searchsorted(keys, base + (2**31 - 1 if last is None else last), side="right")
+    present = stop > start
+    counts = pd.Series(stop - start, index=patient_ids)[present]
+    matched = dates[(start if find_first else stop - 1)[present]]
+    counted[name] = counts, pd.Series(matched, index=counts.index)
+  return counted
+
+
+def scan_coded_events(group, tables, anchors, profile=None):
+  """
+  extracts every variable in a clinical_events or medications scan group from one pass over the table
+
+  the codelists of all variables in the group are stacked into one lookup and
+  joined to the events once; each variable then only filters its own (much
+  smaller) set of matching rows by its date limits
+
+  flags and counts over the same codes in several day windows relative to one
+  anchor (eg astrxm1, astrxm2 and astrxm3) are joined once between them, and
+  counted together by count_in_windows
+
+  returns a dict of values and a dict of match dates, keyed by variable name
+  """
+  started = time.perf_counter()
+  families = window_families(group.variables, anchors.frame.columns)
+  # the other members of each family use the rows matched for the first
+  family_of = {
+    name: first for first, (_, windows) in families.items() for name in windows
+  }
+  lookup = []
+  for name, (query_type, query_args) in group.variables.items():
+    if family_of.get(name, name) != name:
+      continue
+    if query_type == "most_recent_bmi":
+      # recorded BMI values only: height and weight are not used to derive BMI locally
+      codes, categories = ["22K.."], [None]
+    else:
+      if query_args.get("ignore_days_where_these_codes_occur"):
+        raise ValueError(f"ignore_days_where_these_codes_occur is not supported locally ({name})")
+      codes, categories = codes_and_categories(query_args["codelist"])
+    lookup.append(pd.DataFrame({"code": codes, "category": categories, "variable": name}))
+
+  events = anchors.rows_for_patients(tables[group.table])
+  hits = events.merge(pd.concat(lookup, ignore_index=True), on="code")
+  hits = {name: rows for name, rows in hits.groupby("variable", sort=False)}
+  shared = time.perf_counter() - started
+
+  columns, dates = {}, {}
+  for first, (anchor, windows) in families.items():
+    started = time.perf_counter()
+    rows = hits.get(first, hits_template(events))
+    find_first = bool(group.variables[first][1].get("find_first_match_in_period"))
+    for name, (counts, matched_dates) in count_in_windows(rows, anchor, windows, anchors, find_first).items():
+      if group.variables[name][1]["returning"] == "binary_flag":
+        counts = pd.Series(1, index=counts.index)
+      columns[name], dates[name] = counts, matched_dates
+    if profile is not None:
+      seconds = (time.perf_counter() - started) / len(windows)
+      for name in windows:
+        profile.record(name, group.label, seconds, len(events), len(rows), len(columns[name]))
+
+  for name, (query_type, query_args) in group.variables.items():
+    if name in family_of:
+      continue
+    started = time.perf_counter()
+    rows = hits.get(name, hits_template(events))
+    matched = len(rows)
+    rows = rows[in_period(rows, query_args.get("between"), anchors)]
+    if query_type == "most_recent_bmi":
+      date_of_birth = tables["patients"].set_index("patient_id")["date_of_birth"]
+      age_at_measurement = (rows["date"] - date_of_birth.reindex(rows["patient_id"]).to_numpy()).dt.days / 365.25
+      rows = rows[age_at_measurement.to_numpy() >= query_args["minimum_age_at_measurement"]]
+      query_args = {"returning": "numeric_value", "find_last_match_in_period": True}
+    elif query_args.get("ignore_missing_values"):
+      rows = rows[rows["numeric_value"].fillna(0) != 0]
+    columns[name], dates[name] = summarise_events(rows, query_args)
+    if profile is not None:
+      profile.record(name, group.label, time.perf_counter() - started, len(events), matched, len(columns[name]))
+  if profile is not None:
+    profile.share(shared, {name: len(hits.get(family_of.get(name, name), ())) for name in group.variables})
+  return columns, dates
+
+
+def hits_template(events):
+  """
+  an empty set of matching rows, for variables whose codes never occur
+  """
+  return events.head(0).assign(category=None, variable=None)
+
+
+def scan_emergency_care(group, tables, anchors, profile=None):
+  """
+  extracts every attended_emergency_care variable in a scan group from one pass over the attendances
+
+  as with coded events, the diagnosis codelists of all variables in the group
+  (eg the emergency_<group>_date variable for each group in diagnosis_groups.json)
+  are stacked into one lookup and joined to the attendances' diagnoses once,
+  rather than scanning the attendances once per diagnosis group
+
+  returns a dict of values and a dict of match dates, keyed by variable name
+  """
+  started = time.perf_counter()
+  attendances = anchors.rows_for_patients(tables["ecds"]).sort_values("attendance_id")
+  lookup = [
+    pd.DataFrame({"code": list(query_args["with_these_diagnoses"]), "variable": name})
+    for name, (query_type, query_args) in group.variables.items()
+    if query_args.get("with_these_diagnoses")
+  ]
+  hits = {}
+  if lookup:
+    diagnoses = tables["ecds_diagnoses"]
+    diagnoses = diagnoses[diagnoses["attendance_id"].isin(attendances["attendance_id"])]
+    # an attendance matches a variable once, however many of its diagnoses are in the codelist
+    matched = diagnoses.merge(pd.concat(lookup, ignore_index=True), on="code")
+    matched = matched[["attendance_id", "variable"]].drop_duplicates()
+    matched = attendances.merge(matched, on="attendance_id")
+    hits = {name: rows for name, rows in matched.groupby("variable", sort=False)}
+  shared = time.perf_counter() - started
+
+  columns, dates = {}, {}
+  for name, (query_type, query_args) in group.variables.items():
+    started = time.perf_counter()
+    rows = hits.get(name, attendances.head(0)) if query_args.get("with_these_diagnoses") else attendances
+    matched = len(rows)
+    rows = rows[in_period(rows, query_args.get("between"), anchors)]
+    if query_args.get("discharged_to"):
+      rows = rows[rows["discharge_destination"].isin(query_args["discharged_to"])]
+    if query_args["returning"] == "date_arrived":
+      query_args = dict(query_args, returning="date")
+    columns[name], dates[name] = summarise_events(rows, query_args)
+    if profile is not None:
+      profile.record(name, group.label, time.perf_counter() - started, len(attendances), matched, len(columns[name]))
+  if profile is not None:
+    profile.share(shared, {name: len(hits.get(name, ())) for name in group.variables})
+  return columns, dates
+
+
+def vaccine_key(query_args):
+  """
+  the target diseases and product names a vaccination variable matches
+  """
+  return tuple(
+    tuple([values] if isinstance(values, str) else values or ())
+    for values in (query_args.get("target_disease_matches"), query_args.get("product_name_matches"))
+  )
+
+
+def scan_vaccinations(group, tables, anchors, profile=None):
+  """
+  extracts every with_tpp_vaccination_record variable in a scan group from one pass over the vaccinations
+
+  the vaccinations for each product or target disease are picked out once,
+  however many variables use them; doses dated relative to an earlier dose in
+  the group (eg covid_vax_pfizer_2_date, on or after covid_vax_pfizer_1_date + 1 days)
+  follow that dose in the group, so each is worked out from the doses before it
+  and a whole vaccination history is read in one pass
+
+  returns a dict of values and a dict of match dates, keyed by variable name
+  """
+  started = time.perf_counter()
+  vaccinations = anchors.rows_for_patients(tables["vaccinations"])
+  matches = {}
+  for name, (query_type, query_args) in group.variables.items():
+    key = vaccine_key(query_args)
+    if key not in matches:
+      target_diseases, product_names = key
+      mask = np.ones(len(vaccinations), dtype=bool)
+      if target_diseases:
+        mask &= vaccinations["target_disease"].isin(target_diseases).to_numpy()
+      if product_names:
+        mask &= vaccinations["product_name"].isin(product_names).to_numpy()
+      matches[key] = vaccinations[mask]
+  # doses that later doses in the group are dated relative to
+  anchored = {
+    anchor for _, query_args in group.variables.values()
+    for anchor in anchor_columns(query_args, group.variables)
+  }
+  shared = time.perf_counter() - started
+
+  columns, dates = {}, {}
+  for name, (query_type, query_args) in group.variables.items():
+    started = time.perf_counter()
+    rows = matches[vaccine_key(query_args)]
+    matched = len(rows)
+    rows = rows[in_period(rows, query_args.get("between"), anchors)]
+    columns[name], dates[name] = summarise_events(rows, query_args)
+    if name in anchored:
+      anchors.add(name, columns[name])
+    if profile is not None:
+      profile.record(name, group.label, time.perf_counter() - started, len(vaccinations), matched, len(columns[name]))
+  if profile is not None:
+    profile.share(shared, {name: len(matches[vaccine_key(query_args)]) for name, (_, query_args) in group.variables.items()})
+  return columns, dates
+
+
+def patient_runs(positions):
+  """
+  the start and end (exclusive) of each patient's run of rows, for rows sorted by patient
+  """
+  starts = np.flatnonzero(np.diff(positions, prepend=-1))
+  stops = np.append(starts[1:], len(positions)) if len(starts) else starts
+  return starts, stops
+
+
+def scan_sgss_tests(group, tables, anchors, profile=None):
+  """
+  extracts every with_test_result_in_sgss variable from one pass over the tests
+
+  the planner puts all of a study's SGSS variables in one scan group, so each
+  patient's tests are read and sorted by date once; every variable then picks
+  from that sequence the tests with its result within its dates (only the
+  earliest specimen of each episode, unless restrict_to_earliest_specimen_date
+  is False) and takes the first or last date, a flag or a count, without sorting again
+
+  returns a dict of values and a dict of match dates, keyed by variable name
+  """
+  started = time.perf_counter()
+  rows = anchors.rows_for_patients(tables["sgss_tests"])
+  order = np.lexsort((rows["date"].to_numpy(), rows["position"].to_numpy()))
+  tests = pd.DataFrame({"position": rows["position"].to_numpy()[order], "date": rows["date"].to_numpy()[order]})
+  positions = tests["position"].to_numpy()
+  test_dates = tests["date"].to_numpy()
+  results = {result: rows["result"].eq(result).to_numpy(dtype=bool)[order] for result in ("positive", "negative")}
+  earliest = (rows["earliest"].to_numpy() == 1)[order]
+  shared = time.perf_counter() - started
+
+  columns, dates = {}, {}
+  for name, (query_type, query_args) in group.variables.items():
+    started = time.perf_counter()
+    returning, test_result = query_args["returning"], query_args["test_result"]
+    restrict = query_args.get("restrict_to_earliest_specimen_date", True)
+    if query_args.get("pathogen") != "SARS-CoV-2":
+      raise ValueError(f"Unsupported pathogen: {query_args.get('pathogen')}")
+    if test_result not in ("positive", "negative", "any"):
+      raise ValueError(f"Unsupported test_result '{test_result}'")
+    if returning == "number_of_matches_in_period" and restrict is not False:
+      raise ValueError("returning='number_of_matches_in_period' needs restrict_to_earliest_specimen_date=False")
+    if returning not in ("binary_flag", "date", "number_of_matches_in_period"):
+      raise ValueError(f"with_test_result_in_sgss returning {returning} is not supported locally")
+
+    mask = in_period(tests, query_args.get("between"), anchors)
+    if test_result != "any":
+      mask &= results[test_result]
+    if restrict:
+      mask &= earliest
+    matched = np.flatnonzero(mask)
+    # still in date order within each patient, so a patient's first and last
+    # tests are the ends of their run
+    starts, stops = patient_runs(positions[matched])
+    patient_ids = anchors.frame.index[positions[matched[starts]]]
+    if returning == "number_of_matches_in_period":
+      columns[name] = pd.Series(stops - starts, index=patient_ids)
+      dates[name] = pd.Series(pd.NaT, index=patient_ids, dtype="datetime64[ns]")
+    else:
+      picked = matched[starts] if query_args.get("find_first_match_in_period") else matched[stops - 1]
+      dates[name] = pd.Series(test_dates[picked], index=patient_ids)
+      columns[name] = dates[name] if returning == "date" else pd.Series(1, index=patient_ids)
+    if profile is not None:
+      profile.record(name, group.label, time.perf_counter() - started, len(tests), len(matched), len(columns[name]))
+  if profile is not None:
+    profile.share(shared, dict.fromkeys(group.variables, 0))
+  return columns, dates
+
+
+def code_pattern(codes, prefix):
+  """
+  a regular expression matching any of `codes` (or codes they prefix) after `prefix`,
+  as cohortextractor's LIKE patterns do
+  """
+  return prefix + "(?:" + "|".join(re.escape(code) for code in codes) + ")"
+
+
+def spell_conditions(query_args):
+  """
+  the conditions on an admitted_to_hospital variable's spells other than their dates,
+  each as a key which is the same for every variable with that condition
+  """
+  conditions = []
+  for key, value in query_args.items():
+    if not key.startswith("with_") or not value:
+      continue
+    if key == "with_at_least_one_day_in_critical_care":
+      conditions.append(("critical_care",))
+    elif key in APCS_CODE_COLUMNS:
+      column, prefix = APCS_CODE_COLUMNS[key]
+      conditions.append((column, code_pattern(codelist_codes(value), prefix)))
+    elif key[5:] in APCS_COLUMNS:
+      values = [value] if isinstance(value, str) else value
+      conditions.append((key[5:], tuple(str(value) for value in values)))
+    else:
+      raise ValueError(f"admitted_to_hospital {key} is not supported locally")
+  return conditions
+
+
+def spell_mask(spells, condition):
+  """
+  boolean mask of the spells meeting one condition from spell_conditions
+  """
+  if condition == ("critical_care",):
+    return pd.to_numeric(spells["days_in_critical_care"], errors="coerce").gt(0).to_numpy()
+  column, values = condition
+  if isinstance(values, tuple):
+    return spells[column].isin(values).to_numpy()
+  return spells[column].str.contains(values, regex=True, na=False).to_numpy(dtype=bool)
+
+
+def summarise_spells(spells, matched, query_args, anchors):
+  """
+  reduces the matching spells (positions in `spells`, which are sorted by patient,
+  admission date and apcs_ident) to one value per patient, as the TPP backend does
+  returns the values and the admission date they were taken from
+  """
+  returning, first = query_args["returning"], query_args.get("find_first_match_in_period")
+  positions = spells["position"].to_numpy()[matched]
+  admitted = spells["admission_date"].to_numpy()[matched]
+  starts, stops = patient_runs(positions)
+  patient_ids = anchors.frame.index[positions[starts]]
+
+  if returning in ("total_bed_days_in_period", "total_critical_care_days_in_period"):
+    if first or query_args.get("find_last_match_in_period"):
+      raise ValueError(f"Cannot use 'find_first_match_in_period' or 'find_last_match_in_period' when returning '{returning}'")
+    if returning == "total_bed_days_in_period":
+      # a stay is counted in nights, so a spell discharged on the day of admission is one bed day
+      days = (spells["discharge_date"] - spells["admission_date"]).dt.days + 1
+    else:
+      days = pd.to_numeric(spells["days_in_critical_care"], errors="coerce")
+    # spells admitted on the same day are duplicates, counted once with the longest stay
+    days = pd.Series(days.to_numpy()[matched]).groupby([positions, admitted], dropna=False).max()
+    totals = days.groupby(level=0).sum(min_count=1)
+    return pd.Series(totals.to_numpy(), index=patient_ids), pd.Series(pd.NaT, index=patient_ids, dtype="datetime64[ns]")
+
+  # still in date order within each patient, so a patient's first and last
+  # admissions are the ends of their run
+  dates = pd.Series(admitted[starts] if first else admitted[stops - 1], index=patient_ids)
+  if returning == "binary_flag":
+    return pd.Series(1, index=patient_ids), dates
+  if returning == "date_admitted":
+    return dates, dates
+  if returning == "number_of_matches_in_period":
+    return pd.Series(stops - starts, index=patient_ids), dates
+  if returning == "date_discharged":
+    discharged = pd.Series(spells["discharge_date"].to_numpy()[matched]).groupby(positions)
+    discharged = discharged.min() if first else discharged.max()
+    return pd.Series(discharged.to_numpy(), index=patient_ids), dates
+  if returning not in APCS_COLUMNS:
+    raise ValueError(f"admitted_to_hospital returning {returning} is not supported locally")
+  if first:
+    picked = starts
+  else:
+    # ties on the last admission date go to the lowest apcs_ident, as they do on the first
+    same_day = (np.diff(positions) == 0) & (np.diff(admitted) == np.timedelta64(0))
+    day_starts = np.flatnonzero(np.append(True, ~same_day))
+    picked = day_starts[np.searchsorted(day_starts, stops) - 1]
+  return pd.Series(spells[returning].to_numpy()[matched[picked]], index=patient_ids), dates
+
+
+def most_frequent_ethnicity(spells, query_args):
+  """
+  each patient's most frequent ethnicity code on their spells (or its 6 or 16 category group)
+  ties between equally frequent codes are broken by the code, where TPP's order is arbitrary
+  """
+  returning = query_args.get("returning", "code")
+  if not query_args.get("use_most_frequent_code"):
+    raise ValueError("use_most_frequent_code must be set to 'True'")
+  if returning not in ("code", "group_6", "group_16"):
+    raise ValueError(f"Unknown value for 'returning' ({returning})")
+  codes = spells.loc[spells["ethnicity"].notna(), ["patient_id", "ethnicity"]]
+  codes = codes[codes["ethnicity"].ne("99") & ~codes["ethnicity"].str.startswith("Z")]
+  counts = codes.groupby(["patient_id", "ethnicity"]).size().rename("count").reset_index()
+  counts = counts.sort_values(["patient_id", "count", "ethnicity"], ascending=[True, False, True])
+  values = counts.drop_duplicates("patient_id").set_index("patient_id")["ethnicity"]
+  if returning != "code":
+    values = values.str[0].map(ETHNICITY_GROUPS[returning]).fillna("0")
+  return values, pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+
+
+def scan_admissions(group, tables, anchors, profile=None):
+  """
+  extracts every admitted_to_hospital and with_ethnicity_from_sus variable from one pass over the spells
+
+  the planner puts all of a study's APCS variables in one scan group, so each
+  patient's spells, before and after vaccination, are read and sorted by admission
+  date once, and each condition on them (a list of admission methods, a diagnosis
+  codelist, at least one day in critical care) is matched once, however many
+  variables share it (eg covidadmitted_date, covidadmitted_ccdays and admitted_date);
+  every variable then combines those with its dates and takes the first or last
+  spell, a flag, a count or a total, without sorting again
+
+  returns a dict of values and a dict of match dates, keyed by variable name
+  """
+  started = time.perf_counter()
+  rows = anchors.rows_for_patients(tables["apcs"])
+  order = np.lexsort((rows["apcs_ident"].to_numpy(), rows["admission_date"].to_numpy(), rows["position"].to_numpy()))
+  spells = rows.iloc[order].reset_index(drop=True)
+  conditions = {
+    name: spell_conditions(query_args)
+    for name, (query_type, query_args) in group.variables.items()
+    if query_type == "admitted_to_hospital"
+  }
+  masks = {}
+  for condition in (condition for variable in conditions.values() for condition in variable):
+    if condition not in masks:
+      masks[condition] = spell_mask(spells, condition)
+  shared = time.perf_counter() - started
+
+  columns, dates = {}, {}
+  for name, (query_type, query_args) in group.variables.items():
+    started = time.perf_counter()
+    matched = None
+    if query_type == "with_ethnicity_from_sus":
+      columns[name], dates[name] = most_frequent_ethnicity(spells, query_args)
+    else:
+      mask = in_period(spells, query_args.get("between"), anchors, date_column="admission_date")
+      for condition in conditions[name]:
+        mask &= masks[condition]
+      matched = np.flatnonzero(mask)
+      columns[name], dates[name] = summarise_spells(spells, matched, query_args, anchors)
+      matched = len(matched)
+    if profile is not None:
+      profile.record(name, group.label, time.perf_counter() - started, len(spells), matched, len(columns[name]))
+  if profile is not None:
+    profile.share(shared, dict.fromkeys(group.variables, 0))
+  return columns, dates
+
+
+def scan_healthcare_workers(group, tables, anchors, profile=None):
+  """
+  extracts the healthcare worker flag recorded on patients' covid vaccine records
+  """
+  started = time.perf_counter()
+  workers = anchors.rows_for_patients(tables["healthcare_workers"])
+  flagged = pd.Index(workers.loc[workers["healthcare_worker"] == "Y", "patient_id"].unique(), name="patient_id")
+  columns, dates = {}, {}
+  for name in group.variables:
+    columns[name] = pd.Series(1, index=flagged)
+    dates[name] = pd.Series(pd.NaT, index=flagged)
+  if profile is not None:
+    for name in group.variables:
+      profile.record(name, group.label, 0.0, len(workers), len(flagged), len(flagged))
+    profile.share(time.perf_counter() - started, dict.fromkeys(group.variables, 0))
+  return columns, dates
+
+
+def date_integers(dates):
+  """
+  dates (or a date) as microseconds, so they're compared and sorted as integers
+  """
+  return np.asarray(dates, dtype="datetime64[us]").view("int64")
+
+
+def sort_periods(rows):
+  """
+  the order of registrations or addresses that puts each patient's rows in the
+  TPP backend's order of preference: the latest start, then the latest end (a
+  current period, with no end, is the latest), then for addresses one with a
+  postcode, then the lowest id
+
+  returns that order and the start and end dates, in that order, as integers;
+  a missing start is later than any date, so that period is never current
+  """
+  starts = np.where(rows["start_date"].isna().to_numpy(), np.iinfo(np.int64).max, date_integers(rows["start_date"]))
+  ends = np.where(rows["end_date"].isna().to_numpy(), np.iinfo(np.int64).max, date_integers(rows["end_date"]))
+  if "address_id" in rows:
+    keys = (rows["address_id"].to_numpy(), rows["msoa"].eq("NPC").to_numpy(dtype=bool), -ends, -starts, rows["position"].to_numpy())
+  else:
+    keys = (rows["registration_id"].to_numpy(), -ends, -starts, rows["position"].to_numpy())
+  order = np.lexsort(keys)
+  return order, starts[order], ends[order]
+
+
+def current_periods(positions, starts, ends, limit):
+  """
+  the periods (positions in the order from sort_periods) that are current on the
+  date `limit` (a Timestamp, or one date per patient): for each patient, the
+  first of their periods which started on or before the date and ends after it
+  """
+  dates = date_integers(limit[positions] if isinstance(limit, np.ndarray) else limit.to_datetime64())
+  current = np.flatnonzero((starts <= dates) & (ends > dates))
+  first, _ = patient_runs(positions[current])
+  return current[first]
+
+
+def snapshot_values(periods, current, query_type, query_args):
+  """
+  a registered_practice_as_of, address_as_of or care_home_status_as_of variable's
+  values, read from the `current` rows of periods on its date
+  """
+  returning = query_args.get("returning")
+  if query_type == "registered_practice_as_of":
+    if returning not in PRACTICE_COLUMNS:
+      raise ValueError(f"Unsupported `returning` value: {returning}")
+    return periods[PRACTICE_COLUMNS[returning]].iloc[current].to_numpy()
+  if query_type == "address_as_of":
+    if returning not in ADDRESS_COLUMNS:
+      raise ValueError(f"Unsupported `returning` value: {returning}")
+    if returning == "index_of_multiple_deprivation" and query_args.get("round_to_nearest") != 100:
+      raise ValueError("index_of_multiple_deprivation is only available rounded to the nearest 100")
+    return periods[ADDRESS_COLUMNS[returning]].iloc[current].to_numpy()
+  current = periods.iloc[current]
+  columns = pd.DataFrame({
+    "IsPotentialCareHome": current["care_home"].fillna(0).astype("int64").to_numpy(),
+    "LocationRequiresNursing": current["requires_nursing"].to_numpy(),
+    "LocationDoesNotRequireNursing": current["does_not_require_nursing"].to_numpy(),
+  })
+  column_types = {"IsPotentialCareHome": "int", "LocationRequiresNursing": "str", "LocationDoesNotRequireNursing": "str"}
+  return evaluate_categories(query_args["categorised_as"], columns, column_types).to_numpy()
+
+
+def scan_periods(group, tables, anchors, profile=None):
+  """
+  extracts the registered_practice_as_of, address_as_of and care_home_status_as_of
+  variables in a scan group by finding each patient's current registration or
+  address once per date, rather than once per variable
+
+  the periods are sorted once in the TPP backend's order of preference, so each
+  date (eg covid_vax_any_1_date - 1 days, for practice_id, stp and region) is one
+  pass over them, and every variable on that date reads its column from the same
+  rows; the table's other variables are extracted with DuckDB
+
+  returns a dict of values and a dict of match dates, keyed by variable name
+  """
+  snapshots = OrderedDict((name, definition) for name, definition in group.variables.items() if definition[0] in SNAPSHOT_TYPES)
+  others = OrderedDict((name, definition) for name, definition in group.variables.items() if name not in snapshots)
+  columns, dates = {}, {}
+  if others:
+    columns, dates = scan_with_duckdb(ScanGroup(group.table, group.anchor, others), tables, anchors, profile)
+  if not snapshots:
+    return columns, dates
+
+  started = time.perf_counter()
+  periods = anchors.rows_for_patients(tables[group.table])
+  order, starts, ends = sort_periods(periods)
+  positions = periods["position"].to_numpy()
+  # the rows current on each date the variables are taken on, as row numbers in `periods`
+  current = {}
+  for query_type, query_args in snapshots.values():
+    if query_args["date"] not in current:
+      limit = anchors.limit(query_args["date"])
+      current[query_args["date"]] = order[current_periods(positions[order], starts, ends, limit)]
+  shared = time.perf_counter() - started
+
+  for name, (query_type, query_args) in snapshots.items():
+    started = time.perf_counter()
+    rows = current[query_args["date"]]
+    patient_ids = anchors.frame.index[positions[rows]]
+    columns[name] = pd.Series(snapshot_values(periods, rows, query_type, query_args), index=patient_ids)
+    dates[name] = pd.Series(pd.NaT, index=patient_ids, dtype="datetime64[ns]")
+    if profile is not None:
+      profile.record(name, group.label, time.perf_counter() - started, len(periods), len(rows), len(columns[name]))
+  if profile is not None:
+    profile.share(shared, dict.fromkeys(snapshots, 0))
+  return columns, dates
+
+
+# table scanners implemented for local extraction
+SCANNERS = {
+  "clinical_events": scan_coded_events,
+  "medications": scan_coded_events,
+  "ecds": scan_emergency_care,
+  "vaccinations": scan_vaccinations,
+  "sgss_tests": scan_sgss_tests,
+  "apcs": scan_admissions,
+  "healthcare_workers": scan_healthcare_workers,
+  **dict.fromkeys(DUCKDB_TABLES, scan_with_duckdb),
+  # their snapshot variables are resolved here, and the rest handed on to DuckDB
+  "registrations": scan_periods,
+  "addresses": scan_periods,
+}
+
+
+def run_scan_group(group, tables, anchors, cache=None, profile=None):
+  """
+  extracts a scan group, reusing any cached columns and scanning the table
+  once for the variables that are new or have changed
+  """
+  columns, dates = {}, {}
+  if cache is not None:
+    for name in group.variables:
+      cached = cache.get(name)
+      if cached is not None:
+        columns[name], dates[name] = cached
+        if group.variables[name][1]["column_type"] == "date":
+          # a later variable in the group may be dated relative to this one
+          anchors.add(name, columns[name])
+        if profile is not None:
+          profile.record(name, "cache", 0.0, 0, 0, len(cached[0]))
+
+  stale = OrderedDict(
+    (name, definition) for name, definition in group.variables.items() if name not in columns
+  )
+  if stale:
+    if group.table not in SCANNERS:
+      raise ValueError(f"no local scanner for the {group.table} table")
+    new_columns, new_dates = SCANNERS[group.table](
+      ScanGroup(group.table, group.anchor, stale), tables, anchors, profile
+    )
+    for name in stale:
+      columns[name], dates[name] = new_columns[name], new_dates[name]
+      if cache is not None:
+        cache.put(name, new_columns[name], new_dates[name])
+  return columns, dates
+
+
+def fill_missing(values, column_type):
+  """
+  replaces missing values with the default for the column type, as the TPP backend does
+  """
+  if column_type == "date":
+    return pd.to_datetime(values)
+  values = values.fillna(DEFAULT_VALUES[column_type])
+  if column_type in ("bool", "int"):
+    return values.astype("int64")
+  if column_type == "str":
+    return values.astype(object)
+  return values
+
+
+def derive_column(step, frame, match_dates, column_types):
+  """
+  computes a variable from columns which have already been extracted
+  """
+  query_args = step.query_args
+  if step.query_type == "aggregate_of":
+    columns = frame[list(query_args["column_names"])]
+    if query_args["aggregate_function"] == "MIN":
+      return columns.min(axis=1)
+    return columns.max(axis=1)
+  if step.query_type == "value_from":
+    if query_args["returning"] == "date":
+      return match_dates[query_args["source"]]
+    return frame[query_args["source"]]
+  if step.query_type == "fixed_value":
+    return pd.Series(query_args["value"], index=frame.index)
+  if step.query_type == "categorised_as":
+    return evaluate_categories(query_args["category_definitions"], frame, column_types)
+  raise ValueError(f"variable type not supported locally: {step.query_type}")
+
+
+def run_steps(levels, frame, anchors, match_dates, tables, column_types, cache, profile, workers=1):
+  """
+  runs planned steps level by level (see plan_levels), adding each variable to `frame` as a column
+
+  the scan groups in a level are independent of each other, so they run on up to
+  `workers` threads at once (numpy, pyarrow and DuckDB release the GIL while they
+  scan); their columns are added once the whole level is done, then the level's
+  derived variables are computed from them
+  """
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for steps in levels:
+      scans = [step for step in steps if isinstance(step, ScanGroup)]
+      results = pool.map(lambda group: run_scan_group(group, tables, anchors, cache, profile), scans)
+      for columns, dates in list(results):
+        for name, values in columns.items():
+          frame[name] = fill_missing(values.reindex(frame.index), column_types[name])
+          match_dates[name] = dates[name].reindex(frame.index)
+
+      for step in steps:
+        if isinstance(step, ScanGroup):
+          continue
+        started = time.perf_counter()
+        frame[step.name] = derive_column(step, frame, match_dates, column_types)
+        if profile is not None:
+          returned = frame[step.name].notna() & (frame[step.name] != DEFAULT_VALUES[column_types[step.name]])
+          profile.record(step.name, step.query_type, time.perf_counter() - started, len(frame), None, returned.sum())
+
+
+def extract_population(definitions, tables, column_types, cache=None, profile=None, workers=1):
+  """
+  extracts the population and the variables it depends on for every patient in `tables`,
+  returning them as a frame indexed by patient_id, and their match dates
+  """
+  frame = pd.DataFrame(index=pd.Index(tables["patients"]["patient_id"], name="patient_id"))
+  match_dates = {}
+  population = population_variables(definitions)
+  run_steps(
+    plan_levels({name: definitions[name] for name in population}),
+    frame, AnchorTable(frame), match_dates, tables, column_types, cache, profile, workers,
+  )
+  return frame, match_dates
+
+
+def extract_remaining(definitions, frame, match_dates, tables, column_types, cache=None, profile=None, workers=1):
+  """
+  extracts every variable outside the population's dependencies for the patients
+  in `frame`, adding each one to it as a column
+  """
+  run_steps(
+    plan_remaining(definitions),
+    frame, AnchorTable(frame), match_dates, tables, column_types, cache, profile, workers,
+  )
+
+
+def extract(study, tables, cache=None, profile=None, columns=None, workers=1, compact=False):
+  """
+  runs a study definition against local tables, returning one row per patient
+  in the population with the same columns as the cohortextractor output
+
+  the population and the variables it depends on are extracted for every
+  patient first; everything else is then only extracted for the population
+
+  `cache` is an optional ColumnCache; cached columns are joined onto the
+  cohort by patient_id instead of being extracted again
+  `profile` is an optional ExtractionProfile, which records the time and rows for each variable
+  `columns` optionally limits the output to those columns (names or glob patterns),
+  so only they, the population and the variables they depend on are extracted
+  `workers` is the number of independent scan groups run at once
+  with `compact`, dates are left as datetimes, for compact_table
+  """
+  definitions = study.covariate_definitions
+  outputs = output_columns(definitions, columns)
+  if columns is not None:
+    definitions = project_definitions(definitions, columns)
+  column_types = {name: query_args["column_type"] for name, (_, query_args) in definitions.items()}
+  frame, match_dates = extract_population(definitions, tables, column_types, cache, profile, workers)
+  in_population = frame["population"].astype(bool)
+  frame = frame[in_population].copy()
+  match_dates = {name: dates[in_population] for name, dates in match_dates.items()}
+  extract_remaining(definitions, frame, match_dates, tables, column_types, cache, profile, workers)
+  if compact:
+    return frame[outputs].reset_index()
+  return format_output(frame[outputs], definitions)
+
+
+def output_columns(definitions, columns=None):
+  """
+  the variables written to the output, in study definition order
+  with `columns`, only the variables which match them
+  """
+  names = [
+    name for name, (_, query_args) in definitions.items()
+    if not query_args.get("hidden") and name != "population"
+  ]
+  if columns is not None:
+    selected = set(select_columns(definitions, columns))
+    names = [name for name in names if name in selected]
+  return names
+
+
+def date_format(definitions, name):
+  """
+  the precision a date variable is written at, as in cohortextractor: its `date_format`,
+  or for an aggregate_of without one, that of its first column, and otherwise just the year
+  """
+  query_type, query_args = definitions[name]
+  if query_args.get("date_format"):
+    return query_args["date_format"]
+  if query_type == "aggregate_of":
+    return date_format(definitions, query_args["column_names"][0])
+  return "YYYY"
+
+
+def format_output(frame, definitions):
+  """
+  converts dates to strings at the precision given by each variable's `date_format`
+  """
+  frame = frame.copy()
+  formats = {"YYYY": "%Y", "YYYY-MM": "%Y-%m", "YYYY-MM-DD": "%Y-%m-%d"}
+  for name in frame.columns:
+    if definitions[name][1]["column_type"] == "date":
+      frame[name] = frame[name].dt.strftime(formats[date_format(definitions, name)])
+  return frame.reset_index()
+
+
+def output_schema(definitions, columns=None, compact=False):
+  """
+  the arrow schema of the extracted cohort
+  with `compact`, in compact types, with each column's type and date_format as metadata
+  """
+  types = COMPACT_TYPES if compact else ARROW_TYPES
+  names = output_columns(definitions, columns)
+  schema = pa.schema(
+    [pa.field("patient_id", pa.int64())]
+    + [pa.field(name, types[definitions[name][1]["column_type"]]) for name in names]
+  )
+  if compact:
+    metadata = {name: {"column_type": definitions[name][1]["column_type"]} for name in names}
+    for name in names:
+      if definitions[name][1]["column_type"] == "date":
+        metadata[name]["date_format"] = date_format(definitions, name)
+    schema = schema.with_metadata({COMPACT_METADATA: json.dumps(metadata)})
+  return schema
+
+
+def dictionary_encode(values, dictionary):
+  """
+  text values as a dictionary array, indexing `dictionary` (each value seen so far -> its position)
+  after adding any new values to its end
+
+  batches encoded with the same `dictionary` only ever add to it, so a feather
+  writer can write each new batch's dictionary as a delta on the last one
+  """
+  for value in pd.unique(values.dropna()):
+    dictionary.setdefault(value, len(dictionary))
+  indices = pd.array(values.map(dictionary), dtype="Int32")
+  return pa.DictionaryArray.from_arrays(pa.array(indices), pa.array(list(dictionary), type=pa.string()))
+
+
+def compact_table(cohort, definitions, schema, dictionaries):
+  """
+  an extracted cohort (from extract with `compact`) as an arrow table with the compact `schema`,
+  with each date truncated to its variable's date_format (eg to the first of the month for YYYY-MM)
+
+  `dictionaries` holds each text column's dictionary, shared by every batch of the same output
+  """
+  arrays = []
+  for field in schema:
+    values = cohort[field.name]
+    if pa.types.is_dictionary(field.type):
+      arrays.append(dictionary_encode(values, dictionaries.setdefault(field.name, {})))
+    elif pa.types.is_date(field.type):
+      unit = DATE_UNITS[date_format(definitions, field.name)]
+      days = values.to_numpy(dtype="datetime64[ns]").astype(f"datetime64[{unit}]").astype("datetime64[D]")
+      arrays.append(pa.array(days, type=field.type, from_pandas=True))
+    else:
+      arrays.append(pa.array(values, type=field.type, from_pandas=True))
+  return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def patient_batches(tables_dir, batch_size):
+  """
+  the ids in the patients table, `batch_size` at a time
+  """
+  patient_ids = table_datasets(tables_dir)["patients"].to_table(columns=["patient_id"])["patient_id"]
+  for start in range(0, len(patient_ids), batch_size):
+    yield patient_ids.slice(start, batch_size)
+
+
+def write_cohort(table, output_file):
+  """
+  writes an arrow table of the cohort to `output_file`, as parquet for a .parquet file and feather otherwise
+  """
+  if Path(output_file).suffix == ".parquet":
+    pq.write_table(table, output_file, compression="zstd")
+  else:
+    feather.write_feather(table, output_file)
+
+
+def open_writer(path, schema, file_format):
+  """
+  a writer that appends tables to a single parquet file (one row group per batch)
+  or feather file (one record batch per batch)
+
+  a feather file holds one dictionary per column, so a dictionary that grows from one
+  batch to the next (see dictionary_encode) is written as deltas on the first
+  """
+  if file_format == ".parquet":
+    return pq.ParquetWriter(path, schema, compression="zstd")
+  return pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression="zstd", emit_dictionary_deltas=True))
+
+
+def extract_in_batches(
+  study, tables_dir, output_file, batch_size, cache_dir=None, profile=None, columns=None, workers=1, cache_max_bytes=None,
+  compact=False,
+):
+  """
+  extracts `batch_size` patients at a time, reading only their rows from each
+  table and appending each batch's cohort to `output_file` before starting the next
+
+  with `cache_dir`, columns are cached per batch, so an unchanged batch size
+  reuses the same cached columns on the next run
+  with `compact`, the cohort is written in compact types (see compact_table)
+  returns the number of patients written and the cache of each batch
+  """
+  definitions = study.covariate_definitions
+  schema = output_schema(definitions, columns, compact)
+  tables = source_tables(definitions if columns is None else project_definitions(definitions, columns))
+  snapshot = tables_snapshot(tables_dir) if cache_dir else ""
+  caches = []
+  dictionaries = {}
+  rows = 0
+  # write to a temporary file first (removed if the run fails), so an interrupted run never leaves a partial cohort behind
+  partial = Path(output_file).with_name(Path(output_file).name + ".partial")
+  try:
+    with open_writer(partial, schema, Path(output_file).suffix) as writer:
+      for number, patient_ids in enumerate(patient_batches(tables_dir, batch_size)):
+        cache = None
+        if cache_dir:
+          cache = ColumnCache(cache_dir, definitions, f"{snapshot}:{batch_size}:{number}", cache_max_bytes)
+          caches.append(cache)
+        cohort = extract(study, load_tables(tables_dir, patient_ids, tables), cache, profile, columns, workers, compact)
+        if compact:
+          writer.write_table(compact_table(cohort, definitions, schema, dictionaries))
+        else:
+          writer.write_table(pa.Table.from_pandas(cohort, schema=schema, preserve_index=False))
+        rows += len(cohort)
+  except BaseException:
+    partial.unlink(missing_ok=True)
+    raise
+  partial.replace(output_file)
+  return rows, caches
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="run a study definition against local, TPP-shaped tables")
+  parser.add_argument("study_definition")
+  parser.add_argument("tables_dir")
+  parser.add_argument("output_file")
+  parser.add_argument("--cache-dir", help="directory of per-variable cached columns")
+  parser.add_argument("--cache-size-mb", type=float, help="size the cache is kept within, evicting the least recently used columns")
+  parser.add_argument("--batch-size", type=int, help="number of patients to extract at a time")
+  parser.add_argument("--profile", action="store_true", help="write the time and rows for each variable next to the output")
+  parser.add_argument("--columns", help="manifest of the columns to extract, one name or glob pattern per line")
+  parser.add_argument("--workers", type=int, default=1, help="number of independent scans to run at once")
+  parser.add_argument("--compact", action="store_true", help="write dates, flags and text in compact types")
+  args = parser.parse_args()
+
+  study = load_study(args.study_definition)
+  profile = ExtractionProfile() if args.profile else None
+  columns = read_manifest(args.columns) if args.columns else None
+  cache_max_bytes = args.cache_size_mb * 1e6 if args.cache_size_mb else None
+  if args.batch_size:
+    rows, caches = extract_in_batches(
+      study, args.tables_dir, args.output_file, args.batch_size, args.cache_dir, profile, columns, args.workers,
+      cache_max_bytes, args.compact,
+    )
+    print(f"wrote {rows} patients to {args.output_file} in batches of {args.batch_size}")
+    if caches:
+      reused = sum(len(cache.reused) for cache in caches)
+      extracted = sum(len(cache.extracted) for cache in caches)
+      evicted = sum(len(cache.evicted) for cache in caches)
+      rate = f" ({reused / (reused + extracted):.0%} hit rate)" if reused + extracted else ""
+      print(
+        f"{reused} column(s) reused from cache, {extracted} extracted{rate}, {evicted} evicted,"
+        f" across {len(caches)} batches;"
+        f" cache holds {caches[-1].size() / 1e6:.1f}MB"
+      )
+  else:
+    cache = None
+    if args.cache_dir:
+      cache = ColumnCache(args.cache_dir, study.covariate_definitions, tables_snapshot(args.tables_dir), cache_max_bytes)
+    definitions = study.covariate_definitions
+    tables = source_tables(definitions if columns is None else project_definitions(definitions, columns))
+    cohort = extract(study, load_tables(args.tables_dir, names=tables), cache, profile, columns, args.workers, args.compact)
+    if args.compact:
+      write_cohort(compact_table(cohort, definitions, output_schema(definitions, columns, True), {}), args.output_file)
+    else:
+      write_cohort(pa.Table.from_pandas(cohort, preserve_index=False), args.output_file)
+    if cache is not None:
+      print(cache.summary())
+  if profile is not None:
+    report = profile.write(report_path(args.output_file))
+    print(f"wrote the extraction profile to {report_path(args.output_file)}; slowest variables:")
+    print(report.head(10).to_string(index=False))
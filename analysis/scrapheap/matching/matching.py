@@ -0,0 +1,329 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script matches cases to controls, as osmatching's `match()` does and
+# taking the same arguments, so matchwithdate.py and matchwithoutdate.py can use either
+#
+# rather than comparing every case with every control, cases and controls are
+# split into blocks on the exact ("category") match variables, and controls in
+# each block are sorted on a caliper variable (the first closest_match_variable
+# if it has a caliper), so each case only looks at the controls within its
+# caliper window on that variable
+#
+# cases are matched greedily in order of their index date, as in osmatching:
+# each case takes the closest available controls, with ties broken at random
+#
+# blocks never share controls, so they're matched in parallel by a pool of
+# worker processes; each block breaks ties with its own random generator,
+# seeded from RANDOM_SEED and the block's position in sort order, so the
+# matches are the same whatever the number of workers
+# # # # # # # # # # # # # # # # # # # # #
+
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from cohort_store import read_frame
+
+
+NOT_PREVIOUSLY_MATCHED = -9
+
+# seed for breaking ties between equally close controls, so matching is reproducible
+RANDOM_SEED = 123
+
+OFFSET = re.compile(r"^(?P<length>\d+)_(?P<unit>day|month|year)s?_(?P<direction>earlier|later)$")
+
+
+def import_data(path, csv, match_variables, index_date_variable, date_exclusion_variables):
+  """
+  reads cases or controls, indexed by patient_id, converting dates and month-only variables
+  the CSV is read through its memory-mapped cohort store, so repeated runs don't re-parse it
+  """
+  data = read_frame(Path(path) / f"{csv}.csv").set_index("patient_id")
+  for variable, match_type in match_variables.items():
+    if match_type == "month_only":
+      data[f"{variable}_m"] = data[variable].astype(str).str.slice(start=5, stop=7)
+  for variable in [index_date_variable, *(date_exclusion_variables or {})]:
+    if variable in data:
+      data[variable] = pd.to_datetime(data[variable])
+  return data
+
+
+def exact_and_caliper_variables(match_variables):
+  """
+  splits the match variables into those matched exactly (categories and
+  month-only dates) and those matched within a caliper
+  """
+  exact = []
+  calipers = {}
+  for variable, match_type in match_variables.items():
+    if match_type == "category":
+      exact.append(variable)
+    elif match_type == "month_only":
+      exact.append(f"{variable}_m")
+    else:
+      calipers[variable] = match_type
+  return exact, calipers
+
+
+def date_exclusions(data, date_exclusion_variables, index_date):
+  """
+  patients with an exclusion variable before (or after) the index date
+  `index_date` is a single date or an array with one date per patient
+  """
+  excluded = np.zeros(len(data), dtype=bool)
+  for variable, before_after in (date_exclusion_variables or {}).items():
+    dates = data[variable].to_numpy()
+    if before_after == "before":
+      excluded |= dates < index_date
+    elif before_after == "after":
+      excluded |= dates > index_date
+    else:
+      raise ValueError(f"date exclusion must be 'before' or 'after', not '{before_after}'")
+  return excluded
+
+
+def match_index_date(case_date, replace_match_index_date_with_case):
+  """
+  the index date given to a case's matches, when it's taken from the case
+  """
+  if replace_match_index_date_with_case == "no_offset":
+    return case_date
+  offset = OFFSET.match(replace_match_index_date_with_case)
+  if not offset:
+    raise ValueError(f"unrecognised index date offset: {replace_match_index_date_with_case}")
+  length = int(offset["length"])
+  if offset["direction"] == "earlier":
+    length = -length
+  return case_date + pd.DateOffset(**{f"{offset['unit']}s": length})
+
+
+def closest(candidates, deltas, matches_per_case):
+  """
+  the candidates whose deltas (compared in order of closest_match_variables) are
+  among the `matches_per_case` smallest, keeping everyone tied with the last of them
+  """
+  if not deltas or len(candidates) <= matches_per_case:
+    return candidates
+  order = np.lexsort(deltas[::-1])
+  cutoff = tuple(delta[order[matches_per_case - 1]] for delta in deltas)
+  keep = np.zeros(len(candidates), dtype=bool)
+  equal = np.ones(len(candidates), dtype=bool)
+  for delta, limit in zip(deltas, cutoff):
+    keep |= equal & (delta < limit)
+    equal &= delta == limit
+  return candidates[keep | equal]
+
+
+def match_block(
+  cases, controls, calipers, closest_match_variables, matches_per_case, min_matches_per_case,
+  index_date_variable, date_exclusion_variables, replace_match_index_date_with_case, seed,
+):
+  """
+  matches the cases in one block (sharing the same values of the exact match
+  variables) to the controls in the same block, in order of their index dates
+
+  returns the number of matches for each case, and the set_id (and index date,
+  if it's taken from the case) for each control
+  """
+  rng = np.random.default_rng(seed)
+  sort_variable = None
+  if closest_match_variables and closest_match_variables[0] in calipers:
+    sort_variable = closest_match_variables[0]
+  elif calipers:
+    sort_variable = next(iter(calipers))
+  if sort_variable is not None:
+    controls = controls.sort_values(sort_variable, kind="stable")
+
+  control_ids = controls.index.to_numpy()
+  values = {variable: controls[variable].to_numpy(dtype=float) for variable in {*calipers, *closest_match_variables}}
+  available = np.ones(len(controls), dtype=bool)
+  set_ids = np.full(len(controls), NOT_PREVIOUSLY_MATCHED)
+  index_dates = controls[index_date_variable].to_numpy(copy=True) if index_date_variable in controls else None
+  match_counts = np.zeros(len(cases), dtype=int)
+
+  for position, (case_id, case) in enumerate(zip(cases.index, cases.to_dict("records"))):
+    start, stop = 0, len(controls)
+    if sort_variable is not None:
+      value, caliper = case[sort_variable], calipers[sort_variable]
+      if pd.isna(value):
+        continue
+      start = np.searchsorted(values[sort_variable], value - caliper, side="left")
+      stop = np.searchsorted(values[sort_variable], value + caliper, side="right")
+
+    eligible = available[start:stop].copy()
+    for variable, caliper in calipers.items():
+      if variable != sort_variable:
+        eligible &= np.abs(values[variable][start:stop] - case[variable]) <= caliper
+
+    if date_exclusion_variables:
+      if replace_match_index_date_with_case:
+        index_date = match_index_date(case[index_date_variable], replace_match_index_date_with_case)
+        index_date = np.datetime64(index_date)
+      else:
+        index_date = index_dates[start:stop]
+      eligible &= ~date_exclusions(controls.iloc[start:stop], date_exclusion_variables, index_date)
+
+    candidates = np.flatnonzero(eligible) + start
+    deltas = [np.abs(values[variable][candidates] - case[variable]) for variable in closest_match_variables]
+    candidates = closest(candidates, deltas, matches_per_case)
+    if len(candidates) > matches_per_case:
+      # more equally close controls than needed, so pick at random
+      candidates = candidates[np.sort(rng.choice(len(candidates), matches_per_case, replace=False))]
+
+    match_counts[position] = len(candidates)
+    if len(candidates) >= min_matches_per_case:
+      available[candidates] = False
+      set_ids[candidates] = case_id
+      if replace_match_index_date_with_case:
+        index_dates[candidates] = match_index_date(case[index_date_variable], replace_match_index_date_with_case)
+
+  matched_controls = pd.DataFrame({"set_id": set_ids}, index=control_ids)
+  if replace_match_index_date_with_case:
+    matched_controls[index_date_variable] = index_dates
+  return pd.Series(match_counts, index=cases.index), matched_controls
+
+
+def match_blocks(blocks, match_one, workers):
+  """
+  runs `match_one` over (cases, controls, seed) blocks, in a pool of `workers`
+  processes if there's more than one, returning results in the order of `blocks`
+  """
+  if workers <= 1 or len(blocks) <= 1:
+    return [match_one(cases, controls, seed=seed) for cases, controls, seed in blocks]
+  # forked workers inherit the blocks rather than re-importing the calling
+  # script, which runs match() at the top level
+  with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+    # submit the largest blocks first, so a big block isn't left running on its own at the end
+    order = sorted(range(len(blocks)), key=lambda i: -len(blocks[i][0]) * len(blocks[i][1]))
+    futures = {}
+    for i in order:
+      cases, controls, seed = blocks[i]
+      futures[i] = pool.submit(match_one, cases, controls, seed=seed)
+    return [futures[i].result() for i in range(len(blocks))]
+
+
+def match(
+  case_csv,
+  match_csv,
+  matches_per_case,
+  match_variables,
+  index_date_variable,
+  closest_match_variables=None,
+  date_exclusion_variables=None,
+  min_matches_per_case=0,
+  replace_match_index_date_with_case=None,
+  indicator_variable_name="case",
+  output_suffix="",
+  input_path=None,
+  output_path="output",
+  drop_cases_from_matches=False,
+  workers=None,
+  seed=RANDOM_SEED,
+):
+  """
+  matches cases in `<input_path>/<case_csv>.csv` to controls in `<input_path>/<match_csv>.csv`
+  (input_path defaults to output_path) and writes matched_cases, matched_matches
+  and matched_combined CSVs and a matching report to `output_path`
+
+  blocks are matched by `workers` processes (default: one per CPU), or in this
+  process where forking isn't available
+  """
+  if workers is None:
+    workers = os.cpu_count() or 1
+  if "fork" not in multiprocessing.get_all_start_methods():
+    workers = 1
+  closest_match_variables = list(closest_match_variables or [])
+  input_path = output_path if input_path is None else input_path
+  Path(output_path).mkdir(parents=True, exist_ok=True)
+  report_path = Path(output_path) / f"matching_report{output_suffix}.txt"
+  report_path.write_text("")
+
+  def matching_report(lines):
+    text = "\n".join(lines) + "\n\n"
+    with report_path.open("a") as report:
+      report.write(text)
+    print(text)
+
+  matching_report([f"Matching started at: {datetime.now()}"])
+  cases = import_data(input_path, case_csv, match_variables, index_date_variable, date_exclusion_variables)
+  matches = import_data(input_path, match_csv, match_variables, index_date_variable, date_exclusion_variables)
+  matching_report(["Data import:", f"Completed {datetime.now()}", f"Cases    {len(cases)}", f"Matches  {len(matches)}"])
+
+  if drop_cases_from_matches:
+    matches = matches.drop(cases.index, errors="ignore")
+  cases["set_id"] = cases.index
+  matches["set_id"] = NOT_PREVIOUSLY_MATCHED
+  cases[indicator_variable_name] = 1
+  matches[indicator_variable_name] = 0
+
+  if date_exclusion_variables:
+    cases = cases.loc[~date_exclusions(cases, date_exclusion_variables, cases[index_date_variable].to_numpy())]
+    matching_report(["Date exclusions for cases:", f"Completed {datetime.now()}", f"Cases    {len(cases)}"])
+
+  cases = cases.sort_values(index_date_variable, kind="stable")
+  exact, calipers = exact_and_caliper_variables(match_variables)
+
+  # blocks never share controls, so each can be matched on its own
+  control_blocks = dict(iter(matches.groupby(exact, sort=True, observed=True))) if exact else {(): matches}
+  case_blocks = cases.groupby(exact, sort=True, observed=True) if exact else [((), cases)]
+  match_counts = []
+  blocks = []
+  for number, (key, case_block) in enumerate(case_blocks):
+    if key not in control_blocks:
+      match_counts.append(pd.Series(0, index=case_block.index))
+      continue
+    blocks.append((case_block, control_blocks[key], [seed, number]))
+
+  match_one = partial(
+    match_block,
+    calipers=calipers,
+    closest_match_variables=closest_match_variables,
+    matches_per_case=matches_per_case,
+    min_matches_per_case=min_matches_per_case,
+    index_date_variable=index_date_variable,
+    date_exclusion_variables=date_exclusion_variables,
+    replace_match_index_date_with_case=replace_match_index_date_with_case,
+  )
+  results = match_blocks(blocks, match_one, workers)
+  match_counts.extend(counts for counts, _ in results)
+  matched_controls = [controls for _, controls in results]
+
+  # cases with a missing exact match variable are in no block and never match
+  cases["match_counts"] = pd.concat(match_counts).reindex(cases.index).fillna(0).astype(int) if match_counts else 0
+  for controls in matched_controls:
+    matches.loc[controls.index, controls.columns] = controls
+
+  matched_cases = cases.loc[cases["match_counts"] >= min_matches_per_case]
+  matched_matches = matches.loc[matches["set_id"] != NOT_PREVIOUSLY_MATCHED]
+
+  comparisons = []
+  for variable in closest_match_variables:
+    comparisons.extend([
+      f"\n{variable} comparison:",
+      "Cases:", matched_cases[variable].describe().to_string(),
+      "Matches:", matched_matches[variable].describe().to_string(),
+    ])
+  matching_report(
+    [
+      "After matching:",
+      f"Completed {datetime.now()}",
+      f"Cases    {len(matched_cases)}",
+      f"Matches  {len(matched_matches)}\n",
+      "Number of available matches per case:",
+      cases["match_counts"].value_counts().to_string(),
+    ]
+    + comparisons
+  )
+
+  matched_cases.to_csv(Path(output_path) / f"matched_cases{output_suffix}.csv")
+  matched_matches.to_csv(Path(output_path) / f"matched_matches{output_suffix}.csv")
+  pd.concat([matched_cases, matched_matches]).to_csv(Path(output_path) / f"matched_combined{output_suffix}.csv")
+  return matched_cases, matched_matches
@@ -1,4 +1,4 @@
-from osmatching import match
+from matching import match
 
 match(
     case_csv="data_vax_az_withdate",
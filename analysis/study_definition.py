@@ -35,6 +35,22 @@ def days(datestring, days):
 
   return datestring_add
 
+def medications_in_windows(codelist, anchor, windows, returning="binary_flag"):
+  # one with_these_medications variable per window, where each window is the
+  # (first day, last day) relative to `anchor`, eg (-31, -1) for the month before it;
+  # local extraction counts every window over the same codes from a single scan
+  def relative_day(day):
+    return f"{anchor} {'+' if day >= 0 else '-'} {abs(day)} days"
+
+  return {
+    name: patients.with_these_medications(
+      codelist,
+      returning=returning,
+      between=[relative_day(first), relative_day(last)],
+    )
+    for name, (first, last) in windows.items()
+  }
+
 with open("./analysis/lib/diagnosis_groups.json") as f:
   diagnosis_groups = json.load(f)
 
@@ -759,23 +775,11 @@ study = StudyDefinition(
       returning="binary_flag",
       on_or_before="covid_vax_any_1_date - 1 day",
     ),
-    # Asthma systemic steroid prescription code in month 1
-    astrxm1=patients.with_these_medications(
-      codelists.astrx,
-      returning="binary_flag",
-      between=["covid_vax_any_1_date - 31 days", "covid_vax_any_1_date - 1 days"],
-    ),
-    # Asthma systemic steroid prescription code in month 2
-    astrxm2=patients.with_these_medications(
+    # Asthma systemic steroid prescription code in months 1, 2 and 3
+    **medications_in_windows(
       codelists.astrx,
-      returning="binary_flag",
-      between=["covid_vax_any_1_date - 61 days", "covid_vax_any_1_date - 32 days"],
-    ),
-    # Asthma systemic steroid prescription code in month 3
-    astrxm3=patients.with_these_medications(
-      codelists.astrx,
-      returning="binary_flag",
-      between= ["covid_vax_any_1_date - 91 days", "covid_vax_any_1_date - 62 days"],
+      "covid_vax_any_1_date",
+      {"astrxm1": (-31, -1), "astrxm2": (-61, -32), "astrxm3": (-91, -62)},
     ),
   
   ),
@@ -0,0 +1,425 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script builds an extraction plan for a study definition
+# variables that read the same source table relative to the same anchor date(s)
+# are grouped into a single scan, so the table is only read once per group
+# rather than once per variable
+#
+# with a manifest of the columns an action reads (one name or glob pattern, eg
+# covid_vax_*_date, per line), only those columns, the population and what they
+# depend on are planned
+#
+# usage: python analysis/study_plan.py <study_definition> [<manifest>]
+# # # # # # # # # # # # # # # # # # # # #
+
+import importlib
+import re
+from fnmatch import fnmatchcase
+import sys
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+
+# source table read by each variable type used in our study definitions
+# variable types not listed here are derived from other columns, not from a table
+SOURCE_TABLES = {
+  "with_these_clinical_events": "clinical_events",
+  "most_recent_bmi": "clinical_events",
+  "with_these_medications": "medications",
+  "with_tpp_vaccination_record": "vaccinations",
+  "with_healthcare_worker_flag_on_covid_vaccine_record": "healthcare_workers",
+  "with_test_result_in_sgss": "sgss_tests",
+  "admitted_to_hospital": "apcs",
+  "with_ethnicity_from_sus": "apcs",
+  "attended_emergency_care": "ecds",
+  "with_these_codes_on_death_certificate": "ons_deaths",
+  "died_from_any_cause": "ons_deaths",
+  "registered_as_of": "registrations",
+  "registered_with_one_practice_between": "registrations",
+  "date_deregistered_from_all_supported_practices": "registrations",
+  "registered_practice_as_of": "registrations",
+  "address_as_of": "addresses",
+  "care_home_status_as_of": "addresses",
+  "age_as_of": "patients",
+  "sex": "patients",
+  "all": "patients",
+}
+
+# tables read alongside another table by the same scan
+LINKED_TABLES = {"ecds": ("ecds_diagnoses",)}
+
+# tables whose variables can be dated relative to other variables from the same
+# table and still be read in one scan, eg successive vaccine doses
+CHAINED_TABLES = ("vaccinations",)
+
+# tables read in a single scan for all of their variables, whatever dates each is
+# relative to, eg the SGSS test history or hospital spells: the scan runs once all those dates are available
+SINGLE_SCAN_TABLES = ("sgss_tests", "apcs")
+
+# variable types computed from other columns once those are available
+DERIVED_TYPES = ("aggregate_of", "categorised_as", "value_from", "fixed_value")
+
+# arguments which can hold a date or a date expression
+DATE_ARGS = ("date", "reference_date", "start_date", "end_date")
+
+# same grammar as cohortextractor's date expressions, eg "covid_vax_any_1_date - 1 day"
+DATE_EXPRESSION = re.compile(
+  r"^((?P<function>[A-Za-z][A-Za-z0-9_\.]*)\()?(?P<name>[A-Za-z][A-Za-z0-9_\.]*)\)?"
+  r"((?P<operator>[\+\-])(?P<quantity>\d+)(?P<units>[A-Za-z]+))?$"
+)
+
+EXPRESSION_TOKEN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def load_study(name):
+  """
+  imports a study definition module from the analysis directory and returns its `study` object
+  """
+  sys.path.insert(0, "analysis")
+  try:
+    return importlib.import_module(name).study
+  finally:
+    sys.path.remove("analysis")
+
+
+def parse_date_ref(date_ref, column_names):
+  """
+  splits a date reference into the column it depends on (if any) and an offset
+  returns (None, None) for fixed dates or missing limits
+  """
+  if date_ref is None:
+    return None, None
+  match = DATE_EXPRESSION.match(date_ref.replace(" ", ""))
+  if not match or match["name"] not in column_names:
+    return None, None
+  offset = None
+  if match["operator"]:
+    quantity = int(match["quantity"])
+    if match["operator"] == "-":
+      quantity = -quantity
+    offset = (quantity, match["units"].rstrip("s"))
+  if match["function"]:
+    raise ValueError(f"date functions are not supported in column references: {date_ref}")
+  return match["name"], offset
+
+
+def date_refs(query_args):
+  """
+  all date references in a variable's arguments
+  """
+  refs = [query_args[key] for key in DATE_ARGS if isinstance(query_args.get(key), str)]
+  refs.extend(query_args.get("between") or ())
+  return [ref for ref in refs if ref is not None]
+
+
+def anchor_columns(query_args, column_names):
+  """
+  the columns that a variable's date limits are defined relative to, eg ("covid_vax_any_1_date",)
+  """
+  anchors = {parse_date_ref(ref, column_names)[0] for ref in date_refs(query_args)}
+  anchors.discard(None)
+  return tuple(sorted(anchors))
+
+
+def expression_columns(expression, column_names):
+  """
+  column names referenced in a `satisfying` or `categorised_as` expression
+  """
+  return {token for token in EXPRESSION_TOKEN.findall(expression) if token in column_names}
+
+
+def variable_dependencies(query_type, query_args, column_names):
+  """
+  the other columns that a variable needs before it can be computed
+  """
+  dependencies = set(anchor_columns(query_args, column_names))
+  if query_type == "aggregate_of":
+    dependencies.update(query_args["column_names"])
+  elif query_type == "value_from":
+    dependencies.add(query_args["source"])
+  elif query_type == "categorised_as":
+    for expression in query_args["category_definitions"].values():
+      dependencies.update(expression_columns(expression, column_names))
+  return dependencies
+
+
+@dataclass
+class ScanGroup:
+  """
+  variables which are extracted together in one pass over `table`
+  `anchor` is the tuple of columns their date limits are relative to
+  """
+  table: str
+  anchor: tuple
+  variables: OrderedDict = field(default_factory=OrderedDict)
+
+  @property
+  def label(self):
+    return f"scan {self.table} relative to {', '.join(self.anchor) or 'fixed dates'}"
+
+
+@dataclass
+class Derived:
+  """
+  a single variable computed from columns that have already been extracted
+  """
+  name: str
+  query_type: str
+  query_args: dict
+
+  @property
+  def label(self):
+    return f"derive {self.name}"
+
+
+def dependency_levels(covariate_definitions, extracted=()):
+  """
+  level of each variable in the dependency graph: 0 for variables that depend
+  on nothing (or only on the `extracted` columns, which are already available),
+  otherwise one more than the deepest of their dependencies
+  """
+  column_names = set(covariate_definitions) | set(extracted)
+  dependencies = {
+    name: variable_dependencies(query_type, query_args, column_names) - set(extracted)
+    for name, (query_type, query_args) in covariate_definitions.items()
+  }
+  levels = {}
+
+  def level_of(name, visiting=()):
+    if name in levels:
+      return levels[name]
+    if name in visiting:
+      raise ValueError(f"circular dependency between variables: {' -> '.join(visiting + (name,))}")
+    levels[name] = 1 + max(
+      (level_of(dependency, visiting + (name,)) for dependency in dependencies[name]),
+      default=-1,
+    )
+    return levels[name]
+
+  for name in covariate_definitions:
+    level_of(name)
+  return levels
+
+
+def scan_anchors(covariate_definitions, extracted=()):
+  """
+  the anchor of each table variable's scan group: the columns its date limits
+  are relative to, except that in a chained table, a variable dated relative to
+  an earlier variable from the same table (eg covid_vax_pfizer_2_date, on or after
+  covid_vax_pfizer_1_date + 1 days) takes that variable's anchor instead, so a
+  whole vaccination history is read in one scan, and every variable from a
+  single-scan table takes the anchors of all of them
+
+  chains continue through `extracted` variables (a dict of their definitions), so once
+  the first doses are extracted with the population the later doses still share one scan
+  """
+  definitions = {**dict(extracted), **covariate_definitions}
+  column_names = set(definitions)
+  anchors = {}
+
+  def anchor_of(name):
+    if name not in anchors:
+      query_type, query_args = definitions[name]
+      table = SOURCE_TABLES[query_type]
+      anchor = set()
+      for column in anchor_columns(query_args, column_names):
+        if table in CHAINED_TABLES and SOURCE_TABLES.get(definitions[column][0]) == table:
+          anchor.update(anchor_of(column))
+        else:
+          anchor.add(column)
+      anchors[name] = tuple(sorted(anchor))
+    return anchors[name]
+
+  for name, (query_type, _) in covariate_definitions.items():
+    if query_type in SOURCE_TABLES:
+      anchor_of(name)
+  anchors = {name: anchor for name, anchor in anchors.items() if name in covariate_definitions}
+  for table in SINGLE_SCAN_TABLES:
+    names = [name for name in anchors if SOURCE_TABLES[covariate_definitions[name][0]] == table]
+    anchor = tuple(sorted({column for name in names for column in anchors[name]}))
+    anchors.update(dict.fromkeys(names, anchor))
+  return anchors
+
+
+def dependency_closure(covariate_definitions, names):
+  """
+  `names` and every variable they depend on, directly or not, in study definition order
+  """
+  column_names = set(covariate_definitions)
+  needed = set()
+  pending = list(names)
+  while pending:
+    name = pending.pop()
+    if name not in needed:
+      needed.add(name)
+      query_type, query_args = covariate_definitions[name]
+      pending.extend(variable_dependencies(query_type, query_args, column_names))
+  return [name for name in covariate_definitions if name in needed]
+
+
+def population_variables(covariate_definitions):
+  """
+  the population variable and every variable it depends on
+  (eg registered, age and covid_vax_any_1_date), in study definition order
+  """
+  return dependency_closure(covariate_definitions, ["population"] if "population" in covariate_definitions else [])
+
+
+def read_manifest(path):
+  """
+  the columns listed in a manifest, one name or glob pattern per line, ignoring blank lines and # comments
+  """
+  with open(path) as lines:
+    return [column for column in (line.split("#")[0].strip() for line in lines) if column]
+
+
+def select_columns(covariate_definitions, columns):
+  """
+  the variables matching `columns` (names or glob patterns), in study definition order
+  a name or pattern which matches nothing is an error, as it's probably a typo
+  """
+  unmatched = [
+    column for column in columns
+    if not any(fnmatchcase(name, column) for name in covariate_definitions)
+  ]
+  if unmatched:
+    raise ValueError(f"columns not in the study definition: {', '.join(unmatched)}")
+  return [name for name in covariate_definitions if any(fnmatchcase(name, column) for column in columns)]
+
+
+def project_definitions(covariate_definitions, columns):
+  """
+  the definitions needed to extract `columns`: those variables, the population,
+  and everything they depend on, including hidden intermediates (eg astadm for asthma)
+  """
+  selected = select_columns(covariate_definitions, columns)
+  needed = dependency_closure(covariate_definitions, selected + population_variables(covariate_definitions))
+  return {name: covariate_definitions[name] for name in needed}
+
+
+def source_tables(covariate_definitions):
+  """
+  the tables an extraction of these definitions reads
+  """
+  tables = {"patients"}
+  for query_type, _ in covariate_definitions.values():
+    if query_type in SOURCE_TABLES:
+      table = SOURCE_TABLES[query_type]
+      tables.update((table,) + LINKED_TABLES.get(table, ()))
+  return tables
+
+
+def step_definitions(step):
+  if isinstance(step, ScanGroup):
+    return step.variables.items()
+  return [(step.name, (step.query_type, step.query_args))]
+
+
+def step_levels(steps, column_names):
+  """
+  level of each step: 0 for steps that only need columns from outside `steps`,
+  otherwise one more than the deepest of the steps holding the columns it needs;
+  a scan group needs every column any of its variables depends on, so a group
+  merged from variables with different anchors waits for all of them
+  """
+  step_of = {name: number for number, step in enumerate(steps) for name, _ in step_definitions(step)}
+  depends_on = [
+    {
+      step_of[dependency]
+      for name, (query_type, query_args) in step_definitions(step)
+      for dependency in variable_dependencies(query_type, query_args, column_names)
+      if dependency in step_of
+    } - {number}
+    for number, step in enumerate(steps)
+  ]
+  levels = {}
+
+  def level_of(number, visiting=()):
+    if number in levels:
+      return levels[number]
+    if number in visiting:
+      cycle = " -> ".join(steps[other].label for other in visiting + (number,))
+      raise ValueError(f"circular dependency between steps: {cycle}")
+    levels[number] = 1 + max((level_of(other, visiting + (number,)) for other in depends_on[number]), default=-1)
+    return levels[number]
+
+  return [level_of(number) for number in range(len(steps))]
+
+
+def plan_study(covariate_definitions, extracted=()):
+  """
+  takes the (processed) covariate definitions from a StudyDefinition and
+  returns a list of steps, in an order that respects dependencies between variables
+
+  each step is either a ScanGroup, reading one source table once for all its
+  variables, or a Derived variable computed from earlier steps
+  `extracted` holds the definitions of columns which are already available, eg the population's dependencies
+  """
+  levels = dependency_levels(covariate_definitions, extracted)
+  anchors = scan_anchors(covariate_definitions, extracted)
+  groups = OrderedDict()
+  steps = []
+
+  for name in sorted(covariate_definitions, key=lambda name: levels[name]):
+    query_type, query_args = covariate_definitions[name]
+    if query_type in DERIVED_TYPES:
+      steps.append(Derived(name, query_type, query_args))
+      continue
+    if query_type not in SOURCE_TABLES:
+      raise ValueError(f"no source table known for variable type '{query_type}' ({name})")
+    table = SOURCE_TABLES[query_type]
+    key = (table, anchors[name])
+    if key not in groups:
+      groups[key] = ScanGroup(table=key[0], anchor=key[1])
+      steps.append(groups[key])
+    groups[key].variables[name] = (query_type, query_args)
+
+  # a group's variables are only known once it's complete, so the steps are ordered afterwards
+  order = step_levels(steps, set(covariate_definitions) | set(extracted))
+  return [step for level, step in sorted(zip(order, steps), key=lambda step: step[0])]
+
+
+def plan_levels(covariate_definitions, extracted=()):
+  """
+  the steps from plan_study, grouped into levels: each step only depends on
+  steps in earlier levels, so the steps within a level can run at the same time
+  """
+  steps = plan_study(covariate_definitions, extracted)
+  order = step_levels(steps, set(covariate_definitions) | set(extracted))
+  levels = [[] for _ in range(max(order, default=-1) + 1)]
+  for level, step in zip(order, steps):
+    levels[level].append(step)
+  return levels
+
+
+def plan_remaining(covariate_definitions):
+  """
+  the levels (as plan_levels) of every variable outside the population's
+  dependencies, which are extracted first, for every patient
+  """
+  population = population_variables(covariate_definitions)
+  remaining = {name: query for name, query in covariate_definitions.items() if name not in population}
+  return plan_levels(remaining, extracted={name: covariate_definitions[name] for name in population})
+
+
+def describe_plan(plan):
+  """
+  human-readable summary of a plan, one line per step
+  """
+  lines = []
+  for step in plan:
+    if isinstance(step, ScanGroup):
+      lines.append(f"{step.label}: {len(step.variables)} variable(s): {', '.join(step.variables)}")
+    else:
+      lines.append(f"derive {step.name} ({step.query_type})")
+  scans = sum(isinstance(step, ScanGroup) for step in plan)
+  queried = sum(len(step.variables) for step in plan if isinstance(step, ScanGroup))
+  lines.append(f"{queried} table variables in {scans} scans")
+  return "\n".join(lines)
+
+
+if __name__ == "__main__":
+  study = load_study(sys.argv[1] if len(sys.argv) > 1 else "study_definition")
+  definitions = study.covariate_definitions
+  if len(sys.argv) > 2:
+    definitions = project_definitions(definitions, read_manifest(sys.argv[2]))
+  print(describe_plan(plan_study(definitions)))
@@ -0,0 +1,381 @@
+# # # # # # # # # # # # # # # # # # # # #
+# This script generates synthetic TPP-shaped tables (in the layout listed at
+# the top of local_extract.py) for running study definitions locally at scale
+#
+# codes, product names and diagnoses are drawn from the codelists and
+# arguments of the study definitions, mixed with codes none of them use, and
+# dates are spread around the dates in study-dates.json, so every variable
+# type finds matching (and non-matching) rows
+#
+# the same population, seed and study definitions always give the same tables;
+# patients are generated a chunk at a time and appended to each table as it's
+# done, so memory use is bounded by the chunk size rather than the population
+#
+# usage: python analysis/synthetic_tables.py <tables_dir> [--population N] [--seed S] [--study-definitions NAME ...]
+# # # # # # # # # # # # # # # # # # # # #
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from local_extract import codes_and_categories
+from study_plan import load_study
+
+
+STUDY_DEFINITIONS = ("study_definition", "study_definition_2dose", "study_definition_hcw")
+
+CHUNK_SIZE = 1000000
+
+# rows per patient in each event table
+EVENTS_PER_PATIENT = {
+  "clinical_events": 10, "medications": 3, "ecds": 0.25, "sgss_tests": 1, "apcs": 0.125,
+}
+
+# codes no study definition asks for, so that scans have rows to skip
+OTHER_CODES = {
+  "clinical_events": ["22K..", "XaXXX", "Xb123"],
+  "medications": ["0000000000", "1111111111"],
+  "ecds_diagnoses": ["000000000"],
+  "apcs": ["I10", "E119", "J189"],
+  "ons_deaths": ["I219", "C349", "J189"],
+}
+
+# source table of the codes each variable type matches, and the arguments they're in
+CODE_ARGUMENTS = {
+  "with_these_clinical_events": ("clinical_events", "codelist"),
+  "most_recent_bmi": ("clinical_events", None),
+  "with_these_medications": ("medications", "codelist"),
+  "attended_emergency_care": ("ecds_diagnoses", "with_these_diagnoses"),
+  "admitted_to_hospital": ("apcs", "with_these_diagnoses"),
+  "with_these_codes_on_death_certificate": ("ons_deaths", "codelist"),
+}
+
+# share of patients flagged as healthcare workers: the study populations are
+# healthcare workers, so this keeps them a realistic size for benchmarking
+HEALTHCARE_WORKERS = 0.5
+
+# codes most_recent_bmi reads its value from
+BMI_CODES = ["22K.."]
+
+ADMISSION_METHODS = ["11", "21", "22", "2A", "28", "81"]
+ETHNICITY_CODES = ["A", "B", "C1", "D", "H", "M", "R", "99", "Z", None]
+DISCHARGE_DESTINATIONS = ["306706006", "1066331000000109"]
+REGIONS = ["East", "East Midlands", "London", "North East", "North West", "South East", "South West", "West Midlands", "Yorkshire and The Humber"]
+
+TIMESTAMP = pa.timestamp("us")
+SCHEMAS = {
+  "patients": pa.schema([("patient_id", pa.int64()), ("date_of_birth", TIMESTAMP), ("sex", pa.string())]),
+  "registrations": pa.schema([
+    ("patient_id", pa.int64()), ("registration_id", pa.int64()), ("start_date", TIMESTAMP), ("end_date", TIMESTAMP),
+    ("practice_id", pa.int64()), ("stp_code", pa.string()), ("region", pa.string()), ("msoa", pa.string()),
+  ]),
+  "addresses": pa.schema([
+    ("patient_id", pa.int64()), ("address_id", pa.int64()), ("start_date", TIMESTAMP), ("end_date", TIMESTAMP),
+    ("msoa", pa.string()), ("imd_rounded", pa.int64()), ("rural_urban", pa.int64()), ("care_home", pa.int64()),
+    ("requires_nursing", pa.string()), ("does_not_require_nursing", pa.string()),
+  ]),
+  "clinical_events": pa.schema([("patient_id", pa.int64()), ("date", TIMESTAMP), ("code", pa.string()), ("numeric_value", pa.float64())]),
+  "medications": pa.schema([("patient_id", pa.int64()), ("date", TIMESTAMP), ("code", pa.string())]),
+  "vaccinations": pa.schema([("patient_id", pa.int64()), ("date", TIMESTAMP), ("product_name", pa.string()), ("target_disease", pa.string())]),
+  "healthcare_workers": pa.schema([("patient_id", pa.int64()), ("healthcare_worker", pa.string())]),
+  "ecds": pa.schema([("patient_id", pa.int64()), ("attendance_id", pa.int64()), ("date", TIMESTAMP), ("discharge_destination", pa.string())]),
+  "ecds_diagnoses": pa.schema([("attendance_id", pa.int64()), ("code", pa.string())]),
+  "ons_deaths": pa.schema(
+    [("patient_id", pa.int64()), ("date", TIMESTAMP), ("icd10u", pa.string())]
+    + [(f"icd10{number:03d}", pa.string()) for number in range(1, 16)]
+  ),
+  "sgss_tests": pa.schema([("patient_id", pa.int64()), ("date", TIMESTAMP), ("result", pa.string()), ("earliest", pa.int64())]),
+  "apcs": pa.schema([
+    ("patient_id", pa.int64()), ("apcs_ident", pa.int64()), ("admission_date", TIMESTAMP), ("discharge_date", TIMESTAMP),
+    ("admission_method", pa.string()), ("source_of_admission", pa.string()), ("discharge_destination", pa.string()),
+    ("patient_classification", pa.string()), ("primary_diagnosis", pa.string()), ("diagnoses", pa.string()),
+    ("procedures", pa.string()), ("days_in_critical_care", pa.string()), ("ethnicity", pa.string()),
+  ]),
+}
+
+
+def read_study_dates(path="analysis/study-dates.json"):
+  with open(path) as f:
+    return {name: pd.Timestamp(date) for name, date in json.load(f).items()}
+
+
+def codelist_codes(codelist):
+  """
+  the codes in a codelist, or in a plain list of codes
+  """
+  if hasattr(codelist, "has_categories"):
+    return codes_and_categories(codelist)[0]
+  return list(codelist)
+
+
+def study_values(study_definitions):
+  """
+  the codes each source table should contain, and the vaccine product names and
+  target diseases, collected from the study definitions' arguments
+  """
+  codes = {table: set(other) for table, other in OTHER_CODES.items()}
+  codes["clinical_events"].update(BMI_CODES)
+  products, diseases = set(), set()
+  for study in study_definitions:
+    for query_type, query_args in study.covariate_definitions.values():
+      if query_type in CODE_ARGUMENTS:
+        table, argument = CODE_ARGUMENTS[query_type]
+        if query_args.get(argument):
+          codes[table].update(codelist_codes(query_args[argument]))
+      elif query_type == "with_tpp_vaccination_record":
+        products.update(filter(None, [query_args["product_name_matches"]]))
+        diseases.update(filter(None, [query_args["target_disease_matches"]]))
+  return (
+    {table: np.array(sorted(table_codes), dtype=object) for table, table_codes in codes.items()},
+    np.array(sorted(products), dtype=object),
+    np.array(sorted(diseases) or ["SARS-2 CORONAVIRUS"], dtype=object),
+  )
+
+
+class ChunkGenerator:
+  """
+  draws every table for one chunk of patients
+  """
+
+  def __init__(self, rng, patient_ids, first_ids, dates, codes, products, diseases):
+    self.rng = rng
+    self.patient_ids = patient_ids
+    self.size = len(patient_ids)
+    # the first row id of this chunk in each table, so ids are unique across chunks
+    self.first_ids = first_ids
+    self.dates = dates
+    self.codes = codes
+    self.products = products
+    self.diseases = diseases
+
+  def days(self, earliest, latest, size):
+    earliest = pd.Timestamp(earliest)
+    return earliest + pd.to_timedelta(self.rng.integers(0, (pd.Timestamp(latest) - earliest).days, size), "D")
+
+  def rows(self, table):
+    return int(self.size * EVENTS_PER_PATIENT[table])
+
+  def some_patients(self, size):
+    return self.rng.choice(self.patient_ids, size)
+
+  def ids(self, table, size):
+    return self.first_ids[table] + np.arange(size)
+
+  def pick(self, values, size):
+    return values[self.rng.integers(0, len(values), size)]
+
+  def periods(self, size):
+    """
+    start and end dates of registrations or addresses, with most still current
+    """
+    start = self.days("1990-01-01", self.dates["end_date"], size)
+    end = pd.Series(start + pd.to_timedelta(self.rng.integers(30, 3000, size), "D"))
+    end[self.rng.random(size) < 0.85] = pd.NaT
+    return start, end
+
+  def period_patients(self):
+    # everyone has one period, and a fifth have a second
+    return np.concatenate([self.patient_ids, self.some_patients(self.size // 5)])
+
+  def patients(self):
+    return pd.DataFrame({
+      "patient_id": self.patient_ids,
+      "date_of_birth": self.days("1915-01-01", "2015-01-01", self.size),
+      "sex": self.rng.choice(["M", "F"], self.size),
+    })
+
+  def registrations(self):
+    patient_ids = self.period_patients()
+    size = len(patient_ids)
+    start, end = self.periods(size)
+    return pd.DataFrame({
+      "patient_id": patient_ids,
+      "registration_id": self.ids("registrations", size),
+      "start_date": start,
+      "end_date": end,
+      "practice_id": self.rng.integers(1, 2500, size),
+      "stp_code": np.char.add("E540000", self.rng.integers(10, 60, size).astype(str)),
+      "region": self.rng.choice(REGIONS, size),
+      "msoa": np.char.add("E0200", self.rng.integers(1000, 9999, size).astype(str)),
+    })
+
+  def addresses(self):
+    patient_ids = self.period_patients()
+    size = len(patient_ids)
+    start, end = self.periods(size)
+    care_home = (self.rng.random(size) < 0.02).astype(int)
+    nursing = np.where(care_home == 1, self.rng.choice(["Y", "N"], size), None)
+    return pd.DataFrame({
+      "patient_id": patient_ids,
+      "address_id": self.ids("addresses", size),
+      "start_date": start,
+      "end_date": end,
+      "msoa": np.where(self.rng.random(size) < 0.02, "NPC", np.char.add("E0200", self.rng.integers(1000, 9999, size).astype(str))),
+      "imd_rounded": self.rng.integers(-1, 328, size) * 100,
+      "rural_urban": self.rng.integers(1, 9, size),
+      "care_home": care_home,
+      "requires_nursing": nursing,
+      "does_not_require_nursing": np.where(nursing == "Y", "N", np.where(care_home == 1, "Y", None)),
+    })
+
+  def clinical_events(self):
+    size = self.rows("clinical_events")
+    return pd.DataFrame({
+      "patient_id": self.some_patients(size),
+      "date": self.days(self.dates["start_date"] - pd.DateOffset(years=10), self.dates["end_date"] + pd.DateOffset(days=120), size),
+      "code": self.pick(self.codes["clinical_events"], size),
+      "numeric_value": self.rng.uniform(15, 50, size).round(1),
+    })
+
+  def medications(self):
+    size = self.rows("medications")
+    return pd.DataFrame({
+      "patient_id": self.some_patients(size),
+      "date": self.days(self.dates["start_date"] - pd.DateOffset(years=2), self.dates["end_date"] + pd.DateOffset(days=120), size),
+      "code": self.pick(self.codes["medications"], size),
+    })
+
+  def vaccinations(self):
+    """
+    a first dose for 85% of patients from when their product became available,
+    and a second dose of the same product 3 to 12 weeks later for 80% of those
+    """
+    vaccinated = self.patient_ids[self.rng.random(self.size) < 0.85]
+    size = len(vaccinated)
+    product = self.rng.integers(0, len(self.products), size)
+    available = pd.DatetimeIndex([self.product_start(name) for name in self.products])[product]
+    window = np.maximum((self.dates["lastvax_date"] - available).days.to_numpy(), 1)
+    first = available + pd.to_timedelta((self.rng.random(size) * window).astype(int), "D")
+    second = self.rng.random(size) < 0.8
+    gap = pd.to_timedelta(self.rng.integers(21, 84, size), "D")
+    vaccinations = pd.concat([
+      pd.DataFrame({"patient_id": vaccinated, "date": first, "product_name": self.products[product]}),
+      pd.DataFrame({"patient_id": vaccinated[second], "date": (first + gap)[second], "product_name": self.products[product][second]}),
+    ], ignore_index=True)
+    vaccinations["target_disease"] = self.pick(self.diseases, len(vaccinations))
+    return vaccinations
+
+  def product_start(self, product_name):
+    for brand in ("pfizer", "az", "moderna"):
+      if f"start_date_{brand}" in self.dates and brand_matches(brand, product_name):
+        return self.dates[f"start_date_{brand}"]
+    return self.dates["start_date"]
+
+  def healthcare_workers(self):
+    return pd.DataFrame({"patient_id": self.patient_ids[self.rng.random(self.size) < HEALTHCARE_WORKERS], "healthcare_worker": "Y"})
+
+  def ecds(self):
+    size = self.rows("ecds")
+    return pd.DataFrame({
+      "patient_id": self.some_patients(size),
+      "attendance_id": self.ids("ecds", size),
+      "date": self.days(self.dates["start_date"] - pd.DateOffset(months=6), self.dates["end_date"] + pd.DateOffset(days=120), size),
+      "discharge_destination": self.rng.choice(DISCHARGE_DESTINATIONS, size),
+    })
+
+  def ecds_diagnoses(self):
+    attendances = self.rows("ecds")
+    size = attendances * 2
+    return pd.DataFrame({
+      "attendance_id": self.ids("ecds", attendances)[self.rng.integers(0, attendances, size)],
+      "code": self.pick(self.codes["ecds_diagnoses"], size),
+    })
+
+  def ons_deaths(self):
+    died = self.patient_ids[self.rng.random(self.size) < 0.02]
+    size = len(died)
+    deaths = {
+      "patient_id": died,
+      "date": self.days(self.dates["start_date"] - pd.DateOffset(months=6), self.dates["end_date"] + pd.DateOffset(days=120), size),
+      "icd10u": self.pick(self.codes["ons_deaths"], size),
+    }
+    for number in range(1, 16):
+      deaths[f"icd10{number:03d}"] = np.where(self.rng.random(size) < 0.1, self.pick(self.codes["ons_deaths"], size), None)
+    return pd.DataFrame(deaths)
+
+  def sgss_tests(self):
+    size = self.rows("sgss_tests")
+    return pd.DataFrame({
+      "patient_id": self.some_patients(size),
+      "date": self.days("2020-03-01", self.dates["end_date"] + pd.DateOffset(days=120), size),
+      "result": self.rng.choice(["positive", "negative"], size, p=[0.2, 0.8]),
+      "earliest": (self.rng.random(size) < 0.7).astype(int),
+    })
+
+  def apcs(self):
+    size = self.rows("apcs")
+    admitted = self.days("2020-01-01", self.dates["end_date"] + pd.DateOffset(days=120), size)
+    primary = self.pick(self.codes["apcs"], size)
+    secondary = self.pick(self.codes["apcs"], size)
+    return pd.DataFrame({
+      "patient_id": self.some_patients(size),
+      "apcs_ident": self.ids("apcs", size),
+      "admission_date": admitted,
+      "discharge_date": admitted + pd.to_timedelta(self.rng.integers(0, 20, size), "D"),
+      "admission_method": self.rng.choice(ADMISSION_METHODS, size),
+      "source_of_admission": "19",
+      "discharge_destination": "19",
+      "patient_classification": "1",
+      "primary_diagnosis": primary,
+      "diagnoses": "||" + primary + " ," + secondary,
+      "procedures": "",
+      "days_in_critical_care": self.rng.choice(["0", "0", "0", "2", "5"], size),
+      "ethnicity": self.rng.choice(np.array(ETHNICITY_CODES, dtype=object), size),
+    })
+
+
+def brand_matches(brand, product_name):
+  return {"pfizer": "Pfizer", "az": "AstraZeneca", "moderna": "Moderna"}[brand] in product_name
+
+
+def generate_tables(tables_dir, population, seed=0, study_definitions=STUDY_DEFINITIONS, chunk_size=CHUNK_SIZE):
+  """
+  writes a <table>.feather file for each table in SCHEMAS to `tables_dir`,
+  and returns the number of rows in each
+
+  study definitions that fail to import are skipped, so their codes won't be drawn
+  """
+  studies = []
+  for name in study_definitions:
+    try:
+      studies.append(load_study(name))
+    except Exception as error:
+      print(f"skipping codes from {name}: {error!r}")
+  codes, products, diseases = study_values(studies)
+  dates = read_study_dates()
+  rng = np.random.default_rng(seed)
+
+  tables_dir = Path(tables_dir)
+  tables_dir.mkdir(parents=True, exist_ok=True)
+  options = pa.ipc.IpcWriteOptions(compression="zstd")
+  writers = {table: pa.ipc.new_file(tables_dir / f"{table}.feather", schema, options=options) for table, schema in SCHEMAS.items()}
+  rows = dict.fromkeys(SCHEMAS, 0)
+  try:
+    for start in range(0, population, chunk_size):
+      patient_ids = np.arange(start, min(start + chunk_size, population))
+      chunk = ChunkGenerator(rng, patient_ids, dict(rows), dates, codes, products, diseases)
+      for table, writer in writers.items():
+        frame = getattr(chunk, table)()
+        writer.write_table(pa.Table.from_pandas(frame, schema=SCHEMAS[table], preserve_index=False))
+        rows[table] += len(frame)
+  finally:
+    for writer in writers.values():
+      writer.close()
+  return rows
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="generate synthetic TPP-shaped tables for running study definitions locally")
+  parser.add_argument("tables_dir")
+  parser.add_argument("--population", type=int, default=100000)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--study-definitions", nargs="+", default=STUDY_DEFINITIONS)
+  args = parser.parse_args()
+
+  rows = generate_tables(args.tables_dir, args.population, args.seed, args.study_definitions)
+  for table, count in rows.items():
+    print(f"{table}: {count} rows")
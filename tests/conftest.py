@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# the analysis scripts import each other as top-level modules, as they do when run from the repository root
+ANALYSIS = Path(__file__).resolve().parents[1] / "analysis"
+sys.path[:0] = [str(ANALYSIS), str(ANALYSIS / "scrapheap" / "matching")]
+
+
+@pytest.fixture
+def tables_dir(tmp_path):
+  """
+  small TPP-shaped patients and clinical_events tables (in the layout listed at the top
+  of local_extract.py), the same every time
+  """
+  rng = np.random.default_rng(0)
+  patients = pd.DataFrame({
+    "patient_id": np.arange(1, 301),
+    "date_of_birth": pd.to_datetime("1930-01-01") + pd.to_timedelta(rng.integers(0, 85 * 365, 300), unit="D"),
+    "sex": rng.choice(["F", "M"], 300),
+  })
+  events = pd.DataFrame({
+    "patient_id": rng.integers(1, 301, 3000),
+    "date": pd.to_datetime("2019-06-01") + pd.to_timedelta(rng.integers(0, 900, 3000), unit="D"),
+    "code": rng.choice(["A1", "A2", "B1", "B2", "X9"], 3000),
+    "numeric_value": rng.normal(25, 5, 3000).round(1),
+  })
+  tables = tmp_path / "tables"
+  tables.mkdir()
+  patients.to_feather(tables / "patients.feather")
+  events.to_feather(tables / "clinical_events.feather")
+  return tables
@@ -0,0 +1,94 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("cohortextractor")
+from cohortextractor.expressions import format_expression
+
+from category_expressions import evaluate, evaluate_categories
+
+
+# empty value of each column type, as the TPP backend fills in for patients with no match
+EMPTY = {"date": "", "str": "", "int": 0, "bool": 0, "float": 0}
+
+COLUMN_TYPES = {"x": "int", "y": "int", "f": "float", "flag": "bool", "a_date": "date", "b_date": "date", "s": "str"}
+
+FRAME = pd.DataFrame({
+  "x": [7, -7, 4, 0, 3, 9, 1, 2],
+  "y": [3, 2, 0, 5, 0, 3, 1, -4],
+  "f": [2.5, 0.0, 1.5, -3.0, 4.0, 10.0, 0.5, 7.25],
+  "flag": [1, 0, 1, 0, 1, 0, 0, 1],
+  "a_date": pd.to_datetime(["2021-01-01", None, "2020-06-30", None, "2021-03-04", "2021-01-01", "2019-12-31", "2022-02-02"]),
+  "b_date": pd.to_datetime(["2021-01-02", None, "2020-06-30", "2021-01-01", None, "2020-12-31", "2020-01-01", "2022-02-02"]),
+  "s": ["London", "", "North East", "", "London", "South", "", "London"],
+})
+
+
+def sqlite_table():
+  """
+  the frame as the TPP backend holds it: dates as ISO strings, and '' where they're missing
+  """
+  connection = sqlite3.connect(":memory:")
+  table = FRAME.copy()
+  for name, column_type in COLUMN_TYPES.items():
+    if column_type == "date":
+      table[name] = FRAME[name].dt.strftime("%Y-%m-%d").fillna("")
+  table.to_sql("patients", connection, index=False)
+  return connection
+
+
+def to_sql(expression):
+  sql, _ = format_expression(expression, {name: name for name in COLUMN_TYPES}, {name: EMPTY[kind] for name, kind in COLUMN_TYPES.items()})
+  return sql
+
+
+@pytest.mark.parametrize("expression", [
+  # dates, where a missing date is '': before every date and equal to another missing date
+  "a_date < b_date",
+  "a_date = b_date",
+  "a_date >= b_date",
+  "a_date",
+  "NOT b_date",
+  "a_date OR b_date",
+  # integer division truncates towards zero, and dividing by zero is NULL
+  "x / y = 2",
+  "x / y = -3",
+  "x / y > 1",
+  "x / 2 = 3",
+  # division with a float on either side doesn't truncate
+  "f / y > 1",
+  "x / 2.0 = 3.5",
+  "x / f < 2",
+  # NULL propagates through NOT, and AND / OR only settle it when the other side decides
+  "NOT (x / y > 1)",
+  "(x / y > 1) AND flag",
+  "(x / y > 1) OR flag",
+  "(x / y > 1) AND NOT flag",
+  "(x / y > 1) OR NOT (x / y > 1)",
+  "NOT ((x / y > 1) AND a_date)",
+  # other arithmetic, strings and flags
+  "x * 2 + 1 > f",
+  "-x < 0",
+  "x - y >= 0 AND f",
+  "s = 'London'",
+  "s AND NOT flag",
+  "s != '' OR a_date > b_date",
+])
+def test_satisfying_matches_sql(expression):
+  expected = [
+    None if value is None else bool(value)
+    for (value,) in sqlite_table().execute(
+      f"SELECT CASE WHEN ({to_sql(expression)}) THEN 1 WHEN NOT ({to_sql(expression)}) THEN 0 END FROM patients ORDER BY rowid"
+    )
+  ]
+  result = evaluate(expression, FRAME, COLUMN_TYPES)
+  assert [None if pd.isna(value) else bool(value) for value in result] == expected
+
+
+def test_categorised_as_matches_sql():
+  # a patient gets the first category that's true, skipping any that are NULL
+  categories = {"low": "x / y < 1", "high": "x / y >= 1 OR b_date", "none": "DEFAULT"}
+  clauses = " ".join(f"WHEN {to_sql(expression)} THEN '{category}'" for category, expression in categories.items() if expression != "DEFAULT")
+  expected = [value for (value,) in sqlite_table().execute(f"SELECT CASE {clauses} ELSE 'none' END FROM patients ORDER BY rowid")]
+  assert evaluate_categories(categories, FRAME, COLUMN_TYPES).tolist() == expected
@@ -0,0 +1,50 @@
+import os
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("cohortextractor")
+from cohortextractor import codelist_from_csv
+
+from codelist_store import CodelistStore
+
+
+REPOSITORY = Path(__file__).resolve().parents[1]
+
+
+def test_the_store_gives_the_codelists_read_from_csv(tmp_path, monkeypatch):
+  monkeypatch.chdir(REPOSITORY)
+  from codelists import CODELIST_CSVS
+
+  compiled = CodelistStore(CODELIST_CSVS, tmp_path / "codelists.pickle")
+  for name in CODELIST_CSVS:
+    compiled.get(name)
+  compiled.save()
+  # and again from the saved store, without parsing any CSV
+  store = CodelistStore(CODELIST_CSVS, tmp_path / "codelists.pickle")
+  for name, spec in CODELIST_CSVS.items():
+    expected = codelist_from_csv(spec["path"], spec["system"], spec["column"], spec.get("category_column"))
+    loaded = store.get(name)
+    assert list(loaded) == list(expected), name
+    assert (loaded.system, loaded.has_categories) == (expected.system, expected.has_categories), name
+  assert not store.changed
+
+
+def test_a_changed_csv_is_compiled_again(tmp_path):
+  path = tmp_path / "asthma.csv"
+  path.write_text("code,term\nA1,asthma\nA2,severe asthma\n")
+  specs = {"asthma": {"path": str(path), "system": "ctv3", "column": "code"}}
+  store = CodelistStore(specs, tmp_path / "codelists.pickle")
+  assert list(store.get("asthma")) == ["A1", "A2"]
+  store.save()
+
+  # touched but unchanged: the saved codes are kept, with the new modification time
+  os.utime(path, ns=(0, 0))
+  store = CodelistStore(specs, tmp_path / "codelists.pickle")
+  assert list(store.get("asthma")) == ["A1", "A2"]
+  assert store.entries["asthma"]["mtime"] == 0
+  store.save()
+
+  path.write_text("code,term\nA1,asthma\nA3,brittle asthma\n")
+  store = CodelistStore(specs, tmp_path / "codelists.pickle")
+  assert list(store.get("asthma")) == ["A1", "A3"]
@@ -0,0 +1,35 @@
+import pandas as pd
+
+from cohort_store import extracted_types
+from local_extract import compact_table, format_output, output_schema
+
+
+def dated(**query_args):
+  return ("with_these_clinical_events", {"column_type": "date", "returning": "date", **query_args})
+
+
+# one variable at each precision, one without a date_format (written as just the year, as
+# cohortextractor writes it) and an aggregate_of taking the date_format of its first column
+DEFINITIONS = {
+  "day": dated(date_format="YYYY-MM-DD"),
+  "month": dated(date_format="YYYY-MM"),
+  "year": dated(),
+  "first": ("aggregate_of", {"column_type": "date", "column_names": ["month", "day"], "aggregate_function": "MIN"}),
+}
+
+COHORT = pd.DataFrame({
+  "patient_id": [1, 2, 3],
+  "day": pd.to_datetime(["2021-03-04", None, "2020-12-31"]),
+  "month": pd.to_datetime(["2021-02-15", "2021-01-31", None]),
+  "year": pd.to_datetime(["2019-07-08", None, "2020-01-01"]),
+  "first": pd.to_datetime(["2021-02-15", "2021-01-31", "2020-12-31"]),
+})
+
+
+def test_compact_dates_read_back_as_cohortextractor_writes_them():
+  expected = format_output(COHORT.set_index("patient_id"), DEFINITIONS)
+  table = compact_table(COHORT, DEFINITIONS, output_schema(DEFINITIONS, compact=True), {})
+  result = extracted_types(table).to_pandas()
+  assert result.fillna("").to_dict("list") == expected.fillna("").to_dict("list")
+  assert result["first"].tolist() == ["2021-02", "2021-01", "2020-12"]
+  assert result["year"].fillna("").tolist() == ["2019", "", "2020"]
@@ -0,0 +1,80 @@
+import pytest
+
+pytest.importorskip("cohortextractor")
+from cohortextractor import StudyDefinition, codelist, patients
+
+from extract_cache import ColumnCache, tables_snapshot
+from local_extract import extract, load_tables
+
+
+def study(
+  minimum_age=16, asthma_codes=("A1", "A2"), asthma_between=("2019-06-01", "2020-12-31"), review_codes=("B1",),
+):
+  # first_asthma isn't in the population's dependencies, and reviews are dated relative to it
+  return StudyDefinition(
+    default_expectations={"date": {"earliest": "2019-01-01", "latest": "2021-12-31"}},
+    population=patients.satisfying(f"age >= {minimum_age}", age=patients.age_as_of("2021-01-01")),
+    first_asthma=patients.with_these_clinical_events(
+      codelist(list(asthma_codes), system="ctv3"), between=list(asthma_between),
+      returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD",
+    ),
+    reviews=patients.with_these_clinical_events(
+      codelist(list(review_codes), system="ctv3"), between=["first_asthma", "2021-12-31"],
+      returning="number_of_matches_in_period",
+    ),
+  )
+
+
+def run(study, tables_dir, cache_dir, snapshot=None, max_bytes=None):
+  cache = ColumnCache(
+    cache_dir, study.covariate_definitions, tables_snapshot(tables_dir) if snapshot is None else snapshot, max_bytes,
+  )
+  return extract(study, load_tables(tables_dir), cache), cache
+
+
+def test_an_unchanged_study_reuses_every_column(tables_dir, tmp_path):
+  first, cache = run(study(), tables_dir, tmp_path / "cache")
+  # derived variables (here the population) are computed again, not cached
+  assert sorted(cache.extracted) == ["age", "first_asthma", "reviews"]
+  second, cache = run(study(), tables_dir, tmp_path / "cache")
+  assert cache.extracted == []
+  assert sorted(cache.reused) == ["age", "first_asthma", "reviews"]
+  assert second.equals(first)
+
+
+@pytest.mark.parametrize("changed, extracted", [
+  # its own arguments, and everything dated relative to it
+  ({"asthma_between": ("2019-06-01", "2020-06-30")}, ["first_asthma", "reviews"]),
+  # its codelist
+  ({"asthma_codes": ("A1",)}, ["first_asthma", "reviews"]),
+  ({"review_codes": ("B1", "B2")}, ["reviews"]),
+  # the population, for everything only extracted for the population, but not for its own dependencies
+  ({"minimum_age": 18}, ["first_asthma", "reviews"]),
+])
+def test_a_changed_definition_misses_the_cache(tables_dir, tmp_path, changed, extracted):
+  run(study(), tables_dir, tmp_path / "cache")
+  cohort, cache = run(study(**changed), tables_dir, tmp_path / "cache")
+  assert sorted(cache.extracted) == extracted
+  fresh, _ = run(study(**changed), tables_dir, tmp_path / "fresh")
+  assert cohort.equals(fresh)
+
+
+def test_changed_source_data_misses_the_cache(tables_dir, tmp_path):
+  run(study(), tables_dir, tmp_path / "cache")
+  _, cache = run(study(), tables_dir, tmp_path / "cache", snapshot="another database")
+  assert cache.reused == []
+  # rewriting a table changes the snapshot taken from the directory
+  (tables_dir / "clinical_events.feather").write_bytes((tables_dir / "clinical_events.feather").read_bytes())
+  _, cache = run(study(), tables_dir, tmp_path / "cache")
+  assert cache.reused == []
+
+
+def test_the_least_recently_used_columns_are_evicted_to_keep_within_the_limit(tables_dir, tmp_path):
+  _, stale = run(study(), tables_dir, tmp_path / "cache")
+  # the size of the columns the changed study uses, without the reviews column it no longer does
+  _, fresh = run(study(review_codes=("B2",)), tables_dir, tmp_path / "fresh")
+  limit = fresh.size()
+  _, cache = run(study(review_codes=("B2",)), tables_dir, tmp_path / "cache", max_bytes=limit)
+  assert cache.evicted == [stale.fingerprints["reviews"]]
+  assert cache.size() <= limit
+  assert all(cache.get(name) is not None for name in ("age", "first_asthma", "reviews"))
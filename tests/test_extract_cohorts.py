@@ -0,0 +1,46 @@
+from collections import Counter
+
+import pytest
+
+pytest.importorskip("cohortextractor")
+from cohortextractor import StudyDefinition, codelist, patients
+
+import local_extract
+from extract_cohorts import extract_cohorts
+from local_extract import extract, load_tables
+
+
+def study(minimum_age, **variables):
+  return StudyDefinition(
+    default_expectations={"date": {"earliest": "2019-01-01", "latest": "2021-12-31"}},
+    population=patients.satisfying(f"age >= {minimum_age}", age=patients.age_as_of("2021-01-01")),
+    asthma=patients.with_these_clinical_events(
+      codelist(["A1", "A2"], system="ctv3"), on_or_before="2020-12-31",
+      returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD",
+    ),
+    **variables,
+  )
+
+
+def test_a_variable_shared_by_two_definitions_is_extracted_once(tables_dir, monkeypatch):
+  studies = {
+    "adults": study(16, reviews=patients.with_these_clinical_events(
+      codelist(["B1"], system="ctv3"), between=["asthma", "2021-12-31"], returning="number_of_matches_in_period",
+    )),
+    "older": study(60, sex=patients.sex(return_expectations={"category": {"ratios": {"F": 0.5, "M": 0.5}}})),
+  }
+  tables = load_tables(tables_dir)
+  separately = {key: extract(study, tables) for key, study in studies.items()}
+
+  scanned = Counter()
+  for table, scanner in list(local_extract.SCANNERS.items()):
+    def counting(group, *arguments, scanner=scanner):
+      scanned.update(list(group.variables))
+      return scanner(group, *arguments)
+    monkeypatch.setitem(local_extract.SCANNERS, table, counting)
+  cohorts, shared = extract_cohorts(studies, tables)
+
+  assert shared == {"adults": ["asthma", "age"], "older": ["asthma", "age"]}
+  assert scanned == {"age": 1, "asthma": 1, "reviews": 1, "sex": 1}
+  for key, cohort in cohorts.items():
+    assert cohort.equals(separately[key]), key
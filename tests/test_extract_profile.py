@@ -0,0 +1,46 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from extract_profile import profile_from_log
+
+
+# cohortextractor's console log (with its colours) of TPPBackend.execute_queries running
+# two variables' queries and one without a description, captured from cohortextractor 1.93.3
+CAPTURED_LOG = Path(__file__).parent / "data" / "generate_cohort.log"
+
+# the same queries logged by the installed cohortextractor, over sqlite instead of SQL Server
+GENERATE_LOG = """
+import sqlite3
+from cohortextractor import tpp_backend
+from cohortextractor.log_utils import LoggingDatabaseConnection, init_logging
+init_logging()
+backend = tpp_backend.TPPBackend.__new__(tpp_backend.TPPBackend)
+backend._db_connection = LoggingDatabaseConnection(tpp_backend.logger, sqlite3.connect(":memory:"))
+backend.execute_queries([
+  "-- Query for covid_vax_pfizer_1_date\\nSELECT 1",
+  "-- Query for age\\nSELECT 2",
+  "SELECT 3",
+])
+"""
+
+
+def test_query_times_are_read_from_a_captured_log():
+  with open(CAPTURED_LOG) as lines:
+    report = profile_from_log(lines).report()
+  assert report.set_index("variable")["seconds"].to_dict() == {
+    "covid_vax_pfizer_1_date": pytest.approx(0.0002965889998449711),
+    "age": pytest.approx(0.00016526400031580124),
+  }
+  assert set(report["step"]) == {"query"}
+
+
+def test_query_times_are_read_from_the_installed_cohortextractor_log():
+  # fails if a new cohortextractor changes the format of its timing lines
+  pytest.importorskip("cohortextractor")
+  log = subprocess.run([sys.executable, "-c", GENERATE_LOG], capture_output=True, text=True, check=True).stderr
+  report = profile_from_log(log.splitlines()).report()
+  assert sorted(report["variable"]) == ["age", "covid_vax_pfizer_1_date"]
+  assert report["seconds"].gt(0).all()
@@ -0,0 +1,244 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("cohortextractor")
+from cohortextractor import StudyDefinition, codelist, patients
+
+import local_extract
+from cohort_store import extracted_types, open_cohort
+from local_extract import extract, extract_in_batches, load_tables
+
+
+def with_population(**variables):
+  return StudyDefinition(
+    default_expectations={"date": {"earliest": "2019-01-01", "latest": "2021-12-31"}},
+    population=patients.all(),
+    **variables,
+  )
+
+
+def test_unsupported_options_are_reported_as_errors(tables_dir):
+  study = with_population(
+    asthma=patients.with_these_clinical_events(
+      codelist(["A1"], system="ctv3"), between=["2019-06-01", "2020-12-31"],
+      ignore_days_where_these_codes_occur=codelist(["B1"], system="ctv3"),
+    ),
+  )
+  with pytest.raises(ValueError, match="ignore_days_where_these_codes_occur is not supported locally"):
+    extract(study, load_tables(tables_dir))
+
+
+def test_unsupported_sgss_values_are_reported_as_errors(tables_dir):
+  pd.DataFrame({
+    "patient_id": [1, 2], "date": pd.to_datetime(["2020-05-01", "2020-06-01"]),
+    "result": ["positive", "negative"], "earliest": [1, 1],
+  }).to_feather(tables_dir / "sgss_tests.feather")
+  study = with_population(
+    variant=patients.with_test_result_in_sgss(
+      pathogen="SARS-CoV-2", test_result="positive", returning="variant", restrict_to_earliest_specimen_date=False,
+      find_first_match_in_period=True,
+      return_expectations={"category": {"ratios": {"B.1.1.7": 0.5, "VOC-21APR-02": 0.5}}, "incidence": 0.5},
+    ),
+  )
+  with pytest.raises(ValueError, match="with_test_result_in_sgss returning variant is not supported locally"):
+    extract(study, load_tables(tables_dir))
+
+
+# patient 1 has two spells admitted on the same day (one discharged that day) and a later one;
+# patient 2 has two spells admitted on the same day, the lower apcs_ident listed second;
+# patient 4 has two spells discharged on the same day
+SPELLS = pd.DataFrame({
+  "patient_id": [1, 1, 1, 2, 2, 4, 4],
+  "apcs_ident": [10, 11, 12, 21, 20, 40, 41],
+  "admission_date": pd.to_datetime(["2021-01-05", "2021-01-05", "2021-02-01", "2021-03-01", "2021-03-01", "2021-01-10", "2021-01-11"]),
+  "discharge_date": pd.to_datetime(["2021-01-05", "2021-01-08", "2021-02-03", "2021-03-04", "2021-03-02", "2021-01-12", "2021-01-12"]),
+  "admission_method": ["21", "21", "22", "21", "21", "11", "21"],
+  "primary_diagnosis": ["U071", "J189", "U072", "A01", "B02", "C03", "D04"],
+  "diagnoses": ["||U071", "||J189 ,U071", "||U072", "||A01", "||B02", "||C03", "||D04"],
+  "procedures": [""] * 7,
+  "days_in_critical_care": [0, 2, 1, 0, 0, 0, 3],
+  "ethnicity": [None] * 7,
+})
+
+
+def admitted(returning, **query_args):
+  return patients.admitted_to_hospital(
+    between=["2021-01-01", "2021-12-31"], returning=returning, date_format="YYYY-MM-DD",
+    return_expectations={"incidence": 0.5, "date": {"earliest": "2021-01-01"}, "category": {"ratios": {"A01": 1}}},
+    **query_args,
+  )
+
+
+def test_spells_are_summarised_as_the_tpp_backend_does(tables_dir):
+  SPELLS.to_feather(tables_dir / "apcs.feather")
+  study = with_population(
+    bed_days=admitted("total_bed_days_in_period"),
+    critical_care_days=admitted("total_critical_care_days_in_period"),
+    spells=admitted("number_of_matches_in_period"),
+    first_diagnosis=admitted("primary_diagnosis", find_first_match_in_period=True),
+    last_diagnosis=admitted("primary_diagnosis", find_last_match_in_period=True),
+    first_discharged=admitted("date_discharged", find_first_match_in_period=True),
+    last_discharged=admitted("date_discharged", find_last_match_in_period=True),
+  )
+  cohort = extract(study, load_tables(tables_dir)).set_index("patient_id").loc[[1, 2, 3, 4]]
+  # spells admitted on the same day are counted once, with the longest stay, and a
+  # spell discharged on the day it was admitted is one bed day
+  assert cohort["bed_days"].tolist() == [4 + 3, 4, 0, 3 + 2]
+  assert cohort["critical_care_days"].tolist() == [2 + 1, 0, 0, 3]
+  assert cohort["spells"].tolist() == [3, 2, 0, 2]
+  # ties on the admission date go to the lowest apcs_ident, for the first and the last admission
+  assert cohort["first_diagnosis"].tolist() == ["U071", "B02", "", "C03"]
+  assert cohort["last_diagnosis"].tolist() == ["U072", "B02", "", "D04"]
+  assert cohort["first_discharged"].fillna("").tolist() == ["2021-01-05", "2021-03-02", "", "2021-01-12"]
+  assert cohort["last_discharged"].fillna("").tolist() == ["2021-02-03", "2021-03-04", "", "2021-01-12"]
+
+
+def test_unsupported_admission_conditions_are_reported_as_errors(tables_dir):
+  SPELLS.to_feather(tables_dir / "apcs.feather")
+  study = with_population(admissions=admitted("binary_flag", with_administrative_category=["01"]))
+  with pytest.raises(ValueError, match="admitted_to_hospital with_administrative_category is not supported locally"):
+    extract(study, load_tables(tables_dir))
+
+
+def test_windows_counted_together_match_each_counted_alone(tables_dir, monkeypatch):
+  # patients without an A1 event have no anchor, which is read as 1900-01-01
+  reviews = codelist(["B1", "B2"], system="ctv3")
+  study = with_population(
+    anchor=patients.with_these_clinical_events(
+      codelist(["A1"], system="ctv3"), returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD",
+    ),
+    before=patients.with_these_clinical_events(
+      reviews, between=["anchor - 90 days", "anchor - 1 day"], include_date_of_match=True, date_format="YYYY-MM-DD",
+    ),
+    around=patients.with_these_clinical_events(
+      reviews, between=["anchor - 30 days", "anchor + 30 days"], returning="number_of_matches_in_period",
+    ),
+    ever_before=patients.with_these_clinical_events(
+      reviews, on_or_before="anchor", include_date_of_match=True, date_format="YYYY-MM-DD",
+    ),
+    after=patients.with_these_clinical_events(reviews, on_or_after="anchor", returning="number_of_matches_in_period"),
+  )
+  definitions = study.covariate_definitions
+  families = local_extract.window_families(definitions, definitions)
+  assert families == {
+    "before": ("anchor", {"before": (-90, -1), "around": (-30, 30), "ever_before": (None, 0), "after": (0, None)}),
+  }
+
+  together = extract(study, load_tables(tables_dir))
+  monkeypatch.setattr(local_extract, "window_families", lambda variables, column_names: {})
+  alone = extract(study, load_tables(tables_dir))
+  assert together.equals(alone)
+  assert together["anchor"].isna().any() and together["before"].gt(0).any() and together["after"].gt(0).any()
+
+
+# the TPP backend's query for a patient's practice on a date, as duckdb_scans.py ran it
+# before scan_periods: the latest start, then the latest end, then the lowest registration_id
+CURRENT_REGISTRATION = """
+  SELECT patient_id, practice_id, region FROM (
+    SELECT *, ROW_NUMBER() OVER (
+      PARTITION BY patient_id
+      ORDER BY start_date DESC, COALESCE(end_date, TIMESTAMP '9999-12-31') DESC, registration_id
+    ) AS rownum
+    FROM registrations
+    WHERE start_date <= $date AND COALESCE(end_date, TIMESTAMP '9999-12-31') > $date
+  ) WHERE rownum = 1
+"""
+
+REGISTRATIONS = pd.DataFrame.from_records([
+  # overlapping: both are current on 2021-01-01, and the later start wins
+  (1, 1, "2019-01-01", "2021-06-01", 101), (1, 2, "2020-06-01", None, 102),
+  # adjacent: the first ends on 2021-01-01, when the second starts
+  (2, 3, "2019-01-01", "2021-01-01", 103), (2, 4, "2021-01-01", None, 104),
+  # ends on 2021-01-01, so not registered on that day
+  (3, 5, "2018-01-01", "2021-01-01", 105),
+  # the same start: the later end wins, and a current registration has the latest end
+  (4, 6, "2020-01-01", "2021-03-01", 106), (4, 7, "2020-01-01", "2022-01-01", 107),
+  (5, 8, "2020-01-01", "2022-01-01", 108), (5, 9, "2020-01-01", None, 109),
+  # the same start and end: the lowest registration_id wins
+  (6, 11, "2020-06-01", None, 111), (6, 10, "2020-06-01", None, 110),
+  # a registration with no start is never current
+  (7, 12, None, None, 112),
+], columns=["patient_id", "registration_id", "start_date", "end_date", "practice_id"]).assign(
+  start_date=lambda rows: pd.to_datetime(rows["start_date"]),
+  end_date=lambda rows: pd.to_datetime(rows["end_date"]),
+  region=lambda rows: "region " + rows["practice_id"].astype(str),
+  stp_code="", msoa="",
+)
+
+
+def test_current_registrations_match_the_tpp_query(tables_dir):
+  duckdb = pytest.importorskip("duckdb")
+  REGISTRATIONS.to_feather(tables_dir / "registrations.feather")
+  study = with_population(
+    **{
+      f"{column}_{day}": patients.registered_practice_as_of(
+        date, returning=returning, return_expectations={"incidence": 1, "category": {"ratios": {"1": 1}}},
+      )
+      for day, date in (("index", "2021-01-01"), ("before", "2020-12-31"), ("start", "2020-06-01"))
+      for column, returning in (("practice", "pseudo_id"), ("region", "nuts1_region_name"))
+    },
+    registered_index=patients.registered_as_of("2021-01-01"),
+  )
+  cohort = extract(study, load_tables(tables_dir)).set_index("patient_id")
+  connection = duckdb.connect()
+  connection.register("registrations", REGISTRATIONS)
+  for day, date in (("index", "2021-01-01"), ("before", "2020-12-31"), ("start", "2020-06-01")):
+    expected = connection.execute(CURRENT_REGISTRATION, {"date": pd.Timestamp(date)}).df().set_index("patient_id")
+    expected = expected.reindex(cohort.index)
+    assert cohort[f"practice_{day}"].tolist() == expected["practice_id"].fillna(0).astype("int64").tolist(), day
+    assert cohort[f"region_{day}"].tolist() == expected["region"].fillna("").tolist(), day
+  assert cohort.loc[1:7, "practice_index"].tolist() == [102, 104, 0, 107, 109, 110, 0]
+  # registered_as_of, from DuckDB, agrees on who is registered
+  assert cohort["registered_index"].tolist() == cohort["practice_index"].gt(0).astype("int64").tolist()
+
+
+def small_study():
+  return StudyDefinition(
+    default_expectations={"date": {"earliest": "2019-01-01", "latest": "2021-12-31"}},
+    population=patients.satisfying("age >= 16", age=patients.age_as_of("2021-01-01")),
+    sex=patients.sex(return_expectations={"category": {"ratios": {"F": 0.5, "M": 0.5}}}),
+    asthma=patients.with_these_clinical_events(
+      codelist(["A1", "A2"], system="ctv3"), returning="date", find_first_match_in_period=True, date_format="YYYY-MM",
+    ),
+    reviews=patients.with_these_clinical_events(
+      codelist(["B1"], system="ctv3"), between=["asthma", "2021-12-31"], returning="number_of_matches_in_period",
+    ),
+  )
+
+
+@pytest.mark.parametrize("output_name, compact", [
+  ("input.feather", False), ("input.parquet", False), ("input.feather", True), ("input.parquet", True),
+])
+def test_batches_write_the_same_cohort_as_one_extraction(tables_dir, tmp_path, output_name, compact):
+  # sexes first seen in later batches, so the compact dictionary grows from batch to batch
+  people = pd.read_feather(tables_dir / "patients.feather")
+  people["sex"] = ["F"] * 100 + ["M"] * 150 + ["I"] * 50
+  people.to_feather(tables_dir / "patients.feather")
+  study = small_study()
+  cohort = extract(study, load_tables(tables_dir))
+  # batches of 70 patients, so the last of the 300 is short
+  rows, _ = extract_in_batches(study, tables_dir, tmp_path / output_name, 70, compact=compact)
+  assert rows == len(cohort)
+  written = open_cohort(tmp_path / output_name)
+  if compact:
+    written = extracted_types(written)
+  assert written.to_pandas().fillna("").to_dict("list") == cohort.fillna("").to_dict("list")
+  assert not (tmp_path / f"{output_name}.partial").exists()
+
+
+def test_a_failed_batch_leaves_the_previous_output_in_place(tables_dir, tmp_path, monkeypatch):
+  output = tmp_path / "input.feather"
+  output.write_bytes(b"the previous cohort")
+  batches = []
+
+  def failing(*arguments):
+    batches.append(1)
+    if len(batches) == 3:
+      raise MemoryError
+    return extract(*arguments)
+
+  monkeypatch.setattr(local_extract, "extract", failing)
+  with pytest.raises(MemoryError):
+    extract_in_batches(small_study(), tables_dir, output, 70)
+  assert output.read_bytes() == b"the previous cohort"
+  assert list(tmp_path.glob("*.partial")) == []
@@ -0,0 +1,124 @@
+from pathlib import Path
+
+import pytest
+
+from study_plan import ScanGroup, load_study, plan_levels, plan_remaining, plan_study
+
+
+REPOSITORY = Path(__file__).resolve().parents[1]
+
+
+def vaccination(product, between):
+  return (
+    "with_tpp_vaccination_record",
+    {
+      "column_type": "date", "product_name_matches": product, "between": between,
+      "returning": "date", "find_first_match_in_period": True,
+    },
+  )
+
+
+def sgss_test(between):
+  return (
+    "with_test_result_in_sgss",
+    {
+      "column_type": "int", "pathogen": "SARS-CoV-2", "test_result": "any", "between": between,
+      "returning": "number_of_matches_in_period",
+    },
+  )
+
+
+def scan_groups(levels, table):
+  return [step for steps in levels for step in steps if isinstance(step, ScanGroup) and step.table == table]
+
+
+def test_later_doses_share_one_scan_after_the_population():
+  # the population depends on the first doses, so they're extracted first, and
+  # the later doses chain from them (and from each other) in a single scan
+  definitions = {}
+  for product in ("pfizer", "az"):
+    definitions[f"{product}_1"] = vaccination(product, ("2020-12-08", "2021-04-25"))
+    definitions[f"{product}_2"] = vaccination(product, (f"{product}_1 + 1 days", "2021-04-25"))
+    definitions[f"{product}_3"] = vaccination(product, (f"{product}_2 + 1 days", "2021-04-25"))
+  definitions["any_1"] = ("aggregate_of", {"column_type": "date", "column_names": ["pfizer_1", "az_1"], "aggregate_function": "MIN"})
+  definitions["population"] = ("categorised_as", {"column_type": "bool", "category_definitions": {1: "any_1", 0: "DEFAULT"}})
+
+  groups = scan_groups(plan_remaining(definitions), "vaccinations")
+  assert len(groups) == 1
+  assert list(groups[0].variables) == ["pfizer_2", "az_2", "pfizer_3", "az_3"]
+
+
+def test_derived_variables_wait_for_a_merged_single_scan_group():
+  # t_fixed doesn't depend on anything, but it shares a scan with t_rel, which
+  # waits for the anchor, so flag (from t_fixed) has to wait for that scan too
+  definitions = {
+    "vax": vaccination("pfizer", ("2020-12-08", "2021-04-25")),
+    "anchor": ("aggregate_of", {"column_type": "date", "column_names": ["vax"], "aggregate_function": "MIN"}),
+    "t_fixed": sgss_test(("2020-02-01", "2020-12-07")),
+    "t_rel": sgss_test(("anchor", "2021-04-25")),
+    "flag": ("categorised_as", {"column_type": "bool", "category_definitions": {1: "t_fixed > 0", 0: "DEFAULT"}}),
+  }
+  steps = plan_study(definitions)
+  order = [step.table if isinstance(step, ScanGroup) else step.name for step in steps]
+  assert order == ["vaccinations", "anchor", "sgss_tests", "flag"]
+
+  levels = plan_levels(definitions)
+  assert [[step.label for step in steps] for steps in levels] == [
+    ["scan vaccinations relative to fixed dates"],
+    ["derive anchor"],
+    ["scan sgss_tests relative to anchor"],
+    ["derive flag"],
+  ]
+
+
+def test_derived_variables_wait_for_the_merged_apcs_scan():
+  # ethnicity from SUS needs no dates, but it's read in the same scan of apcs as the
+  # admissions after the first dose, so a category derived from it waits for that scan
+  definitions = {
+    "vax": vaccination("pfizer", ("2020-12-08", "2021-04-25")),
+    "anchor": ("aggregate_of", {"column_type": "date", "column_names": ["vax"], "aggregate_function": "MIN"}),
+    "ethnicity_6_sus": (
+      "with_ethnicity_from_sus", {"column_type": "str", "returning": "group_6", "use_most_frequent_code": True},
+    ),
+    "admitted_date": (
+      "admitted_to_hospital",
+      {
+        "column_type": "date", "between": ("anchor", None), "returning": "date_admitted",
+        "find_first_match_in_period": True, "with_admission_method": ["21", "22"],
+      },
+    ),
+    "ethnicity_known": (
+      "categorised_as", {"column_type": "bool", "category_definitions": {1: "ethnicity_6_sus != ''", 0: "DEFAULT"}},
+    ),
+  }
+  levels = plan_levels(definitions)
+  assert [[step.label for step in steps] for steps in levels] == [
+    ["scan vaccinations relative to fixed dates"],
+    ["derive anchor"],
+    ["scan apcs relative to anchor"],
+    ["derive ethnicity_known"],
+  ]
+  assert list(scan_groups(levels, "apcs")[0].variables) == ["ethnicity_6_sus", "admitted_date"]
+
+
+def test_a_single_scan_group_dated_relative_to_itself_is_an_error():
+  # the anchor comes from the sgss scan, which can't also wait for it
+  definitions = {
+    "t_first": ("with_test_result_in_sgss", {**sgss_test(("2020-02-01", "2020-12-07"))[1], "returning": "date", "column_type": "date"}),
+    "anchor": ("aggregate_of", {"column_type": "date", "column_names": ["t_first"], "aggregate_function": "MIN"}),
+    "t_rel": sgss_test(("anchor", "2021-04-25")),
+  }
+  with pytest.raises(ValueError, match="circular dependency between steps"):
+    plan_study(definitions)
+
+
+@pytest.mark.skipif(
+  not (REPOSITORY / "output" / "data" / "metadata_study-dates.json").exists(),
+  reason="the study definitions read the study dates written by design.R",
+)
+@pytest.mark.parametrize("name", ["study_definition", "study_definition_2dose"])
+def test_study_definitions_read_vaccinations_once_after_the_population(name, monkeypatch):
+  pytest.importorskip("cohortextractor")
+  monkeypatch.chdir(REPOSITORY)
+  definitions = load_study(name).covariate_definitions
+  assert len(scan_groups(plan_remaining(definitions), "vaccinations")) == 1